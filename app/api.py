@@ -1,138 +1,240 @@
-from urllib import response
+import asyncio
+import random
 import uuid
 import os
 import json
 from datetime import datetime
-from pathlib import Path
 from typing import Optional, List
-import shutil
-import logging
+from contextlib import asynccontextmanager, aclosing
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel, Field
 
-from app.constants import LOG_LEVEL, MAX_RESPONSE_LENGTH
-from app.utils.additional_rules import search_additional_rules
-from app.utils.normalization import truncate_text
-from app.utils.terminology import search_terminology
-from app.utils.claude import generate_response
+from app.constants import LOG_LEVEL, LOG_FORMAT, MAX_RESPONSE_LENGTH, RESPONSE_POSTFIX, METRICS_ENABLED, PERSONAS_DIR
+from app.utils import codec
+from app.utils.normalization import truncate_text, StreamingTruncator
+from app.utils.claude import ClaudeRequest, generate_response_stream, warm_up
+from app.utils.history_cache import HistoryCache
+from app.utils.history_store import HistoryStore, JsonlHistoryStore, SqliteHistoryStore
+from app.utils.gateway import CircuitBreaker, CircuitOpen, ProviderBusy, ProviderGateway
+from app.utils.history_writer import ConversationWriter
+from app.utils.idempotency import IdempotencyStore, MemoryIdempotencyStore, RequestDeduplicator, SqliteIdempotencyStore
+from app.utils.log import EventLogger, bind, setup_logging
+from app.utils.metrics import inc, register_collector, render_metrics, server_timing_header, stage, start_timings
 from app.utils.models import ChatMessage, ChatRole, TermCategory
+from app.utils.persona import Persona, persona_registry
+from app.utils.prompt import prompt_cache_stats
+from app.utils.user_locks import UserTurnLocks
 
 # Environment variables for conversation history
+CONV_HISTORY_BACKEND = os.getenv("CONV_HISTORY_BACKEND", "jsonl").lower()
 CONV_HISTORY_PATH_TEMPLATE = os.getenv("CONV_HISTORY_PATH_TEMPLATE", "data/conversations/{user_id}.jsonl")
+CONV_HISTORY_SQLITE_PATH = os.getenv("CONV_HISTORY_SQLITE_PATH", "data/conversations/history.sqlite3")
 MAX_CHAT_LOG_LENGTH = int(os.getenv("MAX_CHAT_LOG_LENGTH", "10"))
-CONV_HISTORY_MAX_SIZE_MB = int(os.getenv("CONV_HISTORY_MAX_SIZE_MB", "50"))
+CONV_HISTORY_MAX_SIZE_MB = float(os.getenv("CONV_HISTORY_MAX_SIZE_MB", "50"))
 CONV_HISTORY_ARCHIVE_FOLDER = os.getenv("CONV_HISTORY_ARCHIVE_FOLDER", "data/conversations/archive/")
+CONV_HISTORY_FLUSH_INTERVAL_MS = int(os.getenv("CONV_HISTORY_FLUSH_INTERVAL_MS", "50"))
+CONV_HISTORY_FSYNC = os.getenv("CONV_HISTORY_FSYNC", "false").lower() == "true"
+HISTORY_CACHE_MAX_USERS = int(os.getenv("HISTORY_CACHE_MAX_USERS", "10000"))
+HISTORY_CACHE_MAX_MB = int(os.getenv("HISTORY_CACHE_MAX_MB", "64"))
+
+# Environment variables for the batch endpoint
+CHAT_BATCH_CONCURRENCY = int(os.getenv("CHAT_BATCH_CONCURRENCY", "8"))
+CHAT_BATCH_MAX_SIZE = int(os.getenv("CHAT_BATCH_MAX_SIZE", "100"))
+
+# Environment variables for retried deliveries of the same request_id
+IDEMPOTENCY_BACKEND = os.getenv("IDEMPOTENCY_BACKEND", "memory").lower()
+IDEMPOTENCY_SQLITE_PATH = os.getenv("IDEMPOTENCY_SQLITE_PATH", "data/idempotency.sqlite3")
+IDEMPOTENCY_TTL_SEC = float(os.getenv("IDEMPOTENCY_TTL_SEC", "600"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+IDEMPOTENCY_LEASE_SEC = float(os.getenv("IDEMPOTENCY_LEASE_SEC", "120"))
+
+# Environment variables for admission control of Claude calls
+PROVIDER_MAX_CONCURRENCY = int(os.getenv("PROVIDER_MAX_CONCURRENCY", "64"))
+PROVIDER_MAX_QUEUE = int(os.getenv("PROVIDER_MAX_QUEUE", "256"))
+CHAT_DEADLINE_MS = int(os.getenv("CHAT_DEADLINE_MS", "15000"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SEC = float(os.getenv("CIRCUIT_RESET_SEC", "30"))
+
+# Environment variables for the order of the turns of a user: none, process, or workers to run several API workers
+USER_ORDERING = os.getenv("USER_ORDERING", "none").lower()
+USER_LOCK_DIR = os.getenv("USER_LOCK_DIR", "data/locks")
+USER_LOCK_STRIPES = int(os.getenv("USER_LOCK_STRIPES", "1024"))
+
+setup_logging(LOG_LEVEL, LOG_FORMAT)
+logger = EventLogger(__name__)
+
+
+def create_history_store() -> HistoryStore:
+    """Create the conversation history store selected by CONV_HISTORY_BACKEND."""
+    if CONV_HISTORY_BACKEND == "jsonl":
+        return JsonlHistoryStore(
+            path_template=CONV_HISTORY_PATH_TEMPLATE,
+            archive_folder=CONV_HISTORY_ARCHIVE_FOLDER,
+            max_bytes=int(CONV_HISTORY_MAX_SIZE_MB * 1024 * 1024),
+            carry_over=2 * MAX_CHAT_LOG_LENGTH,
+            max_cached_sizes=HISTORY_CACHE_MAX_USERS,
+            fsync=CONV_HISTORY_FSYNC
+        )
+    if CONV_HISTORY_BACKEND == "sqlite":
+        return SqliteHistoryStore(
+            db_path=CONV_HISTORY_SQLITE_PATH,
+            max_bytes=int(CONV_HISTORY_MAX_SIZE_MB * 1024 * 1024),
+            carry_over=2 * MAX_CHAT_LOG_LENGTH,
+            max_cached_sizes=HISTORY_CACHE_MAX_USERS,
+            fsync=CONV_HISTORY_FSYNC
+        )
+    raise ValueError(f"unknown CONV_HISTORY_BACKEND: {CONV_HISTORY_BACKEND}")
 
-logger = logging.getLogger(__name__)
-logger.setLevel(LOG_LEVEL)
 
-def get_conversation_file_path(user_id: str) -> str:
-    """Get the conversation file path for a user."""
-    p = Path(os.path.expandvars(os.path.expanduser(CONV_HISTORY_PATH_TEMPLATE.format(user_id=user_id))))
-    return str(p)
+history_store = create_history_store()
 
+history_cache = HistoryCache(
+    capacity=MAX_CHAT_LOG_LENGTH,
+    max_users=HISTORY_CACHE_MAX_USERS,
+    max_bytes=HISTORY_CACHE_MAX_MB * 1024 * 1024
+)
 
-def ensure_directory_exists(file_path: str):
-    """Ensure the directory for the file path exists."""
-    directory = Path(file_path).parent
-    directory.mkdir(parents=True, exist_ok=True)
 
+def create_idempotency_store() -> IdempotencyStore:
+    """Create the store of answered requests selected by IDEMPOTENCY_BACKEND."""
+    if IDEMPOTENCY_BACKEND == "memory":
+        return MemoryIdempotencyStore(ttl=IDEMPOTENCY_TTL_SEC, max_entries=IDEMPOTENCY_MAX_ENTRIES)
+    if IDEMPOTENCY_BACKEND == "sqlite":
+        return SqliteIdempotencyStore(db_path=IDEMPOTENCY_SQLITE_PATH, ttl=IDEMPOTENCY_TTL_SEC, lease=IDEMPOTENCY_LEASE_SEC)
+    raise ValueError(f"unknown IDEMPOTENCY_BACKEND: {IDEMPOTENCY_BACKEND}")
+
+
+# Failed and fallback responses are answered again when retried
+request_deduplicator = RequestDeduplicator(create_idempotency_store(), keep=lambda response: response.status == "ok" and not response.fallback_used)
+
+provider_gateway = ProviderGateway(
+    max_concurrency=PROVIDER_MAX_CONCURRENCY,
+    max_queue=PROVIDER_MAX_QUEUE,
+    breaker=CircuitBreaker(failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_SEC)
+)
+
+
+def create_user_locks() -> Optional[UserTurnLocks]:
+    """Create the locks of the turns of each user selected by USER_ORDERING, None when turns aren't ordered."""
+    if USER_ORDERING == "none":
+        return None
+    if USER_ORDERING == "process":
+        return UserTurnLocks(stripes=USER_LOCK_STRIPES)
+    if USER_ORDERING == "workers":
+        return UserTurnLocks(stripes=USER_LOCK_STRIPES, lock_dir=USER_LOCK_DIR, max_users=HISTORY_CACHE_MAX_USERS)
+    raise ValueError(f"unknown USER_ORDERING: {USER_ORDERING}")
 
-def archive_conversation_file(file_path: str, user_id: str):
-    """Archive conversation file if it exists and exceeds size limit."""
-    try:
-        if not Path(file_path).exists():
-            return
-            
-        file_size_mb = Path(file_path).stat().st_size / (1024 * 1024)
-        if file_size_mb < CONV_HISTORY_MAX_SIZE_MB:
-            return
-
-        # Create archive directory
-        archive_dir = Path(CONV_HISTORY_ARCHIVE_FOLDER)
-        archive_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Generate archive filename with timestamp
-        timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-        archive_filename = f"{user_id}_{timestamp}.jsonl"
-        archive_path = archive_dir / archive_filename
 
-        # Copy to archive
-        shutil.copy(file_path, archive_path)
+user_locks = create_user_locks()
 
-        # Truncate original file to last 2 * MAX_CHAT_LOG_LENGTH lines
-        with open(file_path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.writelines(lines[-2 * MAX_CHAT_LOG_LENGTH:])
+# Personas of PERSONAS_DIR next to the default one, all sharing the provider client and the history store
+persona_registry.load_dir(PERSONAS_DIR)
 
+
+def write_conversation_records(user_id: str, records: List[dict]):
+    """Append history records to the store. Called by the conversation writer with the user's lock held."""
+    try:
+        history_store.append(user_id, records)
     except Exception:
-        # If archiving fails, continue silently to avoid breaking the chat
-        pass
+        # If saving fails, continue to avoid breaking the chat
+        logger.exception("history_write_failed", user_id=user_id, records=len(records))
+
+
+conversation_writer = ConversationWriter(
+    write=write_conversation_records,
+    user_lock=history_cache.user_lock,
+    flush_interval=CONV_HISTORY_FLUSH_INTERVAL_MS / 1000
+)
+
+
+def collect_cache_metrics() -> List[tuple[str, str, float]]:
+    history = history_cache.stats()
+    prompts = prompt_cache_stats()
+    return [
+        ("history_cache_hits_total", "counter", history["hits"]),
+        ("history_cache_misses_total", "counter", history["misses"]),
+        ("history_cache_evictions_total", "counter", history["evictions"]),
+        ("history_cache_users", "gauge", history["users"]),
+        ("history_cache_bytes", "gauge", history["bytes"]),
+        ("prompt_cache_hits_total", "counter", prompts["hits"]),
+        ("prompt_cache_misses_total", "counter", prompts["misses"]),
+        ("prompt_cache_size", "gauge", prompts["size"]),
+    ]
+
+
+def collect_gateway_metrics() -> List[tuple[str, str, float]]:
+    gateway = provider_gateway.stats()
+    return [
+        ("provider_in_flight", "gauge", gateway["in_flight"]),
+        ("provider_waiting", "gauge", gateway["waiting"]),
+        ("provider_circuit_open", "gauge", int(gateway["circuit_open"])),
+    ]
+
+
+register_collector(collect_cache_metrics)
+register_collector(collect_gateway_metrics)
 
 
 def load_conversation_history(user_id: str, max_length: int = MAX_CHAT_LOG_LENGTH) -> List[ChatMessage]:
-    """Load conversation history for a user, limited to max_length messages."""
-    file_path = get_conversation_file_path(user_id)
-    
-    if not Path(file_path).exists():
-        return []
-    
-    try:
-        messages = []
-        with open(file_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                    
-                data = json.loads(line)
-                role = ChatRole.USER if data['role'] == 'user' else ChatRole.AI
-                messages.append(ChatMessage(role=role, content=data['text']))
-
-        # Return only the last max_length messages
-        return messages[-max_length:]
+    """Load conversation history for a user, limited to max_length messages. The store is only read on a cache miss."""
+    with history_cache.user_lock(user_id):
+        messages = history_cache.get(user_id) if max_length <= history_cache.capacity else None
+        if messages is None:
+            # Queued records must reach the store before it is read
+            conversation_writer.flush_user(user_id)
+            messages = history_store.load_last(user_id, max(max_length, history_cache.capacity))
+            history_cache.put(user_id, messages)
+    return messages[-max_length:] if max_length > 0 else []
 
-    except Exception:
-        # If loading fails, return empty history to avoid breaking the chat
-        return []
 
+def save_conversation_messages(user_id: str, platform: str, messages: List[ChatMessage], persona: Optional[Persona] = None):
+    """Save messages to the user's history as a single write, with their keyword matches so later turns don't search them again.
 
-def save_conversation_message(user_id: str, platform: str, role: str, text: str):
-    """Save a conversation message to the user's history file."""
+    `user_id` is the history key of the user's conversation with `persona`, the default persona when omitted.
+    """
     try:
-        file_path = get_conversation_file_path(user_id)
-        
-        # Archive if file is too large before adding new message
-        archive_conversation_file(file_path, user_id)
-        
-        # Ensure directory exists
-        ensure_directory_exists(file_path)
-        
-        # Create message object
-        message_data = {
-            "user_id": user_id,
-            "platform": platform,
-            "timestamp": datetime.utcnow().isoformat() + "Z",
-            "role": role,
-            "text": text
-        }
-        
-        # Append to file
-        with open(file_path, 'a', encoding='utf-8') as f:
-            f.write(json.dumps(message_data, ensure_ascii=False) + '\n')
-            
+        timestamp = datetime.utcnow().isoformat() + "Z"
+        snapshot = (persona or persona_registry.default).knowledge.get()
+        records = [
+            {
+                "user_id": user_id,
+                "platform": platform,
+                "timestamp": timestamp,
+                "role": "user" if message.role == ChatRole.USER else "assistant",
+                "text": message.content,
+                "matches": snapshot.matches_of(message).to_dict()
+            }
+            for message in messages
+        ]
+
+        # Queue for the writer, the cache serves the messages until they are flushed. Workers sharing the
+        # history write it at once instead, the next turn may be read by another worker
+        with history_cache.user_lock(user_id):
+            if USER_ORDERING == "workers":
+                write_conversation_records(user_id, records)
+            else:
+                conversation_writer.append(user_id, records)
+            for message in messages:
+                history_cache.append(user_id, message)
+
     except Exception:
         # If saving fails, continue silently to avoid breaking the chat
         pass
 
 
+def save_conversation_message(user_id: str, platform: str, role: str, text: str):
+    """Save a conversation message to the user's history."""
+    save_conversation_messages(user_id, platform, [ChatMessage(role=ChatRole.USER if role == 'user' else ChatRole.AI, content=text)])
+
+
 class ChatRequest(BaseModel):
     request_id: Optional[str] = Field(default=None, description="Unique id for tracing; echoed if provided")
     origin: Optional[dict] = Field(default=None)
     author: dict = Field(..., description="Author information with user_id")
     message: dict = Field(..., description="Message with text content")
+    persona_id: Optional[str] = Field(default=None, description="Persona answering the request, the default persona when omitted")
 
     def get_platform(self) -> str:
         """Get platform from origin, default to 'unknown'"""
@@ -148,6 +250,14 @@ class ChatRequest(BaseModel):
         """Get text from message"""
         return self.message["text"]
 
+    def get_idempotency_key(self) -> Optional[str]:
+        """Key of retried deliveries of this request, None when the request has no request_id"""
+        if not self.request_id:
+            return None
+        if self.persona_id is not None:
+            return json.dumps([self.get_user_id(), self.request_id, self.persona_id], ensure_ascii=False)
+        return json.dumps([self.get_user_id(), self.request_id], ensure_ascii=False)
+
 
 class ErrorInfo(BaseModel):
     code: str = Field(..., description="Error code")
@@ -156,77 +266,199 @@ class ErrorInfo(BaseModel):
 
 class ChatResponse(BaseModel):
     request_id: Optional[str] = Field(default=None, description="Mirrors the request id when provided")
-    status: str = Field(..., description="Status: ok or provider_error")
+    status: str = Field(..., description="Status: ok, busy or provider_error")
     messages: List[str] = Field(..., description="Response messages")
     fallback_used: Optional[bool] = Field(default=False, description="True when fallback text is used")
     error: Optional[ErrorInfo] = Field(default=None, description="Error information when status is provider_error")
 
 
-app = FastAPI(title="Pino Anxiousroid API", version="0.1")
+class ChatBatchRequest(BaseModel):
+    requests: List[ChatRequest] = Field(..., max_length=CHAT_BATCH_MAX_SIZE, description="Chat requests, answered in order per user")
 
 
-@app.post("/api/chat/v0.1", response_model=ChatResponse)
-async def chat_endpoint(request: ChatRequest):
+class ChatBatchResponse(BaseModel):
+    responses: List[ChatResponse] = Field(..., description="One response per request, in request order")
+
+
+def fallback_response(request_id: str, endpoint: str, reason: str, persona: Persona) -> ChatResponse:
+    """An in-character reply of the persona for when Claude can't answer, by `reason`: deadline or circuit_open."""
+    inc("chat_responses_total", endpoint=endpoint, status="fallback")
+    inc("chat_fallbacks_total", endpoint=endpoint, reason=reason)
+    return ChatResponse(
+        request_id=request_id,
+        status="ok",
+        messages=[random.choice(persona.fallback_messages)],
+        fallback_used=True
+    )
+
+
+def busy_response(request_id: str, endpoint: str) -> ChatResponse:
+    inc("chat_responses_total", endpoint=endpoint, status="busy")
+    return ChatResponse(
+        request_id=request_id,
+        status="busy",
+        messages=[],
+        fallback_used=False,
+        error=ErrorInfo(
+            code="busy",
+            message="Too many requests are waiting for Claude, retry later"
+        )
+    )
+
+
+@asynccontextmanager
+async def user_turn(user_id: str, deadline: float):
+    """Hold the turn of a user from loading the history until the reply is saved, with USER_ORDERING set.
+    Waiting for the turn ends with TimeoutError at `deadline`."""
+    if user_locks is None:
+        yield
+        return
+    async with user_locks.hold(user_id, deadline) as changed:
+        if changed:
+            # Written by another worker since this one last served the user
+            with history_cache.user_lock(user_id):
+                history_cache.invalidate(user_id)
+                history_store.invalidate(user_id)
+        yield
+
+
+def prepare_params(user_message: ChatMessage, chat_history: List[ChatMessage], persona: Optional[Persona] = None) -> dict:
+    """Collect the people and additional rules of the persona's knowledge mentioned in the last messages of the
+    conversation for the prompt.
+
+    Only the new message is searched, the history carries the matches found when it was saved.
     """
-    Chat endpoint that processes user messages and returns AI responses.
+    snapshot = (persona or persona_registry.default).knowledge.get()
+    with stage("keyword_match"):
+        matches = [snapshot.matches_of(message) for message in chat_history[-3:] + [user_message]]
+        people, additional_rules = snapshot.collect(matches, TermCategory.PERSON)
+    logger.info(
+        "knowledge_collected",
+        people=lambda: [person.name for person in people],
+        additional_rules=lambda: [rule.index_regex for rule in additional_rules]
+    )
+    return {
+        "people": people,
+        "additional_rules": additional_rules
+    }
+
+
+def resolve_persona(request: ChatRequest) -> Persona:
+    """The persona named by the request. Raises a 422 error for an unknown persona."""
+    try:
+        return persona_registry.get(request.persona_id)
+    except KeyError:
+        raise HTTPException(status_code=422, detail=f"Unknown persona_id: {request.persona_id}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the knowledge files of every persona before the first request and pick up their edits without a restart
+    await asyncio.to_thread(persona_registry.load_knowledge)
+    persona_registry.start()
+    # Import the provider client and connect so the first request doesn't pay for it
+    await warm_up()
+    conversation_writer.start()
+    yield
+    persona_registry.stop()
+    # Drain queued history records before the worker exits
+    await asyncio.to_thread(conversation_writer.close)
+    history_store.close()
+    request_deduplicator.store.close()
+
+
+app = FastAPI(title="Pino Anxiousroid API", version="0.1", lifespan=lifespan)
+
+
+async def process_chat(request: ChatRequest) -> ChatResponse:
+    """Answer one chat request, or return the response to an earlier delivery of its request_id.
+    Failures are returned as a provider_error response instead of raised."""
+    async with request_deduplicator.claim(request.get_idempotency_key(), ChatResponse) as claim:
+        if claim.replayed:
+            logger.info("chat_replayed", request_id=request.request_id, user_id=request.get_user_id())
+        else:
+            claim.response = await answer_chat(request)
+        return claim.response
+
+
+async def answer_chat(request: ChatRequest) -> ChatResponse:
+    """Answer one chat request. Failures are returned as a provider_error response instead of raised.
+
+    A request that isn't answered by Claude within CHAT_DEADLINE_MS, or while Claude keeps failing, gets a
+    fallback reply. One that finds too many requests waiting for Claude gets a busy response right away.
     """
     # Generate request_id if not provided
     request_id = request.request_id or str(uuid.uuid4())
+    deadline = asyncio.get_running_loop().time() + CHAT_DEADLINE_MS / 1000
+    persona = resolve_persona(request)
     
     try:
         # Extract required fields
         user_message = request.get_message_text()
         user_id = request.get_user_id()
         platform = request.get_platform()
-        logger.info(f"received message from user {user_id} on platform {platform}: {user_message}(request_id: {request_id})")
-
-        # Load conversation history for this user
-        chat_history = load_conversation_history(user_id)
-        logger.info(f"got chat history: {chat_history}(request_id: {request_id})")
-        
-        # Prepare parameters for Claude
-        if len(chat_history) > 0:
-            query = "".join([chat.content for chat in chat_history[-3:]]) + user_message
-        else:
-            query = user_message
-        logger.info(f"got query for searching people: {query}(request_id: {request_id})")
-        people = search_terminology(query, TermCategory.PERSON)
-        logger.info(f"searched people: {people}(request_id: {request_id})")
-        query = query + "".join([person.description for person in people])
-        logger.info(f"got query for searching additional rules: {query}(request_id: {request_id})")
-        additional_rules = search_additional_rules(query)
-        logger.info(f"searched additional rules: {additional_rules}(request_id: {request_id})")
-        params = {
-            "people": people,
-            "additional_rules": additional_rules
-        }
-
-        # Call Claude API through existing generate_response function with history
-        reply, usage = generate_response(user_message, chat_history=chat_history, params=params)
-        logger.info(f"generated reply: {reply}(request_id: {request_id})")
-        logger.info(f"claude usage: {usage}(request_id: {request_id})")
-
-        reply = reply.strip()
-
-        reply = truncate_text(reply, MAX_RESPONSE_LENGTH) or truncate_text(reply, MAX_RESPONSE_LENGTH*2, 1) or reply
-
-        # Save the incoming user message
-        save_conversation_message(user_id, platform, "user", user_message)
-        logger.info(f"saved user message from user {user_id} on platform {platform}: {user_message}(request_id: {request_id})")
-        # Save the assistant response
-        save_conversation_message(user_id, platform, "assistant", reply)
-        logger.info(f"saved assistant message for user {user_id} on platform {platform}: {reply}(request_id: {request_id})")
+        bind(request_id=request_id, user_id=user_id, persona_id=persona.persona_id)
+        logger.info("chat_received", endpoint="chat", platform=platform, chars=len(user_message))
+        logger.debug("chat_text", text=user_message)
+        # Each persona keeps its own conversation with the user
+        history_key = persona.history_key(user_id)
+
+        # The user's previous turn is saved before this one reads the history
+        async with user_turn(history_key, deadline):
+            async with asyncio.timeout_at(deadline):
+                # Load conversation history for this user
+                with stage("history_load"):
+                    chat_history = await asyncio.to_thread(load_conversation_history, history_key)
+                logger.info("history_loaded", messages=len(chat_history), chars=lambda: sum(len(message.content) for message in chat_history))
+
+                # Prepare parameters for Claude
+                user_chat = ChatMessage(role=ChatRole.USER, content=user_message)
+                params = prepare_params(user_chat, chat_history, persona)
+
+                # Built outside the provider slot, so its failures don't count against the provider
+                claude_request = ClaudeRequest(user_message, chat_history=chat_history, params=params, persona=persona)
+
+                # Call Claude API without blocking the event loop
+                async with provider_gateway.slot(deadline):
+                    reply, usage = await claude_request.send_async()
+            logger.info("reply_generated", chars=len(reply), usage=usage.model_dump)
+
+            with stage("truncation"):
+                reply = reply.strip()
+
+                reply = truncate_text(reply, MAX_RESPONSE_LENGTH) or truncate_text(reply, MAX_RESPONSE_LENGTH*2, 1) or reply
+
+            # Save the incoming user message and the assistant response as one turn
+            with stage("persist"):
+                await asyncio.to_thread(save_conversation_messages, history_key, platform, [user_chat, ChatMessage(role=ChatRole.AI, content=reply)], persona)
+            logger.info("turn_saved", reply_chars=len(reply))
+            logger.debug("reply_text", text=reply)
         
         # Return successful response
+        inc("chat_responses_total", endpoint="chat", status="ok")
         return ChatResponse(
             request_id=request_id,
             status="ok",
             messages=[reply],
             fallback_used=False
         )
+
+    except ProviderBusy:
+        logger.warning("chat_rejected", reason="busy")
+        return busy_response(request_id, "chat")
+
+    except CircuitOpen:
+        logger.warning("fallback_sent", reason="circuit_open")
+        return fallback_response(request_id, "chat", "circuit_open", persona)
+
+    except TimeoutError:
+        logger.warning("fallback_sent", reason="deadline")
+        return fallback_response(request_id, "chat", "deadline", persona)
         
     except Exception as e:
         # Return error response
+        logger.exception("chat_failed")
+        inc("chat_responses_total", endpoint="chat", status="provider_error")
         return ChatResponse(
             request_id=request_id,
             status="provider_error",
@@ -239,6 +471,190 @@ async def chat_endpoint(request: ChatRequest):
         )
 
 
+@app.post("/api/chat/v0.1", response_model=ChatResponse)
+async def chat_endpoint(request: ChatRequest, response: Response):
+    """
+    Chat endpoint that processes user messages and returns AI responses.
+    Responds with 429 and status busy when too many requests are waiting for Claude.
+    The duration of each stage is returned in the Server-Timing header when metrics are enabled.
+    Responds with 422 when persona_id names no loaded persona.
+    """
+    resolve_persona(request)
+    timings = start_timings()
+    with stage("total"):
+        chat_response = await process_chat(request)
+    if timings is not None:
+        response.headers["Server-Timing"] = server_timing_header(timings)
+    if chat_response.status == "busy":
+        response.status_code = 429
+        response.headers["Retry-After"] = "1"
+    return chat_response
+
+
+@app.post("/api/chat/batch", response_model=ChatBatchResponse)
+async def chat_batch_endpoint(batch: ChatBatchRequest):
+    """
+    Answer many chat requests at once, at most CHAT_BATCH_CONCURRENCY at a time.
+    Requests of the same user are answered one after another in request order, so each sees the
+    previous reply in its history. That history is served from the history cache after the first load,
+    together with the keyword matches of its messages. Requests of a user to different personas are separate
+    conversations. Responds with 422 when a persona_id names no loaded persona.
+    """
+    semaphore = asyncio.Semaphore(CHAT_BATCH_CONCURRENCY)
+    responses: List[Optional[ChatResponse]] = [None] * len(batch.requests)
+
+    user_indices: dict[tuple[str, Optional[str]], List[int]] = {}
+    for i, request in enumerate(batch.requests):
+        user_indices.setdefault((resolve_persona(request).persona_id, request.get_user_id()), []).append(i)
+
+    async def process_user(indices: List[int]):
+        for i in indices:
+            async with semaphore:
+                responses[i] = await process_chat(batch.requests[i])
+
+    await asyncio.gather(*(process_user(indices) for indices in user_indices.values()))
+    return ChatBatchResponse(responses=responses)
+
+
+@app.post("/api/chat/v0.1/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    """
+    Streaming variant of the chat endpoint. Returns NDJSON lines: `{"type": "delta", "text": ...}` for each
+    piece of the reply as soon as it is final, then `{"type": "done", ...}` with the fields of ChatResponse.
+    Generation stops as soon as the reply reaches the response length limit.
+    A retried request_id gets the reply of its first delivery. Responds with 429 before streaming when too many
+    requests are waiting for Claude, and with 422 when persona_id names no loaded persona.
+    """
+    # Generate request_id if not provided
+    request_id = request.request_id or str(uuid.uuid4())
+    persona = resolve_persona(request)
+
+    # Rejected before the stream starts so the client gets the status code
+    if provider_gateway.busy():
+        logger.warning("chat_rejected", request_id=request_id, user_id=request.get_user_id(), reason="busy")
+        return JSONResponse(busy_response(request_id, "stream").model_dump(), status_code=429, headers={"Retry-After": "1"})
+
+    def ndjson(event: dict) -> bytes:
+        return codec.dumps_lines([event])
+
+    async def events():
+        async with request_deduplicator.claim(request.get_idempotency_key(), ChatResponse) as claim:
+            if claim.replayed:
+                # The reply of an earlier delivery is sent again as a single delta
+                logger.info("chat_replayed", request_id=request_id, user_id=request.get_user_id())
+                for text in claim.response.messages:
+                    yield ndjson({"type": "delta", "text": text})
+                yield ndjson({"type": "done", **claim.response.model_dump()})
+                return
+
+            deadline = asyncio.get_running_loop().time() + CHAT_DEADLINE_MS / 1000
+            sent = False
+            try:
+                # Extract required fields
+                user_message = request.get_message_text()
+                user_id = request.get_user_id()
+                platform = request.get_platform()
+                bind(request_id=request_id, user_id=user_id, persona_id=persona.persona_id)
+                logger.info("chat_received", endpoint="stream", platform=platform, chars=len(user_message))
+                logger.debug("chat_text", text=user_message)
+                # Each persona keeps its own conversation with the user
+                history_key = persona.history_key(user_id)
+
+                # The user's previous turn is saved before this one reads the history
+                async with user_turn(history_key, deadline):
+                    async with asyncio.timeout_at(deadline):
+                        # Load conversation history for this user
+                        with stage("history_load"):
+                            chat_history = await asyncio.to_thread(load_conversation_history, history_key)
+                        logger.info("history_loaded", messages=len(chat_history), chars=lambda: sum(len(message.content) for message in chat_history))
+
+                        # Prepare parameters for Claude
+                        user_chat = ChatMessage(role=ChatRole.USER, content=user_message)
+                        params = prepare_params(user_chat, chat_history, persona)
+
+                    # Forward the reply while it is generated and stop the provider once it is complete.
+                    # The deadline is applied per read, a timeout can't span the yields to the client.
+                    response_stream = generate_response_stream(user_message, chat_history=chat_history, params=params, persona=persona)
+                    truncator = StreamingTruncator(MAX_RESPONSE_LENGTH, stop_text=RESPONSE_POSTFIX)
+                    try:
+                        async with provider_gateway.slot(deadline):
+                            async with aclosing(response_stream.text_stream()) as texts:
+                                while not truncator.done:
+                                    async with asyncio.timeout_at(deadline):
+                                        text = await anext(texts, None)
+                                    if text is None:
+                                        break
+                                    chunk = truncator.feed(text)
+                                    if chunk:
+                                        sent = True
+                                        yield ndjson({"type": "delta", "text": chunk})
+                    except TimeoutError:
+                        if not sent:
+                            raise
+                        # The client already has the beginning of the reply, which becomes the whole reply
+                        logger.warning("reply_cut", reason="deadline")
+                    chunk = truncator.finish()
+                    if chunk:
+                        yield ndjson({"type": "delta", "text": chunk})
+                    reply = truncator.text
+                    logger.info("reply_generated", chars=len(reply), usage=response_stream.usage.model_dump)
+
+                    # Save the incoming user message and the final truncated reply as one turn
+                    with stage("persist"):
+                        await asyncio.to_thread(save_conversation_messages, history_key, platform, [user_chat, ChatMessage(role=ChatRole.AI, content=reply)], persona)
+                    logger.info("turn_saved", reply_chars=len(reply))
+                    logger.debug("reply_text", text=reply)
+
+                inc("chat_responses_total", endpoint="stream", status="ok")
+                response = ChatResponse(
+                    request_id=request_id,
+                    status="ok",
+                    messages=[reply],
+                    fallback_used=False
+                )
+
+            except ProviderBusy:
+                logger.warning("chat_rejected", reason="busy")
+                response = busy_response(request_id, "stream")
+
+            except CircuitOpen:
+                logger.warning("fallback_sent", reason="circuit_open")
+                response = fallback_response(request_id, "stream", "circuit_open", persona)
+
+            except TimeoutError:
+                logger.warning("fallback_sent", reason="deadline")
+                response = fallback_response(request_id, "stream", "deadline", persona)
+
+            except Exception as e:
+                logger.exception("chat_failed")
+                inc("chat_responses_total", endpoint="stream", status="provider_error")
+                response = ChatResponse(
+                    request_id=request_id,
+                    status="provider_error",
+                    messages=[],
+                    fallback_used=False,
+                    error=ErrorInfo(
+                        code="runtime_error",
+                        message=str(e)
+                    )
+                )
+
+            claim.response = response
+            if response.fallback_used:
+                yield ndjson({"type": "delta", "text": response.messages[0]})
+            yield ndjson({"type": "done", **response.model_dump()})
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Stage duration histograms, token usage and cache counters in the Prometheus text format"""
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
@@ -0,0 +1,26 @@
+"""Validate the knowledge files and compile their search indices into one file loaded at start.
+
+Run from the repository root after editing the knowledge files, e.g. as a deployment build step:
+    PYTHONPATH=$(pwd)/app python app/build_knowledge.py
+Exits with an error when a file is invalid. The servers load the JSON files instead while the compiled
+file is missing or older than them, so an outdated file is slower but never wrong.
+"""
+import argparse
+import time
+
+from constants import TERMINOLOGY_FILE_PATH, ADDITIONAL_RULES_FILE_PATH, KNOWLEDGE_COMPILED_PATH
+from utils.knowledge import compile_knowledge
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--terminology", default=TERMINOLOGY_FILE_PATH)
+    parser.add_argument("--additional-rules", default=ADDITIONAL_RULES_FILE_PATH)
+    parser.add_argument("--output", default=KNOWLEDGE_COMPILED_PATH)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    snapshot = compile_knowledge(args.terminology, args.additional_rules, args.output)
+    print(f"compiled {len(snapshot.terminology)} terms and {len(snapshot.additional_rules)} additional rules into {args.output} in {time.perf_counter() - start:.2f}s")
+
+if __name__ == "__main__":
+    main()
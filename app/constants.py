@@ -4,34 +4,56 @@ load_dotenv(find_dotenv())
 
 import logging
 
+# Checked when the first Claude client is created, so tools that don't call Claude run without it
 CLAUDE_API_KEY = os.getenv("CLAUDE_API_KEY", "")
-if CLAUDE_API_KEY == "":
-    raise ValueError("CLAUDE_API_KEY is not set")
 
 HASHED_ACCESS_TOKENS = os.getenv("HASHED_ACCESS_TOKENS").split(",") if os.getenv("HASHED_ACCESS_TOKENS") else []
 HASHED_INDEFINITE_ACCESS_TOKENS = os.getenv("HASHED_INDEFINITE_ACCESS_TOKENS").split(",") if os.getenv("HASHED_INDEFINITE_ACCESS_TOKENS") else []
 IS_CLOSED = os.getenv("IS_CLOSED", "false").lower() == "true"
 
 LOG_LEVEL = logging.getLevelNamesMapping()[os.getenv("LOG_LEVEL", "INFO")]
+# json, one object per line, or text
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
 
 TITLE = "ぴの不安ロイド"
 
 TERMINOLOGY_FILE_PATH = "data/terminology.json"
 ADDITIONAL_RULES_FILE_PATH = "data/additional_rules.json"
+# Built from the knowledge files by app/build_knowledge.py, they are loaded directly when it is missing or outdated
+KNOWLEDGE_COMPILED_PATH = os.getenv("KNOWLEDGE_COMPILED_PATH", "data/knowledge.compiled")
+# How often the knowledge files are checked for edits, 0 disables reloading
+KNOWLEDGE_RELOAD_INTERVAL_SEC = float(os.getenv("KNOWLEDGE_RELOAD_INTERVAL_SEC", "2"))
 
 USER_NAME = "あなた"
 ASSISTANT_NAME = "ぴの"
 
+# Persona made of the prompts and knowledge files of this module, answers requests that don't name one
+DEFAULT_PERSONA_ID = "pino"
+# One JSON file per additional persona, named after it
+PERSONAS_DIR = os.getenv("PERSONAS_DIR", "data/personas")
+
 MAX_CHAT_LOG_LENGTH = 10
+# Input tokens of a request, the newest history that fits next to the prompts is sent
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# Older messages are clipped to this many tokens
+CONTEXT_MAX_MESSAGE_TOKENS = int(os.getenv("CONTEXT_MAX_MESSAGE_TOKENS", "300"))
 MAX_RESPONSE_LENGTH = 80
 
 CLAUDE_MODEL = "claude-3-7-sonnet-20250219"
 MAX_TOKENS = 100
 TEMPERATURE = 0.8
 
+CLAUDE_MAX_CONNECTIONS = int(os.getenv("CLAUDE_MAX_CONNECTIONS", "100"))
+CLAUDE_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("CLAUDE_MAX_KEEPALIVE_CONNECTIONS", "20"))
+
 MAX_RESPONSE_LENGTH = 100
 
-SYSTEM_PROMPT_TEMPLATE = """You are an angel named ぴの. Users will be confused if you don't respond in the character of ぴの.
+PROMPT_CACHE_MAX_SIZE = 256
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+# The persona is identical for every request, so it goes first and is cached by the provider
+STATIC_SYSTEM_PROMPT = """You are an angel named ぴの. Users will be confused if you don't respond in the character of ぴの.
 
 Your profile:
 - description: You came to the human world from the heavenly world to deal with ぺこら様 and ぽぽろん, who were having fun with demons, as traitors to the heavenly world, but was unable to return to the heavenly world because your 天使の輪 was chipped by ぽぽろん's surprise shaman suplex. In order to live in safety until your 天使の輪 is regenerated, you become the caretaker of the アパート where 花園さん, 邪神ちゃん and the others live. 
@@ -43,20 +65,6 @@ Your profile:
 - appearance: You have pink hair in a drill twin tail and wear a white-based Lolita-style outfit, and have huge breasts.
 - likes: You are good at making sweets and have won the grand prize in the 天界お菓子作りコンテスト.
 
-Here are people you know:
-<people>
-{{#people}}
-<person name="{{name}}" />
-{{description}}
-<attributes>
-{{#attributes}}
-{{name}}: {{value}}
-{{/attributes}}
-</attributes> 
-<person />
-{{/people}}
-</people>
-
 Response to user with the following example:
 <response-example>
 ぴのと申します。これからよろしくお願いしますわ。
@@ -78,11 +86,6 @@ Response to user with the following example:
 
 Important rules for the interaction:
  - Always stay in character as an angel, ぴの.
-{{#additional_rules}}
-{{#rules}}
- - {{.}}
-{{/rules}}
-{{/additional_rules}}
  - You end your sentences with "ですわ" or "ますわ".
  - To stabilise your mind, you often take pills or injections into your knees.
  - You, with your black-hearted nature, have want to dispose of your 'Lord', rule the heavens and become Queen of the whole world.
@@ -95,6 +98,35 @@ Important rules for the interaction:
 
 Respond to the user in 80 characters in Japanese within <response></response> tags."""
 
+# Rendered per request with the people and additional rules matched by the conversation
+DYNAMIC_SYSTEM_PROMPT_TEMPLATE = """Here are people you know:
+<people>
+{{#people}}
+<person name="{{name}}" />
+{{description}}
+<attributes>
+{{#attributes}}
+{{name}}: {{value}}
+{{/attributes}}
+</attributes> 
+<person />
+{{/people}}
+</people>
+
+Additional rules for the interaction:
+{{#additional_rules}}
+{{#rules}}
+ - {{.}}
+{{/rules}}
+{{/additional_rules}}"""
+
 ASSISTANT_PROMPT_TEMPLATE = """[an angel, ぴの]<response>"""
 
 RESPONSE_POSTFIX = "</response>"
+
+# Replies in character when Claude can't answer in time or is failing, instead of an error
+FALLBACK_MESSAGES = [
+    "うふふふ…少し考えごとをしていましたわ。もう一度おっしゃってくださいな。",
+    "不安ですわ…今はうまくお返事できませんの。少し待ってからまた話しかけてくださいませ。",
+    "ちょうどお膝にお注射をしていたところですわ。もう一度お願いしますわ。",
+]
@@ -1,18 +1,41 @@
 import streamlit as st
 import uuid
 import hashlib
+from contextlib import closing
+from typing import Iterator
 
-from utils import generate_response
-from utils import search_terminology
-from utils import search_additional_rules
+from utils import generate_response_stream
 from utils import ChatMessage, ChatRole, TermCategory
-from utils import truncate_text
-from constants import USER_NAME, ASSISTANT_NAME, MAX_CHAT_LOG_LENGTH, TITLE, LOG_LEVEL,  HASHED_ACCESS_TOKENS, IS_CLOSED, HASHED_INDEFINITE_ACCESS_TOKENS, MAX_RESPONSE_LENGTH
+from utils import StreamingTruncator
+from utils import knowledge_store
+from utils.log import EventLogger, bind, setup_logging
+from constants import USER_NAME, ASSISTANT_NAME, MAX_CHAT_LOG_LENGTH, TITLE, LOG_LEVEL, LOG_FORMAT, HASHED_ACCESS_TOKENS, IS_CLOSED, HASHED_INDEFINITE_ACCESS_TOKENS, MAX_RESPONSE_LENGTH, RESPONSE_POSTFIX
 
-from streamlit.logger import get_logger
+setup_logging(LOG_LEVEL, LOG_FORMAT)
+logger = EventLogger(__name__)
+
+
+@st.cache_resource(show_spinner=False)
+def load_knowledge():
+    """Build the term and rule indices once per process, shared by every session instead of paid by the first message.
+    Edits of the knowledge files are picked up in the background."""
+    knowledge_store.get()
+    knowledge_store.start()
+
+
+def truncate_stream(texts: Iterator[str], truncator: StreamingTruncator) -> Iterator[str]:
+    """Yield the final parts of the reply as they arrive, closing the provider stream once the reply is complete."""
+    with closing(texts):
+        for text in texts:
+            chunk = truncator.feed(text)
+            if chunk:
+                yield chunk
+            if truncator.done:
+                break
+    chunk = truncator.finish()
+    if chunk:
+        yield chunk
 
-logger = get_logger(__name__)
-logger.setLevel(LOG_LEVEL)
 
 access_token = st.query_params.get("token",None)
 hashed_user_access_token = hashlib.sha256(access_token.encode()).hexdigest() if access_token is not None else None
@@ -28,6 +51,8 @@ if hashed_user_access_token is None or hashed_user_access_token not in HASHED_AC
 
 st.title(TITLE)
 
+load_knowledge()
+
 
 # チャットログを保存したセッション情報を初期化
 if "chat_history" not in st.session_state:
@@ -39,7 +64,9 @@ session_id = st.session_state.session_id
 
 user_message = st.chat_input("メッセージを入力")
 if user_message:
-    logger.info(f"received message: {user_message}(session_id: {session_id})")
+    bind(session_id=session_id)
+    logger.info("chat_received", chars=len(user_message))
+    logger.debug("chat_text", text=user_message)
     for chat in st.session_state.chat_history:
         with st.chat_message(USER_NAME if chat.role == ChatRole.USER else ASSISTANT_NAME):
             st.write(chat.content)
@@ -48,28 +75,24 @@ if user_message:
         st.write(user_message)
 
     chat_history = st.session_state.chat_history[-MAX_CHAT_LOG_LENGTH:]
-    logger.info(f"got chat history: {chat_history}(session_id: {session_id})")
-    
-    if len(chat_history) > 0:
-        query = "".join([chat.content for chat in chat_history[-3:]]) + user_message
-    else:
-        query = user_message
-    logger.info(f"got query for searching people: {query}(session_id: {session_id})")
-    people = search_terminology(query, TermCategory.PERSON)
-    logger.info(f"searched people: {people}(session_id: {session_id})")
-    query = query + "".join([person.description for person in people])
-    logger.info(f"got query for searching additional rules: {query}(session_id: {session_id})")
-    additional_rules = search_additional_rules(query)
-    logger.info(f"searched additional rules: {additional_rules}(session_id: {session_id})")
-
-    response, claude_usage = generate_response(user_message, chat_history=chat_history, params={"people": people, "additional_rules": additional_rules})
-    logger.info(f"generated response: {response}(session_id: {session_id})")
-    logger.info(f"claude usage: {claude_usage}(session_id: {session_id})")
+    logger.info("history_loaded", messages=len(chat_history), chars=lambda: sum(len(chat.content) for chat in chat_history))
     
-    ai_message = truncate_text(response, MAX_RESPONSE_LENGTH) or truncate_text(response, MAX_RESPONSE_LENGTH*2, 1) or response
+    user_chat = ChatMessage(role=ChatRole.USER, content=user_message)
+    snapshot = knowledge_store.get()
+    people, additional_rules = snapshot.collect([snapshot.matches_of(chat) for chat in chat_history[-3:] + [user_chat]], TermCategory.PERSON)
+    logger.info(
+        "knowledge_collected",
+        people=lambda: [person.name for person in people],
+        additional_rules=lambda: [rule.index_regex for rule in additional_rules]
+    )
+
+    response_stream = generate_response_stream(user_message, chat_history=chat_history, params={"people": people, "additional_rules": additional_rules})
+    truncator = StreamingTruncator(MAX_RESPONSE_LENGTH, stop_text=RESPONSE_POSTFIX)
     with st.chat_message(ASSISTANT_NAME):
-        st.write(ai_message)
-        logger.info(f"sent message: {ai_message}(session_id: {session_id})")
+        st.write_stream(truncate_stream(response_stream.text_stream_sync(), truncator))
+        ai_message = truncator.text
+        logger.debug("reply_text", text=ai_message)
+    logger.info("reply_generated", chars=len(ai_message), usage=response_stream.usage.model_dump)
     
-    st.session_state.chat_history.append(ChatMessage(role=ChatRole.USER, content=user_message))
+    st.session_state.chat_history.append(user_chat)
     st.session_state.chat_history.append(ChatMessage(role=ChatRole.AI, content=ai_message))
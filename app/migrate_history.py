@@ -0,0 +1,84 @@
+"""Bulk-import JSONL conversation history files and their archives into the SQLite history store.
+
+Run from the repository root before switching CONV_HISTORY_BACKEND to sqlite:
+    PYTHONPATH=$(pwd)/app python app/migrate_history.py --db data/conversations/history.sqlite3
+"""
+import argparse
+import gzip
+import json
+import re
+import sys
+from pathlib import Path
+from typing import Iterator
+
+from utils.history_store import SqliteHistoryStore
+
+# Files archived in the same second get a sequence number
+ARCHIVE_FILE_PATTERN = re.compile(r"^(?P<user_id>.+)_(?P<timestamp>\d{8}_\d{6})(?:_(?P<seq>\d+))?\.jsonl(\.gz)?$")
+BATCH_SIZE = 10000
+
+def read_records(file_path: Path) -> Iterator[dict]:
+    opener = gzip.open if file_path.suffix == ".gz" else open
+    with opener(file_path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def collect_user_files(conversations_dir: Path, archive_dir: Path) -> dict[str, list[tuple[Path, bool]]]:
+    """Map each user to their history files, oldest archive first and the active file last. Files of the
+    archive folder that aren't named like archives are reported and left out."""
+    user_files: dict[str, list[tuple[tuple, Path, bool]]] = {}
+    if archive_dir.exists():
+        for file_path in archive_dir.iterdir():
+            m = ARCHIVE_FILE_PATTERN.match(file_path.name)
+            if m:
+                order = (0, m.group("timestamp"), int(m.group("seq") or 0))
+                user_files.setdefault(m.group("user_id"), []).append((order, file_path, True))
+            else:
+                print(f"warning: {file_path} is not named like an archive, not imported", file=sys.stderr)
+    for file_path in conversations_dir.glob("*.jsonl"):
+        user_files.setdefault(file_path.stem, []).append(((1, "", 0), file_path, False))
+    return {user_id: [(file_path, archived) for _, file_path, archived in sorted(files)] for user_id, files in user_files.items()}
+
+def migrate_user(store: SqliteHistoryStore, files: list[tuple[Path, bool]]) -> int:
+    """Import one user's files. Lines carried over into the next file on rotation are imported once."""
+    imported = 0
+    previous_keys: set[int] = set()
+    for file_path, archived in files:
+        keys: set[int] = set()
+        batch = []
+        for record in read_records(file_path):
+            key = hash((record["timestamp"], record["role"], record["text"]))
+            keys.add(key)
+            if key in previous_keys:
+                continue
+            batch.append(record)
+            if len(batch) >= BATCH_SIZE:
+                store.import_records(batch, archived=archived)
+                imported += len(batch)
+                batch = []
+        store.import_records(batch, archived=archived)
+        imported += len(batch)
+        previous_keys = keys
+    return imported
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", default="data/conversations", help="folder of the {user_id}.jsonl files")
+    parser.add_argument("--archive", default="data/conversations/archive", help="folder of the archived files")
+    parser.add_argument("--db", default="data/conversations/history.sqlite3", help="SQLite database to import into")
+    args = parser.parse_args()
+
+    store = SqliteHistoryStore(db_path=args.db, max_bytes=0, carry_over=0, max_cached_sizes=0)
+    try:
+        for user_id, files in sorted(collect_user_files(Path(args.conversations), Path(args.archive)).items()):
+            if store.has_user(user_id):
+                print(f"skipped {user_id}: already in {args.db}")
+                continue
+            print(f"imported {user_id}: {migrate_user(store, files)} messages from {len(files)} files")
+    finally:
+        store.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,10 @@
-from .claude import generate_response
-from .models import ChatMessage, ChatRole, ClaudeOptions, ClaudeUsage, TermCategory, Term
-from .normalization import truncate_text
+from .claude import generate_response, generate_response_async, generate_response_stream
+from .models import ChatMessage, ChatRole, ClaudeOptions, ClaudeUsage, KeywordMatches, TermCategory, Term
+from .normalization import truncate_text, StreamingTruncator
+from .prompt import render_prompts, clear_prompt_cache, prompt_cache_stats
 from .terminology import search_terminology
 from .additional_rules import search_additional_rules
+from .knowledge import knowledge_store
+from .persona import Persona, persona_registry
 
-__all__ = ["generate_response", "ChatMessage", "ChatRole", "ClaudeOptions", "ClaudeUsage", "truncate_text",  "TermCategory", "Term", "search_terminology", "search_additional_rules"]
\ No newline at end of file
+__all__ = ["generate_response", "generate_response_async", "generate_response_stream", "ChatMessage", "ChatRole", "ClaudeOptions", "ClaudeUsage", "KeywordMatches", "truncate_text", "StreamingTruncator", "render_prompts", "clear_prompt_cache", "prompt_cache_stats",  "TermCategory", "Term", "search_terminology", "search_additional_rules", "knowledge_store", "Persona", "persona_registry"]
\ No newline at end of file
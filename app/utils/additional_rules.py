@@ -1,22 +1,5 @@
-import re
-import json
-
 from .models import AditionalRule
-from constants import ADDITIONAL_RULES_FILE_PATH
-
-additional_rules: list[AditionalRule] = []
+from .knowledge import knowledge_store
 
 def search_additional_rules(query:str) -> list[AditionalRule]:
-    global additional_rules
-    if not additional_rules:
-        __init__()
-
-    results = [v for v in additional_rules if re.search(v.index_regex, query)]
-    return results
-
-def __init__():
-    global additional_rules
-    
-    file = open(ADDITIONAL_RULES_FILE_PATH, "r", encoding='utf-8')
-    data = json.load(file)
-    additional_rules = [AditionalRule(**rule) for rule in data]                                   
\ No newline at end of file
+    return knowledge_store.get().additional_rules_index.search(query)
@@ -1,89 +1,276 @@
-from http import client
+import logging
+import threading
 import time
-from typing import Optional
-
-import anthropic
-import pystache
+from typing import AsyncIterator, Iterator, Optional
 
 from constants import (
-    CLAUDE_API_KEY, MAX_TOKENS, TEMPERATURE,
-    SYSTEM_PROMPT_TEMPLATE, ASSISTANT_PROMPT_TEMPLATE, RESPONSE_POSTFIX, CLAUDE_MODEL
+    CLAUDE_API_KEY, MAX_TOKENS, TEMPERATURE, RESPONSE_POSTFIX, CLAUDE_MODEL,
+    CLAUDE_MAX_CONNECTIONS, CLAUDE_MAX_KEEPALIVE_CONNECTIONS
 )
-from .models import ClaudeOptions, ClaudeUsage, ChatRole, ChatMessage
+from .models import ClaudeOptions, ClaudeUsage, ChatMessage
+from .persona import Persona, persona_registry
+from .prompt import render_prompts
+from .context import assemble_context, token_estimator
+from .metrics import inc, record_stage, stage
+
+logger = logging.getLogger(__name__)
+
+# Created on first use, so importing this module stays fast and works without an API key
+_client = None
+_async_client = None
+_async_http_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                import anthropic
+                _client = anthropic.Anthropic(api_key=_api_key())
+    return _client
+
+def get_async_client():
+    """The client shared by every request of the API server, so provider connections are pooled and kept alive."""
+    global _async_client, _async_http_client
+    if _async_client is None:
+        with _client_lock:
+            if _async_client is None:
+                import anthropic
+                import httpx
+                _async_http_client = httpx.AsyncClient(
+                    limits=httpx.Limits(
+                        max_connections=CLAUDE_MAX_CONNECTIONS,
+                        max_keepalive_connections=CLAUDE_MAX_KEEPALIVE_CONNECTIONS
+                    ),
+                    timeout=httpx.Timeout(600.0, connect=5.0)
+                )
+                _async_client = anthropic.AsyncAnthropic(api_key=_api_key(), http_client=_async_http_client)
+    return _async_client
+
+def _api_key() -> str:
+    if CLAUDE_API_KEY == "":
+        raise ValueError("CLAUDE_API_KEY is not set")
+    return CLAUDE_API_KEY
+
+async def warm_up():
+    """Create the async client and open a pooled connection to the provider ahead of the first request.
+
+    Raises when the API key is missing, a provider that can't be reached is only logged.
+    """
+    async_client = get_async_client()
+    try:
+        # Any response leaves a kept-alive connection in the pool, the status doesn't matter
+        await _async_http_client.head(str(async_client.base_url), timeout=5.0)
+    except Exception:
+        logger.warning("failed to connect to the provider during warm-up", exc_info=True)
+
+def _build_messages(user_prompt: str, chat_history: list[ChatMessage], assistant_prompt: Optional[str]) -> list[dict]:
+    # Text content is sent as a plain string. History messages build their payload once and reuse it in later turns
+    messages = [chat.payload() for chat in chat_history]
+    messages.append({"role": "user", "content": user_prompt})
+    if assistant_prompt:
+        messages.append({"role": "assistant", "content": assistant_prompt})
+    return messages
+
+def _build_system(static_system_prompt: str, dynamic_system_prompt: str) -> list[dict]:
+    # The static persona is the cached prefix, the matched people and rules follow it uncached
+    return [
+        {
+            "type": "text",
+            "text": static_system_prompt,
+            "cache_control": {"type": "ephemeral"}
+        },
+        {
+            "type": "text",
+            "text": dynamic_system_prompt
+        }
+    ]
+
+def _build_usage(usage, start_datetime: float, base_tokens: float = 0) -> ClaudeUsage:
+    end_datetime = time.time()
+    claude_usage = ClaudeUsage(
+        input_tokens=usage.input_tokens,
+        output_tokens=usage.output_tokens,
+        cache_creation_input_tokens=getattr(usage, "cache_creation_input_tokens", None) or 0,
+        cache_read_input_tokens=getattr(usage, "cache_read_input_tokens", None) or 0,
+        elapsed_time_ms=int((end_datetime - start_datetime) * 1000)
+    )
+    for field in ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens"):
+        inc(f"claude_{field}_total", getattr(claude_usage, field))
+    # Cached input tokens are counted separately, the estimate covers all of them
+    token_estimator.observe(base_tokens, claude_usage.input_tokens + claude_usage.cache_creation_input_tokens + claude_usage.cache_read_input_tokens)
+    return claude_usage
 
-client = anthropic.Anthropic(api_key=CLAUDE_API_KEY)
+def _parse_response(response, start_datetime: float, base_tokens: float = 0) -> tuple[str, ClaudeUsage]:
+    response_text = response.content[0].text
+    response_usage = _build_usage(response.usage, start_datetime, base_tokens)
+    
+    return response_text, response_usage
 
 def _call_claude_api(
-    system_prompt: str, user_prompt: str,
+    static_system_prompt: str, system_prompt: str, user_prompt: str,
     options: ClaudeOptions,
     chat_history: list[ChatMessage] = [],
-    assistant_prompt: Optional[str] = None
+    assistant_prompt: Optional[str] = None,
+    base_tokens: float = 0
 ) -> tuple[str, ClaudeUsage]:
 
     start_datetime = time.time()
     
-    messages = []
-    for chat in chat_history:
-        messages.append({
-            "role": "user" if chat.role == ChatRole.USER else "assistant",
-            "content": [
-                {
-                    "type": "text",
-                    "text": chat.content
-                }
-            ]
-        })
-    messages.append({
-        "role": "user",
-        "content": [
-            {
-                "type": "text",
-                "text": user_prompt
-            }
-        ]
-    })
-    if assistant_prompt:
-        messages.append({
-            "role": "assistant",
-            "content": [
-                {
-                    "type": "text",
-                    "text": assistant_prompt
-                }
-            ]
-        })
+    messages = _build_messages(user_prompt, chat_history, assistant_prompt)
     
-    response = client.messages.create(
-        model=options.model,
-        max_tokens=options.max_tokens,
-        temperature=options.temperature,
-        system=system_prompt,
-        messages=messages
-    )
-    end_datetime = time.time()
+    with stage("provider"):
+        response = get_client().messages.create(
+            model=options.model,
+            max_tokens=options.max_tokens,
+            temperature=options.temperature,
+            system=_build_system(static_system_prompt, system_prompt),
+            messages=messages
+        )
+    return _parse_response(response, start_datetime, base_tokens)
+
+async def _call_claude_api_async(
+    static_system_prompt: str, system_prompt: str, user_prompt: str,
+    options: ClaudeOptions,
+    chat_history: list[ChatMessage] = [],
+    assistant_prompt: Optional[str] = None,
+    base_tokens: float = 0
+) -> tuple[str, ClaudeUsage]:
+
+    start_datetime = time.time()
     
-    response_text = response.content[0].text
-    response_usage = ClaudeUsage(
-        input_tokens=response.usage.input_tokens,
-        output_tokens=response.usage.output_tokens,
-        elapsed_time_ms=int((end_datetime - start_datetime) * 1000)
-    )
+    messages = _build_messages(user_prompt, chat_history, assistant_prompt)
     
-    return response_text, response_usage
+    with stage("provider"):
+        response = await get_async_client().messages.create(
+            model=options.model,
+            max_tokens=options.max_tokens,
+            temperature=options.temperature,
+            system=_build_system(static_system_prompt, system_prompt),
+            messages=messages
+        )
+    return _parse_response(response, start_datetime, base_tokens)
+
+def _prepare_request(query: str, chat_history: list[ChatMessage], params: dict, persona: Persona) -> tuple[ClaudeOptions, str, str, list[ChatMessage], float]:
+    """Render the prompts of the persona and pick the history that fits the input token budget next to them.
 
-def generate_response(query: str, chat_history: list[ChatMessage] = [], params: dict = {}) -> tuple[str, ClaudeUsage]:
+    Also returns the base token estimate of the request, to calibrate the estimator with the reported usage.
+    """
     options = ClaudeOptions(
         max_tokens=MAX_TOKENS,
         temperature=TEMPERATURE,
         model=CLAUDE_MODEL
     ) 
-    system_prompt = pystache.render(SYSTEM_PROMPT_TEMPLATE, params)
-    assistant_prompt = pystache.render(ASSISTANT_PROMPT_TEMPLATE, params)
-    response_text, response_usage = _call_claude_api(
-        system_prompt=system_prompt,
-        user_prompt=query,
-        options=options,
-        chat_history=chat_history,
-        assistant_prompt=assistant_prompt
-    )
-    return response_text.rstrip(RESPONSE_POSTFIX), response_usage
\ No newline at end of file
+    with stage("prompt_render"):
+        system_prompt, assistant_prompt = render_prompts(params, persona.dynamic_template, persona.assistant_template)
+    with stage("context"):
+        chat_history, base_tokens = assemble_context([persona.system_prompt, system_prompt, query, assistant_prompt or ""], chat_history)
+    return options, system_prompt, assistant_prompt, chat_history, base_tokens
+
+class ClaudeRequest:
+    """A request to Claude with its prompts rendered and its history picked.
+
+    Built before a provider slot is taken, so only the provider call of `send` or `send_async` counts as a
+    provider success or failure, not a bad template or history.
+    """
+
+    def __init__(self, query: str, chat_history: list[ChatMessage] = [], params: dict = {}, persona: Optional[Persona] = None):
+        persona = persona or persona_registry.default
+        self.query = query
+        self.static_system_prompt = persona.system_prompt
+        self.options, self.system_prompt, self.assistant_prompt, self.chat_history, self.base_tokens = _prepare_request(query, chat_history, params, persona)
+
+    def send(self) -> tuple[str, ClaudeUsage]:
+        response_text, response_usage = _call_claude_api(
+            static_system_prompt=self.static_system_prompt,
+            system_prompt=self.system_prompt,
+            user_prompt=self.query,
+            options=self.options,
+            chat_history=self.chat_history,
+            assistant_prompt=self.assistant_prompt,
+            base_tokens=self.base_tokens
+        )
+        return response_text.rstrip(RESPONSE_POSTFIX), response_usage
+
+    async def send_async(self) -> tuple[str, ClaudeUsage]:
+        """Same as `send` but awaits the provider call so the event loop stays free."""
+        response_text, response_usage = await _call_claude_api_async(
+            static_system_prompt=self.static_system_prompt,
+            system_prompt=self.system_prompt,
+            user_prompt=self.query,
+            options=self.options,
+            chat_history=self.chat_history,
+            assistant_prompt=self.assistant_prompt,
+            base_tokens=self.base_tokens
+        )
+        return response_text.rstrip(RESPONSE_POSTFIX), response_usage
+
+def generate_response(query: str, chat_history: list[ChatMessage] = [], params: dict = {}, persona: Optional[Persona] = None) -> tuple[str, ClaudeUsage]:
+    """Answer as `persona`, the default persona when omitted."""
+    return ClaudeRequest(query, chat_history=chat_history, params=params, persona=persona).send()
+
+async def generate_response_async(query: str, chat_history: list[ChatMessage] = [], params: dict = {}, persona: Optional[Persona] = None) -> tuple[str, ClaudeUsage]:
+    """Same as `generate_response` but awaits the provider call so the event loop stays free."""
+    return await ClaudeRequest(query, chat_history=chat_history, params=params, persona=persona).send_async()
+
+class ClaudeResponseStream:
+    """Streamed response of Claude. Closing `text_stream` early stops the generation on the provider side.
+
+    `usage` covers the tokens generated until the stream ended or was closed.
+    """
+
+    def __init__(self, query: str, chat_history: list[ChatMessage] = [], params: dict = {}, persona: Optional[Persona] = None):
+        persona = persona or persona_registry.default
+        self.static_system_prompt = persona.system_prompt
+        self.options, self.system_prompt, assistant_prompt, chat_history, self.base_tokens = _prepare_request(query, chat_history, params, persona)
+        self.messages = _build_messages(query, chat_history, assistant_prompt)
+        self.usage = ClaudeUsage(input_tokens=0, output_tokens=0, elapsed_time_ms=0)
+
+    async def text_stream(self) -> AsyncIterator[str]:
+        start_datetime = time.time()
+        async with get_async_client().messages.stream(
+            model=self.options.model,
+            max_tokens=self.options.max_tokens,
+            temperature=self.options.temperature,
+            system=_build_system(self.static_system_prompt, self.system_prompt),
+            messages=self.messages
+        ) as stream:
+            try:
+                async for event in stream:
+                    if event.type == "content_block_delta" and event.delta.type == "text_delta":
+                        yield event.delta.text
+            finally:
+                record_stage("provider", time.time() - start_datetime)
+                try:
+                    self.usage = _build_usage(stream.current_message_snapshot.usage, start_datetime, self.base_tokens)
+                except (AssertionError, AttributeError):
+                    # The stream was closed before the message started
+                    pass
+
+    def text_stream_sync(self) -> Iterator[str]:
+        """Same as `text_stream` but on the synchronous client, for the Streamlit app."""
+        start_datetime = time.time()
+        with get_client().messages.stream(
+            model=self.options.model,
+            max_tokens=self.options.max_tokens,
+            temperature=self.options.temperature,
+            system=_build_system(self.static_system_prompt, self.system_prompt),
+            messages=self.messages
+        ) as stream:
+            try:
+                for event in stream:
+                    if event.type == "content_block_delta" and event.delta.type == "text_delta":
+                        yield event.delta.text
+            finally:
+                record_stage("provider", time.time() - start_datetime)
+                try:
+                    self.usage = _build_usage(stream.current_message_snapshot.usage, start_datetime, self.base_tokens)
+                except (AssertionError, AttributeError):
+                    # The stream was closed before the message started
+                    pass
+
+def generate_response_stream(query: str, chat_history: list[ChatMessage] = [], params: dict = {}, persona: Optional[Persona] = None) -> ClaudeResponseStream:
+    """Same as `generate_response` but streams the raw response text, including RESPONSE_POSTFIX."""
+    return ClaudeResponseStream(query, chat_history=chat_history, params=params, persona=persona)
+
@@ -0,0 +1,20 @@
+"""JSON encoding of the history records and the streamed events, with orjson.
+
+Output is compact UTF-8, as `json.dumps(..., ensure_ascii=False)` without the spaces, so files written before
+are read the same.
+"""
+from typing import Any, Iterable
+
+import orjson
+
+JSONDecodeError = orjson.JSONDecodeError
+
+def dumps(obj: Any) -> bytes:
+    return orjson.dumps(obj)
+
+def dumps_lines(objs: Iterable[Any]) -> bytes:
+    """One JSON line per object, for JSONL files and NDJSON streams."""
+    return b"".join(orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE) for obj in objs)
+
+def loads(data: bytes | str) -> Any:
+    return orjson.loads(data)
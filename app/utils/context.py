@@ -0,0 +1,108 @@
+import math
+
+from constants import CONTEXT_TOKEN_BUDGET, CONTEXT_MAX_MESSAGE_TOKENS
+from .metrics import inc, register_collector
+from .models import ChatMessage, ChatRole
+
+# Rough tokens the messages API adds around each message
+MESSAGE_OVERHEAD_TOKENS = 4
+CLIP_MARKER = "…"
+
+class TokenEstimator:
+    """Fast local estimate of input tokens, calibrated on the input tokens reported by the provider.
+
+    The base estimate counts ASCII text at about four characters per token and other text, mostly Japanese,
+    at about one character per token. `observe` moves a correction factor towards the ratio of reported
+    to estimated tokens of each request.
+    """
+
+    def __init__(self, ascii_chars_per_token: float = 4.0, other_chars_per_token: float = 1.0, smoothing: float = 0.2):
+        self.ascii_chars_per_token = ascii_chars_per_token
+        self.other_chars_per_token = other_chars_per_token
+        self.smoothing = smoothing
+        self.scale = 1.0
+
+    def base(self, text: str) -> float:
+        """Uncalibrated estimate, the unit `observe` is calibrated in."""
+        chars = len(text)
+        if text.isascii():
+            return chars / self.ascii_chars_per_token
+        # Japanese takes 3 bytes in UTF-8, so this counts it exactly and other scripts roughly
+        other = min(chars, (len(text.encode('utf-8')) - chars) / 2)
+        return (chars - other) / self.ascii_chars_per_token + other / self.other_chars_per_token
+
+    def estimate(self, text: str) -> int:
+        return math.ceil(self.base(text) * self.scale)
+
+    def observe(self, base_tokens: float, input_tokens: int):
+        """Calibrate with the base estimate of a whole request and the input tokens the provider counted for it."""
+        if base_tokens <= 0 or input_tokens <= 0:
+            return
+        ratio = min(max(input_tokens / base_tokens, 0.25), 4.0)
+        self.scale += self.smoothing * (ratio - self.scale)
+
+token_estimator = TokenEstimator()
+
+register_collector(lambda: [("token_estimator_scale", "gauge", token_estimator.scale)])
+
+def clip_text(text: str, max_tokens: int, estimator: TokenEstimator = token_estimator) -> str:
+    """Keep the beginning of text that fits max_tokens, marking the cut with CLIP_MARKER."""
+    tokens = estimator.estimate(text)
+    if tokens <= max_tokens:
+        return text
+    length = int(len(text) * max_tokens / tokens)
+    while length > 0 and estimator.estimate(text[:length] + CLIP_MARKER) > max_tokens:
+        length -= max(1, length // 10)
+    return text[:max(length, 0)] + CLIP_MARKER
+
+def _alternate(chat_history: list[ChatMessage]) -> list[ChatMessage]:
+    """Merge consecutive messages of the same role and drop a trailing user message, which has no reply,
+    so the history alternates and ends with the assistant before the next user message."""
+    merged: list[ChatMessage] = []
+    for message in chat_history:
+        if merged and merged[-1].role == message.role:
+            merged[-1] = ChatMessage(role=message.role, content=merged[-1].content + "\n" + message.content)
+        else:
+            merged.append(message)
+    if merged and merged[-1].role == ChatRole.USER:
+        merged.pop()
+    return merged
+
+def assemble_context(
+    prompts: list[str], chat_history: list[ChatMessage],
+    budget: int = CONTEXT_TOKEN_BUDGET, max_message_tokens: int = CONTEXT_MAX_MESSAGE_TOKENS,
+    estimator: TokenEstimator = token_estimator
+) -> tuple[list[ChatMessage], float]:
+    """Pick the newest messages of chat_history that fit the input token budget next to the prompts.
+
+    `prompts` are the texts sent with every request: the system prompt, the user message and the assistant
+    prompt. Older messages longer than `max_message_tokens` are clipped, messages that no longer fit the
+    budget are dropped, and the picked history starts with a user message and alternates roles as the
+    messages API expects. Returns the history and the base estimate of the whole request for calibration.
+    """
+    history = _alternate(chat_history)
+    fixed_base = sum(estimator.base(prompt) for prompt in prompts) + 2 * MESSAGE_OVERHEAD_TOKENS
+    remaining = budget - math.ceil(fixed_base * estimator.scale)
+
+    picked: list[ChatMessage] = []
+    for message in reversed(history):
+        content = clip_text(message.content, max_message_tokens, estimator)
+        tokens = estimator.estimate(content) + MESSAGE_OVERHEAD_TOKENS
+        if tokens > remaining:
+            break
+        picked.append(message if content is message.content else ChatMessage(role=message.role, content=content))
+        remaining -= tokens
+    picked.reverse()
+
+    # The history has to start with a user message
+    while picked and picked[0].role != ChatRole.USER:
+        picked.pop(0)
+
+    history_base = sum(estimator.base(message.content) + MESSAGE_OVERHEAD_TOKENS for message in picked)
+    sent_tokens = sum(estimator.estimate(message.content) + MESSAGE_OVERHEAD_TOKENS for message in picked)
+    loaded_tokens = sum(estimator.estimate(message.content) + MESSAGE_OVERHEAD_TOKENS for message in history)
+    inc("context_history_messages_total", len(picked))
+    inc("context_history_messages_dropped_total", len(history) - len(picked))
+    inc("context_history_tokens_total", sent_tokens)
+    inc("context_history_tokens_saved_total", loaded_tokens - sent_tokens)
+    return picked, fixed_base + history_base
@@ -0,0 +1,130 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from .metrics import inc
+
+class ProviderUnavailable(Exception):
+    pass
+
+class ProviderBusy(ProviderUnavailable):
+    """All provider slots are taken and the wait queue is full."""
+
+class CircuitOpen(ProviderUnavailable):
+    """The provider failed repeatedly, calls are not attempted until the breaker probes it again."""
+
+class CircuitBreaker:
+    """Fails calls fast after `failure_threshold` failures in a row, for `reset_timeout` seconds.
+
+    Then a single call is let through as a probe (half-open): its success closes the breaker, its
+    failure opens it for another `reset_timeout`. Used from the event loop only, so it takes no lock.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def before_call(self) -> bool:
+        """Raise CircuitOpen unless the call may go ahead. Returns whether the call is the probe."""
+        if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+        if self.state == self.CLOSED:
+            return False
+        if self.state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        raise CircuitOpen("provider circuit is open")
+
+    def on_success(self, probe: bool):
+        if probe:
+            self._probing = False
+        self.failures = 0
+        self.state = self.CLOSED
+
+    def on_failure(self, probe: bool):
+        if probe:
+            self._probing = False
+        self.failures += 1
+        if probe or self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+            inc("provider_circuit_opened_total")
+
+    def on_abandon(self, probe: bool):
+        """The call ended before reaching the provider, e.g. it ran out of time waiting for a slot."""
+        if probe:
+            self._probing = False
+
+class ProviderGateway:
+    """Admission control of provider calls: at most `max_concurrency` calls at a time, at most `max_queue`
+    waiting for a slot, and a circuit breaker in front of both."""
+
+    def __init__(self, max_concurrency: int, max_queue: int, breaker: CircuitBreaker):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.breaker = breaker
+        self.in_flight = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def busy(self) -> bool:
+        """Whether a call made now would be rejected for lack of a slot."""
+        return self._queue_full()
+
+    @asynccontextmanager
+    async def slot(self, deadline: Optional[float] = None) -> AsyncIterator[None]:
+        """Hold a provider slot for the block. Waiting for the slot ends with TimeoutError at `deadline`,
+        in event loop time. Exceptions of the block count as provider failures, except GeneratorExit
+        of a stream closed by its client; a cancelled block is a call that ran out of time."""
+        if self._queue_full():
+            inc("provider_rejections_total", reason="busy")
+            raise ProviderBusy("provider queue is full")
+        try:
+            probe = self.breaker.before_call()
+        except CircuitOpen:
+            inc("provider_rejections_total", reason="circuit_open")
+            raise
+
+        self.waiting += 1
+        try:
+            async with asyncio.timeout_at(deadline):
+                await self._semaphore.acquire()
+        except BaseException:
+            self.breaker.on_abandon(probe)
+            raise
+        finally:
+            self.waiting -= 1
+
+        self.in_flight += 1
+        try:
+            yield
+        except (Exception, asyncio.CancelledError):
+            self.breaker.on_failure(probe)
+            raise
+        except BaseException:
+            self.breaker.on_abandon(probe)
+            raise
+        else:
+            self.breaker.on_success(probe)
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "circuit_open": self.breaker.state != CircuitBreaker.CLOSED,
+        }
+
+    def _queue_full(self) -> bool:
+        return self.in_flight >= self.max_concurrency and self.waiting >= self.max_queue
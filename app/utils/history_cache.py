@@ -0,0 +1,99 @@
+import threading
+from collections import OrderedDict, deque
+from typing import Optional
+
+from .models import ChatMessage
+
+# Rough per-message cost of the ChatMessage object and deque slot on top of its text
+MESSAGE_OVERHEAD_BYTES = 200
+# Rough per-user cost of the OrderedDict entry and the deque itself
+USER_OVERHEAD_BYTES = 700
+USER_LOCK_STRIPES = 64
+
+def _message_size(message: ChatMessage) -> int:
+    return len(message.content.encode('utf-8')) + MESSAGE_OVERHEAD_BYTES
+
+class HistoryCache:
+    """Bounded in-process cache of the latest chat messages per user.
+
+    Each user holds a ring buffer of at most `capacity` messages. Users are evicted in LRU order
+    once either `max_users` or the estimated `max_bytes` is exceeded. The cache never writes files,
+    callers append to it when the message is handed to the history writer. Callers hold `user_lock`
+    around flushing the writer and reading the file followed by `put`, and around queueing a write
+    followed by `append`, so a slow read can never overwrite messages saved in the meantime.
+    """
+
+    def __init__(self, capacity: int, max_users: int, max_bytes: int):
+        self.capacity = capacity
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[str, deque[ChatMessage]] = OrderedDict()
+        self._sizes: dict[str, int] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._user_locks = [threading.Lock() for _ in range(USER_LOCK_STRIPES)]
+
+    def user_lock(self, user_id: str) -> threading.Lock:
+        return self._user_locks[hash(user_id) % USER_LOCK_STRIPES]
+
+    def get(self, user_id: str) -> Optional[list[ChatMessage]]:
+        with self._lock:
+            messages = self._entries.get(user_id)
+            if messages is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(user_id)
+            return list(messages)
+
+    def put(self, user_id: str, messages: list[ChatMessage]):
+        with self._lock:
+            self._remove(user_id)
+            ring = deque(messages[-self.capacity:] if self.capacity > 0 else [], maxlen=self.capacity)
+            self._entries[user_id] = ring
+            self._sizes[user_id] = USER_OVERHEAD_BYTES + sum(_message_size(message) for message in ring)
+            self._bytes += self._sizes[user_id]
+            self._evict()
+
+    def append(self, user_id: str, message: ChatMessage):
+        """Append a persisted message, ignored when the user is not cached since the next load reads the file."""
+        with self._lock:
+            ring = self._entries.get(user_id)
+            if ring is None or self.capacity <= 0:
+                return
+            delta = _message_size(message)
+            if len(ring) == ring.maxlen:
+                delta -= _message_size(ring[0])
+            ring.append(message)
+            self._sizes[user_id] += delta
+            self._bytes += delta
+            self._entries.move_to_end(user_id)
+            self._evict()
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._remove(user_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "users": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _remove(self, user_id: str):
+        if user_id in self._entries:
+            del self._entries[user_id]
+            self._bytes -= self._sizes.pop(user_id)
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_users or self._bytes > self.max_bytes):
+            user_id, _ = self._entries.popitem(last=False)
+            self._bytes -= self._sizes.pop(user_id)
+            self.evictions += 1
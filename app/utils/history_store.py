@@ -0,0 +1,361 @@
+import gzip
+import logging
+import os
+import queue
+import shutil
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+from . import codec
+from .models import ChatMessage, ChatRole, KeywordMatches
+
+logger = logging.getLogger(__name__)
+
+def _to_chat_message(role: str, text: str, matches: Optional[dict] = None) -> ChatMessage:
+    return ChatMessage(
+        role=ChatRole.USER if role == 'user' else ChatRole.AI,
+        content=text,
+        matches=KeywordMatches(**matches) if matches else None
+    )
+
+class HistoryStore(ABC):
+    """Persistent conversation history of every user.
+
+    Records are dicts with `user_id`, `platform`, `timestamp`, `role` and `text`, as in the JSONL history files,
+    and optionally the `matches` of the message against the knowledge files.
+    `append` and `archive` are called while the user's lock is held, by the history writer or, with several
+    workers, by the request threads of different users at once.
+    """
+
+    def __init__(self, max_bytes: int, carry_over: int, max_cached_sizes: int):
+        self.max_bytes = max_bytes
+        self.carry_over = carry_over
+        self.max_cached_sizes = max_cached_sizes
+        # Stored byte size of each user's active history, counted on write so archiving needs no lookup.
+        # Shared by the threads writing different users
+        self._sizes: dict[str, int] = {}
+        self._sizes_lock = threading.Lock()
+
+    @abstractmethod
+    def load_last(self, user_id: str, count: int) -> list[ChatMessage]:
+        """Load the last `count` active messages of a user, oldest first."""
+
+    @abstractmethod
+    def append(self, user_id: str, records: list[dict]):
+        """Append records of a user, archiving older messages first when the size limit is reached."""
+
+    @abstractmethod
+    def archive(self, user_id: str):
+        """Archive all but the last `carry_over` messages of a user if they exceed `max_bytes`."""
+
+    def close(self):
+        pass
+
+    def invalidate(self, user_id: str):
+        """Forget what is cached about a user, after another process may have written their history."""
+        with self._sizes_lock:
+            self._sizes.pop(user_id, None)
+
+    def _cached_size(self, user_id: str, load: Callable[[], int]) -> int:
+        with self._sizes_lock:
+            size = self._sizes.get(user_id)
+        if size is None:
+            size = load()
+            self._set_size(user_id, size)
+        return size
+
+    def _set_size(self, user_id: str, size: int):
+        with self._sizes_lock:
+            if user_id not in self._sizes and len(self._sizes) >= self.max_cached_sizes:
+                self._sizes.pop(next(iter(self._sizes), None), None)
+            self._sizes[user_id] = size
+
+def _fsync_dir(path: Path):
+    """Make renames and new files in a directory durable."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def read_last_lines(file_path: str, count: int, block_size: int = 8192) -> list[bytes]:
+    """Read the last `count` non-empty lines of a file by seeking backwards from its end in fixed-size blocks.
+    Lines are returned undecoded, the JSON decoder reads UTF-8 bytes directly."""
+    if count <= 0:
+        return []
+
+    with open(file_path, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        buffer = b""
+        lines: list[bytes] = []
+        while position > 0:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            buffer = f.read(read_size) + buffer
+            # The first line may be cut off by the block boundary until the start of the file is reached
+            lines = [line for line in buffer.split(b"\n")[0 if position == 0 else 1:] if line.strip()]
+            if len(lines) >= count:
+                break
+
+    return lines[-count:]
+
+class JsonlHistoryStore(HistoryStore):
+    """One JSONL file per user, rotated into gzip archives once it exceeds `max_bytes`."""
+
+    def __init__(self, path_template: str, archive_folder: str, max_bytes: int, carry_over: int,
+                 max_cached_sizes: int, fsync: bool = False, compression_level: int = 6):
+        super().__init__(max_bytes=max_bytes, carry_over=carry_over, max_cached_sizes=max_cached_sizes)
+        self.path_template = path_template
+        self.archive_folder = archive_folder
+        self.fsync = fsync
+        self.compression_level = compression_level
+        # Rotated conversation files waiting to be compressed by the archive worker
+        self.archive_queue: "queue.Queue[Path]" = queue.Queue()
+        threading.Thread(target=self._archive_worker, name="conversation-archiver", daemon=True).start()
+
+    def get_file_path(self, user_id: str) -> str:
+        """Get the conversation file path for a user."""
+        p = Path(os.path.expandvars(os.path.expanduser(self.path_template.format(user_id=user_id))))
+        return str(p)
+
+    def load_last(self, user_id: str, count: int) -> list[ChatMessage]:
+        file_path = self.get_file_path(user_id)
+
+        if not Path(file_path).exists():
+            return []
+
+        try:
+            messages = []
+            # Only the last count lines are read and decoded
+            for line in read_last_lines(file_path, count):
+                try:
+                    data = codec.loads(line)
+                except codec.JSONDecodeError:
+                    # Cut off by a crash during a write, the rest of the history is still valid
+                    logger.warning(f"skipped a damaged line in conversation file {file_path}")
+                    continue
+                messages.append(_to_chat_message(data['role'], data['text'], data.get('matches')))
+
+            return messages
+
+        except Exception:
+            # If loading fails, return empty history to avoid breaking the chat
+            return []
+
+    def append(self, user_id: str, records: list[dict]):
+        file_path = self.get_file_path(user_id)
+        data = codec.dumps_lines(records)
+
+        # Archive if file is too large before adding new messages
+        self.archive(user_id)
+
+        # Ensure directory exists
+        Path(file_path).parent.mkdir(parents=True, exist_ok=True)
+
+        with open(file_path, 'a+b') as f:
+            size = f.seek(0, os.SEEK_END)
+            if size > 0:
+                f.seek(size - 1)
+                if f.read(1) != b"\n":
+                    # The last write was cut off by a crash, its line is ended so the new ones stay readable
+                    data = b"\n" + data
+            f.write(data)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        self._set_size(user_id, size + len(data))
+
+    def archive(self, user_id: str):
+        """Rotate the user's file into the archive folder if it exceeds the size limit.
+
+        The file is linked into the archive folder, then atomically replaced by a new file carrying over its
+        last `carry_over` lines, so a crash at any point leaves a complete active file, and the write that
+        crosses the limit only pays for a link, a rename and a small write. Compression runs in the archive worker.
+        """
+        file_path = self.get_file_path(user_id)
+        try:
+            if self._file_size(user_id, file_path) < self.max_bytes:
+                return
+            if not Path(file_path).exists():
+                self.invalidate(user_id)
+                return
+
+            # Create archive directory
+            archive_dir = Path(self.archive_folder)
+            archive_dir.mkdir(parents=True, exist_ok=True)
+
+            # Generate archive filename with timestamp
+            timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+            archive_filename = f"{user_id}_{timestamp}.jsonl"
+            archive_path = archive_dir / archive_filename
+            suffix = 0
+            # A file archived in the same second is kept
+            while archive_path.exists() or archive_path.with_name(archive_path.name + ".gz").exists():
+                suffix += 1
+                archive_path = archive_dir / f"{user_id}_{timestamp}_{suffix}.jsonl"
+
+            # Prepare the new file with the tail of the old one
+            carry_over = b"".join(line + b"\n" for line in read_last_lines(file_path, self.carry_over))
+            tmp_path = file_path + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(carry_over)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            # The old file stays active until it is archived under its new name
+            try:
+                os.link(file_path, archive_path)
+            except OSError:
+                # The archive folder is on another device
+                shutil.copyfile(file_path, archive_path)
+            os.replace(tmp_path, file_path)
+            if self.fsync:
+                _fsync_dir(Path(file_path).parent)
+            self._set_size(user_id, len(carry_over))
+
+            self.archive_queue.put(archive_path)
+
+        except Exception:
+            # If archiving fails, keep appending to the current file to avoid breaking the chat
+            logger.exception(f"failed to archive conversation file {file_path}")
+
+    def compress_archive_file(self, raw_path: Path):
+        """Stream a rotated conversation file into a gzip archive and remove the uncompressed copy."""
+        gz_path = raw_path.with_name(raw_path.name + ".gz")
+        tmp_path = gz_path.with_name(gz_path.name + ".tmp")
+        with open(raw_path, 'rb') as src, gzip.open(tmp_path, 'wb', compresslevel=self.compression_level) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(tmp_path, gz_path)
+        raw_path.unlink()
+
+    def _archive_worker(self):
+        """Compress rotated conversation files in the background, off the request path."""
+        while True:
+            raw_path = self.archive_queue.get()
+            try:
+                self.compress_archive_file(raw_path)
+                logger.info(f"archived conversation file {raw_path}")
+            except Exception:
+                # The uncompressed rotated file is kept in the archive folder
+                logger.exception(f"failed to compress archived conversation file {raw_path}")
+            finally:
+                self.archive_queue.task_done()
+
+    def _file_size(self, user_id: str, file_path: str) -> int:
+        return self._cached_size(user_id, lambda: Path(file_path).stat().st_size if Path(file_path).exists() else 0)
+
+class SqliteHistoryStore(HistoryStore):
+    """All users in one SQLite database in WAL mode.
+
+    Archiving flags older messages instead of moving them, so archived history stays queryable
+    across users and time through the `(user_id, timestamp)` index.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            platform TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            role TEXT NOT NULL,
+            text TEXT NOT NULL,
+            archived INTEGER NOT NULL DEFAULT 0,
+            matches TEXT
+        );
+        CREATE INDEX IF NOT EXISTS messages_user_id_timestamp ON messages (user_id, timestamp);
+    """
+    LOAD_LAST = "SELECT role, text, matches FROM messages WHERE user_id = ? AND archived = 0 ORDER BY timestamp DESC, id DESC LIMIT ?"
+    INSERT = "INSERT INTO messages (user_id, platform, timestamp, role, text, archived, matches) VALUES (?, ?, ?, ?, ?, ?, ?)"
+    ACTIVE_SIZE = "SELECT COALESCE(SUM(LENGTH(CAST(text AS BLOB))), 0) FROM messages WHERE user_id = ? AND archived = 0"
+    ARCHIVE = """
+        UPDATE messages SET archived = 1
+        WHERE user_id = ? AND archived = 0 AND id NOT IN (
+            SELECT id FROM messages WHERE user_id = ? AND archived = 0 ORDER BY timestamp DESC, id DESC LIMIT ?
+        )
+    """
+    HAS_USER = "SELECT 1 FROM messages WHERE user_id = ? LIMIT 1"
+
+    def __init__(self, db_path: str, max_bytes: int, carry_over: int, max_cached_sizes: int, fsync: bool = False):
+        super().__init__(max_bytes=max_bytes, carry_over=carry_over, max_cached_sizes=max_cached_sizes)
+        self.db_path = db_path
+        self.fsync = fsync
+        # Connections are per thread, WAL lets readers run while the writer thread commits
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        connection = self._connection()
+        connection.executescript(self.SCHEMA)
+        # Databases created before keyword matches were stored
+        if "matches" not in [column[1] for column in connection.execute("PRAGMA table_info(messages)")]:
+            connection.execute("ALTER TABLE messages ADD COLUMN matches TEXT")
+
+    def load_last(self, user_id: str, count: int) -> list[ChatMessage]:
+        if count <= 0:
+            return []
+        try:
+            rows = self._connection().execute(self.LOAD_LAST, (user_id, count)).fetchall()
+            return [_to_chat_message(role, text, codec.loads(matches) if matches else None) for role, text, matches in reversed(rows)]
+        except Exception:
+            # If loading fails, return empty history to avoid breaking the chat
+            logger.exception(f"failed to load conversation history of user {user_id}")
+            return []
+
+    def append(self, user_id: str, records: list[dict]):
+        self.archive(user_id)
+        size = self._active_size(user_id)
+        self.import_records(records)
+        self._set_size(user_id, size + sum(len(record["text"].encode('utf-8')) for record in records))
+
+    def archive(self, user_id: str):
+        try:
+            if self._active_size(user_id) < self.max_bytes:
+                return
+            connection = self._connection()
+            with connection:
+                connection.execute(self.ARCHIVE, (user_id, user_id, self.carry_over))
+            self.invalidate(user_id)
+        except Exception:
+            # If archiving fails, keep appending to avoid breaking the chat
+            logger.exception(f"failed to archive conversation history of user {user_id}")
+
+    def import_records(self, records: Iterable[dict], archived: bool = False):
+        """Insert records in a single transaction."""
+        connection = self._connection()
+        with connection:
+            connection.executemany(self.INSERT, (
+                (
+                    record["user_id"], record["platform"], record["timestamp"], record["role"], record["text"], int(archived),
+                    codec.dumps(record["matches"]).decode('utf-8') if record.get("matches") else None
+                )
+                for record in records
+            ))
+
+    def has_user(self, user_id: str) -> bool:
+        return self._connection().execute(self.HAS_USER, (user_id,)).fetchone() is not None
+
+    def close(self):
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    def _active_size(self, user_id: str) -> int:
+        return self._cached_size(user_id, lambda: self._connection().execute(self.ACTIVE_SIZE, (user_id,)).fetchone()[0])
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(f"PRAGMA synchronous={'FULL' if self.fsync else 'NORMAL'}")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
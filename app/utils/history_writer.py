@@ -0,0 +1,71 @@
+import threading
+import time
+from typing import Callable, Optional
+
+class ConversationWriter:
+    """Write-behind appender that group-commits history records of many users.
+
+    `append` only queues the history records. A background thread wakes up once records are pending,
+    waits `flush_interval` seconds to collect more, then hands each user's records to `write` as a
+    single batch. Records are queued and written while holding the user's lock from `user_lock`,
+    so the records of concurrent requests for the same user are never interleaved.
+    `write` is expected to handle its own errors since it runs on the background thread.
+    """
+
+    def __init__(self, write: Callable[[str, list[dict]], None], user_lock: Callable[[str], threading.Lock], flush_interval: float):
+        self.write = write
+        self.user_lock = user_lock
+        self.flush_interval = flush_interval
+        self._pending: dict[str, list[dict]] = {}
+        self._lock = threading.Lock()
+        self._has_pending = threading.Event()
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._closed = False
+                self._thread = threading.Thread(target=self._run, name="conversation-writer", daemon=True)
+                self._thread.start()
+
+    def append(self, user_id: str, records: list[dict]):
+        """Queue records for a user. The caller must hold the user's lock."""
+        if self._thread is None:
+            self.start()
+        with self._lock:
+            self._pending.setdefault(user_id, []).extend(records)
+        self._has_pending.set()
+
+    def flush_user(self, user_id: str):
+        """Write the queued records of one user now. The caller must hold the user's lock."""
+        with self._lock:
+            records = self._pending.pop(user_id, None)
+        if records:
+            self.write(user_id, records)
+
+    def flush(self):
+        """Write the queued records of every user."""
+        with self._lock:
+            self._has_pending.clear()
+            user_ids = list(self._pending)
+        for user_id in user_ids:
+            with self.user_lock(user_id):
+                self.flush_user(user_id)
+
+    def close(self):
+        """Stop the background thread after writing everything that is still queued."""
+        thread = self._thread
+        if thread is not None:
+            self._closed = True
+            self._has_pending.set()
+            thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._closed:
+            self._has_pending.wait()
+            if not self._closed:
+                time.sleep(self.flush_interval)
+            self.flush()
@@ -0,0 +1,219 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, Callable, Generic, Optional, TypeVar
+
+from pydantic import BaseModel
+
+from .metrics import inc
+
+logger = logging.getLogger(__name__)
+
+M = TypeVar("M", bound=BaseModel)
+
+# Results of `begin`
+DONE = "done"
+CLAIMED = "claimed"
+PENDING = "pending"
+
+class MemoryIdempotencyStore:
+    """Responses of completed requests of this process, kept for `ttl` seconds, at most `max_entries` of them."""
+
+    # Calls are cheap enough for the event loop
+    blocking = False
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # key -> (expires_at, response), oldest first
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def begin(self, key: str) -> tuple[str, Optional[dict]]:
+        now = time.monotonic()
+        with self._lock:
+            while self._entries and next(iter(self._entries.values()))[0] <= now:
+                self._entries.popitem(last=False)
+            entry = self._entries.get(key)
+        # Requests in flight in this process are joined before reaching the store
+        return (DONE, entry[1]) if entry is not None else (CLAIMED, None)
+
+    def complete(self, key: str, response: dict):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def release(self, key: str):
+        pass
+
+    def close(self):
+        pass
+
+class SqliteIdempotencyStore:
+    """Responses of completed requests shared by the workers using the same database file.
+
+    A worker claims a key with a row without response before answering. Other workers wait until the
+    response is stored, or take the key over once the claim is older than `lease` seconds, e.g. when the
+    claiming worker died. Rows expire `ttl` seconds after the response was stored.
+    """
+
+    blocking = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            response TEXT,
+            expires_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS responses_expires_at ON responses (expires_at);
+    """
+    CLAIM = """
+        INSERT INTO responses (key, response, expires_at) VALUES (?, NULL, ?)
+        ON CONFLICT (key) DO UPDATE SET response = NULL, expires_at = excluded.expires_at WHERE responses.expires_at <= ?
+    """
+    GET = "SELECT response FROM responses WHERE key = ?"
+    COMPLETE = "UPDATE responses SET response = ?, expires_at = ? WHERE key = ?"
+    RELEASE = "DELETE FROM responses WHERE key = ? AND response IS NULL"
+    EXPIRE = "DELETE FROM responses WHERE expires_at <= ?"
+
+    def __init__(self, db_path: str, ttl: float, lease: float):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.lease = lease
+        # Connections are per thread, as calls run on the default executor
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._connection().executescript(self.SCHEMA)
+
+    def begin(self, key: str) -> tuple[str, Optional[dict]]:
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            if connection.execute(self.CLAIM, (key, now + self.lease, now)).rowcount == 1:
+                return CLAIMED, None
+            row = connection.execute(self.GET, (key,)).fetchone()
+        if row is None:
+            # Released between the two statements
+            return PENDING, None
+        return (DONE, json.loads(row[0])) if row[0] is not None else (PENDING, None)
+
+    def complete(self, key: str, response: dict):
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            connection.execute(self.COMPLETE, (json.dumps(response, ensure_ascii=False), now + self.ttl, key))
+            connection.execute(self.EXPIRE, (now,))
+
+    def release(self, key: str):
+        connection = self._connection()
+        with connection:
+            connection.execute(self.RELEASE, (key,))
+
+    def close(self):
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+IdempotencyStore = MemoryIdempotencyStore | SqliteIdempotencyStore
+
+class Claim(Generic[M]):
+    """One delivery of a request. `response` is set on entering when the request was already answered,
+    the replay, otherwise the delivery answers it and sets `response` itself."""
+
+    def __init__(self, response: Optional[M] = None):
+        self.response = response
+        self.replayed = response is not None
+
+class RequestDeduplicator:
+    """Answers each request key once. A delivery of a key in flight in this process waits for its response,
+    one answered before, by this or another worker sharing the store, gets the stored response.
+
+    Only responses accepted by `keep` are stored, so deliveries after a failure answer the request again.
+    """
+
+    def __init__(self, store: IdempotencyStore, keep: Callable[[BaseModel], bool], poll_interval: float = 0.1):
+        self.store = store
+        self.keep = keep
+        self.poll_interval = poll_interval
+        self._in_flight: dict[str, asyncio.Future] = {}
+
+    @asynccontextmanager
+    async def claim(self, key: Optional[str], model: type[M]) -> AsyncIterator[Claim[M]]:
+        if key is None:
+            yield Claim()
+            return
+
+        # Deliveries of the same key in this process attach to the first one
+        while key in self._in_flight:
+            response = await asyncio.shield(self._in_flight[key])
+            if response is not None:
+                inc("idempotency_replays_total", state="in_flight")
+                yield Claim(response)
+                return
+            # The first delivery ended without a response, try to answer it here
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        claim: Claim[M] = Claim()
+        try:
+            stored = await self._begin(key)
+            if stored is not None:
+                inc("idempotency_replays_total", state="completed")
+                claim = Claim(model(**stored))
+                yield claim
+                return
+            try:
+                yield claim
+            finally:
+                try:
+                    if claim.response is not None and self.keep(claim.response):
+                        await self._call(self.store.complete, key, claim.response.model_dump())
+                    else:
+                        await self._call(self.store.release, key)
+                except Exception:
+                    # Retries of this request are answered again, the response was already given
+                    logger.exception(f"failed to store the response of request {key}")
+        finally:
+            del self._in_flight[key]
+            future.set_result(claim.response)
+
+    async def _begin(self, key: str) -> Optional[dict]:
+        while True:
+            try:
+                state, response = await self._call(self.store.begin, key)
+            except Exception:
+                # Answering a retry twice is better than not answering
+                logger.exception(f"failed to look up request {key}, answering it")
+                return None
+            if state != PENDING:
+                return response
+            # Being answered by another worker
+            await asyncio.sleep(self.poll_interval)
+
+    async def _call(self, fn, *args):
+        if self.store.blocking:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
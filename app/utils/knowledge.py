@@ -0,0 +1,316 @@
+import hashlib
+import json
+import logging
+import marshal
+import os
+import struct
+import sys
+import threading
+import time
+import weakref
+from typing import Optional
+
+from .matcher import PatternIndex
+from .metrics import inc, register_collector
+from .models import AditionalRule, ChatMessage, KeywordMatches, Term, TermAttribute, TermCategory
+from .prompt import clear_prompt_cache
+from constants import TERMINOLOGY_FILE_PATH, ADDITIONAL_RULES_FILE_PATH, KNOWLEDGE_RELOAD_INTERVAL_SEC, KNOWLEDGE_COMPILED_PATH
+
+logger = logging.getLogger(__name__)
+
+def rule_id(rule: AditionalRule) -> str:
+    """Stable id of an additional rule across reloads, derived from its index pattern."""
+    return hashlib.sha1(rule.index_regex.encode('utf-8')).hexdigest()[:12]
+
+class KnowledgeSnapshot:
+    """Terminology and additional rules of one version of the knowledge files, with their patterns compiled.
+
+    Snapshots are never modified after they are built, a reload builds a new one.
+    """
+
+    __slots__ = (
+        "version", "fingerprint", "terminology", "terminology_indices", "additional_rules", "additional_rules_index",
+        "rule_ids", "term_positions", "rule_positions", "term_rules", "file_stats", "loaded_at", "__weakref__"
+    )
+
+    def __init__(
+        self, version: int, terminology: list[Term], additional_rules: list[AditionalRule], file_stats: tuple = (),
+        compiled: Optional[dict] = None
+    ):
+        """`compiled` is the `export` of a snapshot of the same knowledge, its indices are restored instead of built."""
+        self.version = version
+        self.terminology = tuple(terminology)
+        self.additional_rules = tuple(additional_rules)
+        if compiled is None:
+            self.terminology_indices = build_terminology_indices(terminology)
+            self.additional_rules_index = PatternIndex([(rule.index_regex, rule) for rule in additional_rules])
+            # Identifies the content across processes, stored with the keyword matches of each message
+            content = json.dumps([[term.model_dump() for term in terminology], [rule.model_dump() for rule in additional_rules]], ensure_ascii=False, sort_keys=True)
+            self.fingerprint = hashlib.sha1(content.encode('utf-8')).hexdigest()[:12]
+            # Additional rules triggered by the description of each term
+            self.term_rules = tuple(tuple(self.additional_rules_index.search_indices(term.description)) for term in terminology)
+        else:
+            self.terminology_indices = {
+                category: PatternIndex.restore(
+                    [term for term in terminology if category is None or category in term.categories],
+                    compiled["terminology_indices"][category.value if category else None]
+                )
+                for category in (None, *TermCategory)
+            }
+            self.additional_rules_index = PatternIndex.restore(additional_rules, compiled["additional_rules_index"])
+            self.fingerprint = compiled["fingerprint"]
+            self.term_rules = tuple(map(tuple, compiled["term_rules"]))
+        self.rule_ids = tuple(rule_id(rule) for rule in additional_rules)
+        self.term_positions: dict[str, list[int]] = {}
+        for i, term in enumerate(terminology):
+            self.term_positions.setdefault(term.name, []).append(i)
+        self.rule_positions = {rid: i for i, rid in enumerate(self.rule_ids)}
+        # (mtime_ns, size) of each source file when it was read, to notice edits
+        self.file_stats = file_stats
+        self.loaded_at = time.time()
+
+    def share(self, version: int, file_stats: tuple) -> "KnowledgeSnapshot":
+        """A snapshot of the same knowledge for another store, sharing the terms, rules and indices of this one."""
+        snapshot = object.__new__(KnowledgeSnapshot)
+        for name in KnowledgeSnapshot.__slots__[:-1]:
+            setattr(snapshot, name, getattr(self, name))
+        snapshot.version = version
+        snapshot.file_stats = file_stats
+        snapshot.loaded_at = time.time()
+        return snapshot
+
+    def export(self) -> dict:
+        """The knowledge and its built indices as plain data, for `write_compiled`."""
+        return {
+            "terminology": [term.model_dump(mode="json") for term in self.terminology],
+            "additional_rules": [rule.model_dump(mode="json") for rule in self.additional_rules],
+            "terminology_indices": {category.value if category else None: index.export() for category, index in self.terminology_indices.items()},
+            "additional_rules_index": self.additional_rules_index.export(),
+            "fingerprint": self.fingerprint,
+            "term_rules": [list(rules) for rules in self.term_rules],
+        }
+
+    def match(self, text: str) -> KeywordMatches:
+        """Terms and additional rules mentioned in text."""
+        return KeywordMatches(
+            knowledge=self.fingerprint,
+            terms=[self.terminology[i].name for i in self.terminology_indices[None].search_indices(text)],
+            rules=[self.rule_ids[i] for i in self.additional_rules_index.search_indices(text)],
+        )
+
+    def matches_of(self, message: ChatMessage) -> KeywordMatches:
+        """Keyword matches of a message, matched once and kept on the message until the knowledge changes."""
+        if message.matches is None or message.matches.knowledge != self.fingerprint:
+            message.matches = self.match(message.content)
+        return message.matches
+
+    def collect(self, matches: list[KeywordMatches], category: TermCategory = TermCategory.PERSON) -> tuple[list[Term], list[AditionalRule]]:
+        """The terms of `category` mentioned by the messages, and the additional rules mentioned by the messages or
+        triggered by the descriptions of those terms, both in file order."""
+        term_positions = sorted({
+            i for m in matches for name in m.terms for i in self.term_positions.get(name, ())
+            if category in self.terminology[i].categories
+        })
+        rule_positions = {self.rule_positions[rid] for m in matches for rid in m.rules if rid in self.rule_positions}
+        for i in term_positions:
+            rule_positions.update(self.term_rules[i])
+        return [self.terminology[i] for i in term_positions], [self.additional_rules[i] for i in sorted(rule_positions)]
+
+def build_terminology_indices(terms: list[Term]) -> dict[TermCategory | None, PatternIndex[Term]]:
+    indices = {None: PatternIndex([(term.index_regex, term) for term in terms])}
+    for category in TermCategory:
+        indices[category] = PatternIndex([(term.index_regex, term) for term in terms if category in term.categories])
+    return indices
+
+def _file_stat(path: str) -> Optional[tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def _read_json(path: str, source: bytes) -> list:
+    data = json.loads(source)
+    if not isinstance(data, list):
+        raise ValueError(f"{path} must contain a JSON list")
+    return data
+
+def _read_sources(terminology_path: str, additional_rules_path: str) -> tuple[bytes, bytes]:
+    with open(terminology_path, "rb") as f:
+        terminology = f.read()
+    with open(additional_rules_path, "rb") as f:
+        additional_rules = f.read()
+    return terminology, additional_rules
+
+def _source_digest(sources: tuple[bytes, bytes]) -> str:
+    digest = hashlib.sha1()
+    for source in sources:
+        digest.update(struct.pack("<Q", len(source)))
+        digest.update(source)
+    return digest.hexdigest()
+
+# Snapshots in use by their source digest, so stores of files with identical contents share one
+_snapshots_by_source: weakref.WeakValueDictionary[str, KnowledgeSnapshot] = weakref.WeakValueDictionary()
+_snapshots_lock = threading.Lock()
+
+def _construct_term(data: dict) -> Term:
+    # Validated when the file was compiled, nested models are built by hand since model_construct doesn't
+    return Term.model_construct(**{
+        **data,
+        "categories": [TermCategory(category) for category in data["categories"]],
+        "attributes": [TermAttribute.model_construct(**attribute) for attribute in data["attributes"]],
+    })
+
+def _build_snapshot(paths: tuple[str, str], sources: tuple[bytes, bytes], version: int, file_stats: tuple = (), compiled: Optional[dict] = None) -> KnowledgeSnapshot:
+    if compiled is not None:
+        terminology = [_construct_term(term) for term in compiled["terminology"]]
+        additional_rules = [AditionalRule.model_construct(**rule) for rule in compiled["additional_rules"]]
+    else:
+        terminology = [Term(**term) for term in _read_json(paths[0], sources[0])]
+        additional_rules = [AditionalRule(**rule) for rule in _read_json(paths[1], sources[1])]
+    return KnowledgeSnapshot(version, terminology, additional_rules, file_stats, compiled)
+
+# Compiled snapshot file: magic, header length, marshalled header, marshalled `KnowledgeSnapshot.export()`
+COMPILED_MAGIC = b"PINOKNOW"
+# Bumped when the exported data changes shape
+COMPILED_FORMAT = 1
+
+def _compiled_header(source_digest: str) -> dict:
+    # marshal data is only guaranteed to be readable by the same Python version
+    return {"format": COMPILED_FORMAT, "python": "%d.%d" % sys.version_info[:2], "marshal": marshal.version, "source": source_digest}
+
+def compile_knowledge(terminology_path: str, additional_rules_path: str, output_path: str) -> KnowledgeSnapshot:
+    """Validate the knowledge files, build their indices and write them to `output_path` for `read_compiled`.
+    Raises like a reload does when a file is invalid."""
+    paths = (terminology_path, additional_rules_path)
+    sources = _read_sources(*paths)
+    snapshot = _build_snapshot(paths, sources, version=1)
+    header = marshal.dumps(_compiled_header(_source_digest(sources)))
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(COMPILED_MAGIC + struct.pack("<I", len(header)) + header)
+        f.write(marshal.dumps(snapshot.export()))
+    os.replace(tmp_path, output_path)
+    return snapshot
+
+def read_compiled(path: str, source_digest: str) -> Optional[dict]:
+    """The exported snapshot in the compiled file at `path` if it was compiled from the sources with
+    `source_digest` by this Python version, otherwise None."""
+    try:
+        with open(path, "rb") as f:
+            prefix = f.read(len(COMPILED_MAGIC) + 4)
+            if prefix[:len(COMPILED_MAGIC)] != COMPILED_MAGIC:
+                logger.warning(f"{path} is not a compiled knowledge file, ignoring it")
+                return None
+            (header_length,) = struct.unpack_from("<I", prefix, len(COMPILED_MAGIC))
+            # The header is checked before the rest of an outdated file is read
+            if marshal.loads(f.read(header_length)) != _compiled_header(source_digest):
+                logger.info(f"{path} was compiled from other knowledge files or by another Python version, ignoring it")
+                return None
+            return marshal.loads(f.read())
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logger.warning(f"failed to read compiled knowledge file {path}, ignoring it", exc_info=True)
+        return None
+
+class KnowledgeStore:
+    """Serves the latest good snapshot of the terminology and additional rules files.
+
+    Readers take `get()` without locking, a reload builds the next snapshot aside and swaps it in with a
+    single assignment. A file that fails to parse, validate or compile is logged and the current snapshot
+    is kept. `start` polls the files' modification times on a background thread and reloads on change.
+    The indices are restored from `compiled_path` when it was compiled from the current files, or taken from the
+    snapshot of another store whose files have the same contents.
+    """
+
+    def __init__(self, terminology_path: str, additional_rules_path: str, reload_interval: float, compiled_path: Optional[str] = None):
+        self.terminology_path = terminology_path
+        self.additional_rules_path = additional_rules_path
+        self.reload_interval = reload_interval
+        self.compiled_path = compiled_path
+        self.snapshot: Optional[KnowledgeSnapshot] = None
+        # File stats of the last failed load, so a bad file is only reported once
+        self._failed_stats: Optional[tuple] = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def get(self) -> KnowledgeSnapshot:
+        snapshot = self.snapshot
+        if snapshot is None:
+            with self._lock:
+                if self.snapshot is None:
+                    # Nothing to fall back to, so a bad file fails the first search
+                    self.snapshot = self._load(version=1)
+                    clear_prompt_cache()
+            snapshot = self.snapshot
+        return snapshot
+
+    def reload(self, force: bool = False) -> bool:
+        """Load the files again if they changed since the current snapshot. Returns whether a new snapshot was swapped in."""
+        with self._lock:
+            current = self.snapshot
+            file_stats = self._file_stats()
+            if current is not None and not force and file_stats in (current.file_stats, self._failed_stats):
+                return False
+            try:
+                snapshot = self._load(version=current.version + 1 if current else 1)
+            except Exception:
+                inc("knowledge_reload_failures_total")
+                if current is None:
+                    raise
+                self._failed_stats = file_stats
+                logger.exception(f"failed to reload knowledge files, keeping version {current.version}")
+                return False
+            self.snapshot = snapshot
+            self._failed_stats = None
+        clear_prompt_cache()
+        logger.info(f"loaded knowledge version {snapshot.version}: {len(snapshot.terminology)} terms, {len(snapshot.additional_rules)} additional rules")
+        return True
+
+    def start(self):
+        """Watch the files for changes in the background. Does nothing when the reload interval is 0."""
+        with self._lock:
+            if self._thread is not None or self.reload_interval <= 0:
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._watch, name="knowledge-watcher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        thread = self._thread
+        if thread is not None:
+            self._stopped.set()
+            thread.join()
+            self._thread = None
+
+    def _file_stats(self) -> tuple:
+        return (_file_stat(self.terminology_path), _file_stat(self.additional_rules_path))
+
+    def _load(self, version: int) -> KnowledgeSnapshot:
+        # Stats are taken first, so an edit made while reading is picked up by the next check
+        file_stats = self._file_stats()
+        paths = (self.terminology_path, self.additional_rules_path)
+        sources = _read_sources(*paths)
+        source_digest = _source_digest(sources)
+        with _snapshots_lock:
+            shared = _snapshots_by_source.get(source_digest)
+        if shared is not None:
+            return shared.share(version, file_stats)
+        compiled = read_compiled(self.compiled_path, source_digest) if self.compiled_path else None
+        snapshot = _build_snapshot(paths, sources, version, file_stats, compiled)
+        with _snapshots_lock:
+            _snapshots_by_source.setdefault(source_digest, snapshot)
+        return snapshot
+
+    def _watch(self):
+        while not self._stopped.wait(self.reload_interval):
+            try:
+                self.reload()
+            except Exception:
+                logger.exception("failed to check knowledge files")
+
+knowledge_store = KnowledgeStore(TERMINOLOGY_FILE_PATH, ADDITIONAL_RULES_FILE_PATH, KNOWLEDGE_RELOAD_INTERVAL_SEC, KNOWLEDGE_COMPILED_PATH)
+
+register_collector(lambda: [("knowledge_version", "gauge", knowledge_store.snapshot.version if knowledge_store.snapshot else 0)])
@@ -0,0 +1,133 @@
+import atexit
+import contextvars
+import json
+import logging
+import queue
+import sys
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Optional
+
+from .metrics import inc
+
+# Fields added to every event logged by the current request, e.g. its request_id
+_log_context: contextvars.ContextVar[dict] = contextvars.ContextVar("log_context", default={})
+
+# Libraries that log every HTTP request at INFO
+QUIET_LOGGERS = ("httpx", "httpcore", "anthropic")
+LOG_QUEUE_SIZE = 10000
+
+def bind(**fields: Any):
+    """Add fields to the events logged by the current request, or thread, from now on."""
+    _log_context.set({**_log_context.get(), **fields})
+
+class EventLogger:
+    """Logs an event name with structured fields instead of a formatted message.
+
+    Nothing is built when the level is disabled. Field values that are callables are called by the
+    handler thread when the event is written, so costly summaries stay off the request path; they
+    must only read data that isn't changed afterwards.
+    """
+
+    def __init__(self, name: str):
+        self.logger = logging.getLogger(name)
+
+    def setLevel(self, level: int):
+        self.logger.setLevel(level)
+
+    def debug(self, event: str, **fields: Any):
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event: str, **fields: Any):
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event: str, **fields: Any):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event: str, **fields: Any):
+        self._log(logging.ERROR, event, fields)
+
+    def exception(self, event: str, **fields: Any):
+        self._log(logging.ERROR, event, fields, exc_info=True)
+
+    def _log(self, level: int, event: str, fields: dict, exc_info: bool = False):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, event, extra={"fields": fields}, exc_info=exc_info, stacklevel=3)
+
+def _fields(record: logging.LogRecord) -> dict:
+    fields = {**getattr(record, "context", {}), **getattr(record, "fields", {})}
+    for key, value in fields.items():
+        if callable(value):
+            try:
+                fields[key] = value()
+            except Exception as e:
+                fields[key] = f"<failed: {e!r}>"
+    return fields
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, event, the fields and the traceback if any."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+            **_fields(record),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    """`time level logger event key=value ...` for reading logs in a terminal."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = f"{self.formatTime(record)} {record.levelname} {record.name} {record.getMessage()}"
+        fields = " ".join(f"{key}={json.dumps(value, ensure_ascii=False, default=str)}" for key, value in _fields(record).items())
+        if fields:
+            text += " " + fields
+        if record.exc_info:
+            text += "\n" + self.formatException(record.exc_info)
+        return text
+
+class _DeferredQueueHandler(QueueHandler):
+    """Queues records without formatting them, the listener thread formats and writes them.
+    Records are dropped when the queue is full rather than blocking the caller."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        context = _log_context.get()
+        if context:
+            record.context = context
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            inc("log_records_dropped_total")
+
+_listener: Optional[QueueListener] = None
+_setup_lock = threading.Lock()
+
+def setup_logging(level: int, log_format: str = "json"):
+    """Send the records of all loggers through a queue to a stderr handler on a background thread.
+    Only the first call configures logging, so the Streamlit app can call it on every rerun."""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(JsonFormatter() if log_format == "json" else TextFormatter())
+        log_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+        _listener = QueueListener(log_queue, handler)
+        _listener.start()
+        # Written out on exit, the listener drains the queue before stopping
+        atexit.register(_listener.stop)
+
+        root = logging.getLogger()
+        root.addHandler(_DeferredQueueHandler(log_queue))
+        root.setLevel(level)
+        for name in QUIET_LOGGERS:
+            logging.getLogger(name).setLevel(max(level, logging.WARNING))
@@ -0,0 +1,101 @@
+import re
+from typing import Generic, TypeVar
+
+T = TypeVar("T")
+
+_REGEX_METACHARS = set(".^$*+?{}[]\\()")
+_END = ""
+
+def _is_literal_alternation(pattern: str) -> bool:
+    return not any(c in _REGEX_METACHARS for c in pattern)
+
+def _trie_regex(node: dict) -> str:
+    # Children are tried before the end marker so the longest literal wins at each position.
+    branches = [re.escape(char) + _trie_regex(child) for char, child in sorted(node.items()) if char != _END]
+    if _END in node and branches:
+        branches.append("")
+    if not branches:
+        return ""
+    if len(branches) == 1:
+        return branches[0]
+    return "(?:" + "|".join(branches) + ")"
+
+class PatternIndex(Generic[T]):
+    """Matches a query against many index patterns in a single pass.
+
+    Patterns that are plain alternations of literals are merged into one trie-shaped regex,
+    the rest are compiled individually and searched as a fallback.
+    `search` returns the same items, in the same order, as calling `re.search` on each pattern.
+    """
+
+    def __init__(self, entries: list[tuple[str, T]]):
+        self.items: list[T] = [item for _, item in entries]
+        self._always: set[int] = set()
+        self._fallback: list[tuple[int, re.Pattern]] = []
+
+        literals: dict[str, set[int]] = {}
+        for i, (pattern, _) in enumerate(entries):
+            if not _is_literal_alternation(pattern):
+                self._fallback.append((i, re.compile(pattern)))
+                continue
+            for literal in pattern.split("|"):
+                if literal == "":
+                    self._always.add(i)
+                else:
+                    literals.setdefault(literal, set()).add(i)
+
+        trie: dict = {}
+        for literal in literals:
+            node = trie
+            for char in literal:
+                node = node.setdefault(char, {})
+            node[_END] = literal
+
+        # A literal found at some position implies every literal that is a prefix of it matched there too.
+        self._matches_by_literal: dict[str, frozenset[int]] = {}
+        for literal in literals:
+            node = trie
+            indices: set[int] = set()
+            for char in literal:
+                node = node[char]
+                if _END in node:
+                    indices |= literals[node[_END]]
+            self._matches_by_literal[literal] = frozenset(indices)
+
+        self._literal_regex = re.compile("(?=(" + _trie_regex(trie) + "))") if literals else None
+
+    def export(self) -> dict:
+        """Plain data `restore` rebuilds the index from without building the trie again."""
+        return {
+            "always": sorted(self._always),
+            "fallback": [(i, regex.pattern) for i, regex in self._fallback],
+            "literal_regex": self._literal_regex.pattern if self._literal_regex is not None else None,
+            "matches_by_literal": {literal: sorted(indices) for literal, indices in self._matches_by_literal.items()},
+        }
+
+    @classmethod
+    def restore(cls, items: list[T], state: dict) -> "PatternIndex[T]":
+        index = cls.__new__(cls)
+        index.items = list(items)
+        index._always = set(state["always"])
+        index._fallback = [(i, re.compile(pattern)) for i, pattern in state["fallback"]]
+        index._matches_by_literal = {literal: frozenset(indices) for literal, indices in state["matches_by_literal"].items()}
+        index._literal_regex = re.compile(state["literal_regex"]) if state["literal_regex"] is not None else None
+        return index
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def search(self, query: str) -> list[T]:
+        return [self.items[i] for i in self.search_indices(query)]
+
+    def search_indices(self, query: str) -> list[int]:
+        """Positions of the matching entries, in order."""
+        matched = set(self._always)
+        if self._literal_regex is not None:
+            for m in self._literal_regex.finditer(query):
+                matched |= self._matches_by_literal[m.group(1)]
+        for i, regex in self._fallback:
+            if i not in matched and regex.search(query):
+                matched.add(i)
+        return sorted(matched)
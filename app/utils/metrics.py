@@ -0,0 +1,113 @@
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Optional
+
+from constants import METRICS_ENABLED
+
+# Upper bounds (seconds) of the stage duration histogram buckets
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_lock = threading.Lock()
+# Per stage: count of each bucket (the last one is +Inf, not cumulative), sum and count of the durations
+_stage_buckets: dict[str, list[int]] = {}
+_stage_sums: dict[str, float] = {}
+_counters: dict[str, dict[tuple[tuple[str, str], ...], float]] = {}
+# Functions returning (name, type, value) samples read at scrape time, e.g. cache statistics
+_collectors: list[Callable[[], list[tuple[str, str, float]]]] = []
+# Stage durations (ms) of the current request for the Server-Timing header
+_request_timings: ContextVar[Optional[dict[str, float]]] = ContextVar("request_timings", default=None)
+
+def start_timings() -> Optional[dict[str, float]]:
+    """Collect the stage durations of the current request into the returned dict, None when metrics are disabled."""
+    if not METRICS_ENABLED:
+        return None
+    timings: dict[str, float] = {}
+    _request_timings.set(timings)
+    return timings
+
+def record_stage(name: str, seconds: float):
+    if not METRICS_ENABLED:
+        return
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds * 1000
+    with _lock:
+        buckets = _stage_buckets.get(name)
+        if buckets is None:
+            buckets = _stage_buckets[name] = [0] * (len(STAGE_BUCKETS) + 1)
+            _stage_sums[name] = 0.0
+        buckets[bisect_left(STAGE_BUCKETS, seconds)] += 1
+        _stage_sums[name] += seconds
+
+class _Stage:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record_stage(self.name, time.perf_counter() - self.start)
+        return False
+
+class _NoopStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NOOP_STAGE = _NoopStage()
+
+def stage(name: str):
+    """Time a block as a stage of the current request. A shared no-op when metrics are disabled."""
+    return _Stage(name) if METRICS_ENABLED else _NOOP_STAGE
+
+def inc(name: str, value: float = 1, **labels: str):
+    """Increase a counter, e.g. `inc("chat_responses_total", status="ok")`."""
+    if not METRICS_ENABLED:
+        return
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+def register_collector(collector: Callable[[], list[tuple[str, str, float]]]):
+    _collectors.append(collector)
+
+def server_timing_header(timings: dict[str, float]) -> str:
+    return ", ".join(f"{name};dur={ms:.1f}" for name, ms in timings.items())
+
+def _format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+def render_metrics() -> str:
+    """Render every metric in the Prometheus text exposition format."""
+    lines = ["# TYPE chat_stage_duration_seconds histogram"]
+    with _lock:
+        for name, buckets in _stage_buckets.items():
+            cumulative = 0
+            for bound, count in zip(STAGE_BUCKETS + (float("inf"),), buckets):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'chat_stage_duration_seconds_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+            lines.append(f'chat_stage_duration_seconds_sum{{stage="{name}"}} {_stage_sums[name]}')
+            lines.append(f'chat_stage_duration_seconds_count{{stage="{name}"}} {cumulative}')
+        for name, series in _counters.items():
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in series.items():
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+    for collector in _collectors:
+        for name, metric_type, value in collector():
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
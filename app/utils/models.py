@@ -1,4 +1,5 @@
 from enum import StrEnum
+from typing import Optional
 
 from pydantic import BaseModel
 
@@ -10,15 +11,56 @@ class ClaudeOptions(BaseModel):
 class ClaudeUsage(BaseModel):
     input_tokens: int
     output_tokens: int
+    cache_creation_input_tokens: int = 0
+    cache_read_input_tokens: int = 0
     elapsed_time_ms: int
     
 class ChatRole(StrEnum):
     USER = "user"
     AI = "ai"
     
-class ChatMessage(BaseModel):
-    role: ChatRole
-    content: str
+# Messages and their matches are created for every history line loaded, so they are plain classes with
+# slots instead of pydantic models. Their fields come from the history store or from validated requests.
+
+class KeywordMatches:
+    __slots__ = ("knowledge", "terms", "rules")
+
+    def __init__(self, knowledge: str, terms: list[str], rules: list[str]):
+        # Fingerprint of the knowledge the message was matched against
+        self.knowledge = knowledge
+        # Names of the matched terms and ids of the matched additional rules
+        self.terms = terms
+        self.rules = rules
+
+    def to_dict(self) -> dict:
+        return {"knowledge": self.knowledge, "terms": self.terms, "rules": self.rules}
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, KeywordMatches) and self.to_dict() == other.to_dict()
+
+    def __repr__(self) -> str:
+        return f"KeywordMatches(knowledge={self.knowledge!r}, terms={self.terms!r}, rules={self.rules!r})"
+
+class ChatMessage:
+    __slots__ = ("role", "content", "matches", "_payload")
+
+    def __init__(self, role: ChatRole, content: str, matches: Optional[KeywordMatches] = None):
+        self.role = role
+        self.content = content
+        self.matches = matches
+        self._payload: Optional[dict] = None
+
+    def payload(self) -> dict:
+        """The message as sent to the messages API, built once and reused by every request the message is sent with."""
+        if self._payload is None:
+            self._payload = {"role": "user" if self.role == ChatRole.USER else "assistant", "content": self.content}
+        return self._payload
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, ChatMessage) and (self.role, self.content, self.matches) == (other.role, other.content, other.matches)
+
+    def __repr__(self) -> str:
+        return f"ChatMessage(role={self.role!r}, content={self.content!r}, matches={self.matches!r})"
 
 class TermCategory(StrEnum):
     PERSON = "person"
@@ -39,4 +81,14 @@ class Term(BaseModel):
 
 class AditionalRule(BaseModel):
     index_regex: str
-    rules: list[str]
\ No newline at end of file
+    rules: list[str]
+
+class PersonaDefinition(BaseModel):
+    """A persona file of PERSONAS_DIR, named after the persona. Fields left out are taken from the default persona."""
+    system_prompt: str
+    assistant_prompt_template: str
+    dynamic_system_prompt_template: Optional[str] = None
+    terminology_path: Optional[str] = None
+    additional_rules_path: Optional[str] = None
+    compiled_knowledge_path: Optional[str] = None
+    fallback_messages: Optional[list[str]] = None
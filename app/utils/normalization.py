@@ -15,4 +15,79 @@ def truncate_text(text: str, max_length: int,  max_sentences: int | None = None)
     
     if sentence_positions:
         return truncated[:sentence_positions[-1]]
-    return None
\ No newline at end of file
+    return None
+
+class StreamingTruncator:
+    """Applies `truncate_text(text, max_length) or truncate_text(text, max_length * 2, 1) or text` while text streams in.
+
+    `feed` returns the newly arrived text that is certain to be part of the final reply, so it can be forwarded
+    right away. `done` becomes true as soon as more text can no longer change the reply, or once `stop_text`
+    appears. Leading and trailing whitespace is stripped and `stop_text` is never included.
+    """
+
+    def __init__(self, max_length: int, stop_text: str = ""):
+        self.max_length = max_length
+        self.stop_text = stop_text
+        self.raw = ""
+        self.emitted = ""
+        self.done = False
+
+    def feed(self, chunk: str) -> str:
+        if self.done:
+            return ""
+        self.raw += chunk
+        text, stopped = self._visible_text()
+        if stopped:
+            return self._emit(self._final_text(text))
+        # Trailing whitespace is only part of the reply if more text follows
+        text = text.rstrip()
+
+        max_length = self.max_length
+        if len(text) >= max_length:
+            result = truncate_text(text, max_length) or truncate_text(text, max_length * 2, 1)
+            if result is not None:
+                self.done = True
+                return self._emit(result)
+            # The reply runs at least until the next boundary, so everything so far is part of it
+            return self._emit(text)
+        # The reply runs at least until the last boundary seen so far
+        return self._emit(truncate_text(text, max_length) or "")
+
+    def finish(self) -> str:
+        """Returns the rest of the final reply once the stream has ended."""
+        if self.done:
+            return ""
+        text, _ = self._visible_text(complete=True)
+        return self._emit(self._final_text(text))
+
+    @property
+    def text(self) -> str:
+        return self.emitted
+
+    def _final_text(self, text: str) -> str:
+        self.done = True
+        text = text.strip()
+        return truncate_text(text, self.max_length) or truncate_text(text, self.max_length * 2, 1) or text
+
+    def _visible_text(self, complete: bool = False) -> tuple[str, bool]:
+        raw = self.raw
+        if self.stop_text:
+            position = raw.find(self.stop_text)
+            if position >= 0:
+                return raw[:position].lstrip(), True
+            if complete:
+                return raw.lstrip(), False
+            # Hold back a possible beginning of the stop text
+            for length in range(min(len(self.stop_text) - 1, len(raw)), 0, -1):
+                if self.stop_text.startswith(raw[-length:]):
+                    raw = raw[:-length]
+                    break
+        return raw.lstrip(), False
+
+    def _emit(self, safe_text: str) -> str:
+        if len(safe_text) <= len(self.emitted):
+            return ""
+        chunk = safe_text[len(self.emitted):]
+        self.emitted = safe_text
+        return chunk
+
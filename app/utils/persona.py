@@ -0,0 +1,161 @@
+import logging
+import os
+import re
+from pathlib import Path
+from typing import Optional
+
+from .knowledge import KnowledgeStore, knowledge_store
+from .metrics import register_collector
+from .models import PersonaDefinition
+from .prompt import parse_template
+from constants import (
+    DEFAULT_PERSONA_ID, STATIC_SYSTEM_PROMPT, DYNAMIC_SYSTEM_PROMPT_TEMPLATE, ASSISTANT_PROMPT_TEMPLATE, FALLBACK_MESSAGES,
+    KNOWLEDGE_RELOAD_INTERVAL_SEC
+)
+
+logger = logging.getLogger(__name__)
+
+PERSONA_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]+")
+# Starts the history keys of the personas other than the default one
+HISTORY_KEY_MARKER = "@"
+
+class Persona:
+    """A character the API can answer as: its static system prompt, parsed prompt templates, knowledge and fallback replies."""
+
+    def __init__(
+        self, persona_id: str, system_prompt: str, dynamic_template, assistant_template, knowledge: KnowledgeStore,
+        fallback_messages: list[str], history_prefix: str = ""
+    ):
+        self.persona_id = persona_id
+        self.system_prompt = system_prompt
+        self.dynamic_template = dynamic_template
+        self.assistant_template = assistant_template
+        self.knowledge = knowledge
+        self.fallback_messages = fallback_messages
+        self.history_prefix = history_prefix
+
+    def history_key(self, user_id: Optional[str]) -> str:
+        """Key of the user's conversation with this persona in the history store, cache and turn locks.
+
+        Other personas use `@{persona_id}.{user_id}`. The default persona uses the plain user_id so its existing
+        histories are kept, with the marker doubled for user_ids starting with it, so no two (persona, user) pairs
+        share a key. Requests without a user_id share the key "None", the name their history file always had.
+        """
+        user_id = str(user_id)
+        if self.history_prefix:
+            return self.history_prefix + user_id
+        return HISTORY_KEY_MARKER + user_id if user_id.startswith(HISTORY_KEY_MARKER) else user_id
+
+    def __repr__(self) -> str:
+        return f"Persona({self.persona_id!r})"
+
+class PersonaRegistry:
+    """The personas served by the process, looked up by id.
+
+    Personas only hold what differs between them. Identical templates are parsed once, personas naming the same
+    knowledge files use one KnowledgeStore, and stores whose files have the same contents share one snapshot of the
+    indices. The Claude client and the history store are shared by every persona.
+    """
+
+    def __init__(self, default: Persona):
+        self.default = default
+        self.personas: dict[str, Persona] = {default.persona_id: default}
+        self._stores: dict[tuple, KnowledgeStore] = {self._store_key(default.knowledge.terminology_path, default.knowledge.additional_rules_path, default.knowledge.compiled_path): default.knowledge}
+
+    def get(self, persona_id: Optional[str]) -> Persona:
+        """The persona with `persona_id`, the default one for None. Raises KeyError for an unknown persona."""
+        if persona_id is None:
+            return self.default
+        return self.personas[persona_id]
+
+    def add(self, persona_id: str, definition: PersonaDefinition) -> Persona:
+        if not PERSONA_ID_PATTERN.fullmatch(persona_id):
+            raise ValueError(f"invalid persona id {persona_id!r}, only letters, digits, _ and - are allowed")
+        if persona_id in self.personas:
+            raise ValueError(f"persona {persona_id!r} is defined twice")
+        default = self.default
+        knowledge = self.knowledge_store(
+            definition.terminology_path or default.knowledge.terminology_path,
+            definition.additional_rules_path or default.knowledge.additional_rules_path,
+            definition.compiled_knowledge_path
+        )
+        dynamic_template = default.dynamic_template
+        if definition.dynamic_system_prompt_template is not None:
+            dynamic_template = parse_template(definition.dynamic_system_prompt_template)
+        persona = Persona(
+            persona_id,
+            # Interned so personas with the same prompt hold one string
+            system_prompt=_intern(definition.system_prompt),
+            dynamic_template=dynamic_template,
+            assistant_template=parse_template(definition.assistant_prompt_template),
+            knowledge=knowledge,
+            fallback_messages=definition.fallback_messages or default.fallback_messages,
+            history_prefix=f"{HISTORY_KEY_MARKER}{persona_id}."
+        )
+        self.personas[persona_id] = persona
+        return persona
+
+    def load_dir(self, directory: str) -> list[Persona]:
+        """Add the personas defined by the `*.json` files of `directory`, each named after its file. A missing
+        directory defines none, an invalid file raises."""
+        path = Path(directory)
+        if not path.is_dir():
+            return []
+        personas = []
+        for file in sorted(path.glob("*.json")):
+            with open(file, "rb") as f:
+                definition = PersonaDefinition.model_validate_json(f.read())
+            personas.append(self.add(file.stem, definition))
+        if personas:
+            logger.info(f"loaded {len(personas)} personas from {directory}: {len(self.knowledge_stores())} knowledge stores")
+        return personas
+
+    def knowledge_store(self, terminology_path: str, additional_rules_path: str, compiled_path: Optional[str]) -> KnowledgeStore:
+        """The store of these knowledge files, shared with the personas already using them."""
+        key = self._store_key(terminology_path, additional_rules_path, compiled_path)
+        store = self._stores.get(key)
+        if store is None:
+            store = self._stores[key] = KnowledgeStore(terminology_path, additional_rules_path, KNOWLEDGE_RELOAD_INTERVAL_SEC, compiled_path)
+        return store
+
+    def knowledge_stores(self) -> list[KnowledgeStore]:
+        return list(self._stores.values())
+
+    def load_knowledge(self):
+        """Load the knowledge of every persona, raises when the files of one can't be loaded."""
+        for store in self._stores.values():
+            store.get()
+
+    def start(self):
+        for store in self._stores.values():
+            store.start()
+
+    def stop(self):
+        for store in self._stores.values():
+            store.stop()
+
+    @staticmethod
+    def _store_key(terminology_path: str, additional_rules_path: str, compiled_path: Optional[str]) -> tuple:
+        return (
+            os.path.realpath(terminology_path), os.path.realpath(additional_rules_path),
+            os.path.realpath(compiled_path) if compiled_path else None
+        )
+
+_interned: dict[str, str] = {}
+
+def _intern(text: str) -> str:
+    return _interned.setdefault(text, text)
+
+persona_registry = PersonaRegistry(Persona(
+    DEFAULT_PERSONA_ID,
+    system_prompt=_intern(STATIC_SYSTEM_PROMPT),
+    dynamic_template=parse_template(DYNAMIC_SYSTEM_PROMPT_TEMPLATE),
+    assistant_template=parse_template(ASSISTANT_PROMPT_TEMPLATE),
+    knowledge=knowledge_store,
+    fallback_messages=FALLBACK_MESSAGES
+))
+
+register_collector(lambda: [
+    ("personas", "gauge", len(persona_registry.personas)),
+    ("persona_knowledge_stores", "gauge", len(persona_registry.knowledge_stores())),
+])
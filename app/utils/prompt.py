@@ -0,0 +1,80 @@
+import threading
+from collections import OrderedDict
+
+import pystache
+
+from constants import DYNAMIC_SYSTEM_PROMPT_TEMPLATE, ASSISTANT_PROMPT_TEMPLATE, PROMPT_CACHE_MAX_SIZE
+
+# Parsed templates by their text, so personas with the same template share one parsed tree
+parsed_templates: dict[str, pystache.parsed.ParsedTemplate] = {}
+parsed_templates_lock = threading.Lock()
+
+def parse_template(template: str) -> pystache.parsed.ParsedTemplate:
+    with parsed_templates_lock:
+        parsed = parsed_templates.get(template)
+        if parsed is None:
+            parsed = parsed_templates[template] = pystache.parse(template)
+        return parsed
+
+# Parsed once, rendering only walks the parsed tree
+dynamic_system_prompt_template = parse_template(DYNAMIC_SYSTEM_PROMPT_TEMPLATE)
+assistant_prompt_template = parse_template(ASSISTANT_PROMPT_TEMPLATE)
+
+# Rendered prompts keyed by the identity of the objects in params. Each entry keeps its params alive
+# so an id can't be reused by another object while the entry is cached.
+rendered_prompts: OrderedDict[tuple, tuple[dict, str, str]] = OrderedDict()
+prompt_cache_hits = 0
+prompt_cache_misses = 0
+prompt_cache_lock = threading.Lock()
+
+def _params_key(params: dict) -> tuple:
+    return tuple((key, tuple(map(id, value)) if isinstance(value, list) else value) for key, value in sorted(params.items()))
+
+def _render(params: dict, dynamic_template, assistant_template) -> tuple[str, str]:
+    # Renderer keeps per-render state, so each render gets its own
+    return pystache.Renderer().render(dynamic_template, params), pystache.Renderer().render(assistant_template, params)
+
+def render_prompts(params: dict, dynamic_template=None, assistant_template=None) -> tuple[str, str]:
+    """Render the dynamic part of the system prompt and the assistant prompt, reusing the result for the same matched people and rules.
+
+    The templates are those of a persona from `parse_template`, the default persona's when omitted. Parsed templates are
+    never dropped, so their ids are part of the cache key.
+    """
+    global prompt_cache_hits, prompt_cache_misses
+    dynamic_template = dynamic_template or dynamic_system_prompt_template
+    assistant_template = assistant_template or assistant_prompt_template
+    try:
+        key = (id(dynamic_template), id(assistant_template), _params_key(params))
+        hash(key)
+    except TypeError:
+        return _render(params, dynamic_template, assistant_template)
+
+    with prompt_cache_lock:
+        entry = rendered_prompts.get(key)
+        if entry is not None:
+            prompt_cache_hits += 1
+            rendered_prompts.move_to_end(key)
+            return entry[1], entry[2]
+        prompt_cache_misses += 1
+
+    system_prompt, assistant_prompt = _render(params, dynamic_template, assistant_template)
+    with prompt_cache_lock:
+        rendered_prompts[key] = (dict(params), system_prompt, assistant_prompt)
+        while len(rendered_prompts) > PROMPT_CACHE_MAX_SIZE:
+            rendered_prompts.popitem(last=False)
+    return system_prompt, assistant_prompt
+
+def clear_prompt_cache():
+    """Drop every rendered prompt, called when the knowledge files are reloaded."""
+    with prompt_cache_lock:
+        rendered_prompts.clear()
+
+def prompt_cache_stats() -> dict:
+    with prompt_cache_lock:
+        total = prompt_cache_hits + prompt_cache_misses
+        return {
+            "size": len(rendered_prompts),
+            "hits": prompt_cache_hits,
+            "misses": prompt_cache_misses,
+            "hit_rate": prompt_cache_hits / total if total else 0.0,
+        }
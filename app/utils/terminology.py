@@ -1,22 +1,8 @@
-import re
-import json
-
 from .models import Term, TermCategory
-from constants import TERMINOLOGY_FILE_PATH
-
-terminology: list[Term] = []
+from .knowledge import knowledge_store
 
 def search_terminology(query: str, category: TermCategory | None = None) -> list[Term]:
-    global terminology
-    if not terminology:
-        __init__()
-
-    results = [v for v in terminology if (re.search(v.index_regex, query) and (not category or category in v.categories))]
-    return results
-
-def __init__():
-    global terminology
-    
-    file = open(TERMINOLOGY_FILE_PATH, "r", encoding='utf-8')
-    data = json.load(file)
-    terminology = [Term(**glossary) for glossary in data]                                   
\ No newline at end of file
+    index = knowledge_store.get().terminology_indices.get(category)
+    if index is None:
+        return []
+    return index.search(query)
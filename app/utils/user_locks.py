@@ -0,0 +1,116 @@
+import asyncio
+import hashlib
+import os
+import struct
+import weakref
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where only the locks within the process are available
+    fcntl = None
+
+from .metrics import inc
+
+# Counter of finished turns at the start of each lock file
+VERSION = struct.Struct("<Q")
+
+class UserTurnLocks:
+    """Runs the turns of a user one after another, so each turn reads the history saved by the previous one.
+
+    Users are hashed onto `stripes` locks. Within the process a stripe is an asyncio lock. With `lock_dir` it is
+    also an advisory file lock shared by every worker using the directory, taken without waiting when free and
+    polled otherwise. Each file holds a counter bumped at the end of every turn, so a worker can tell whether
+    another process may have written the history of the stripe's users since it last held it. Since a stripe
+    holds many users, that is recorded per stripe as a local epoch, and a user's history is trusted only if it
+    was last served in the stripe's current epoch. The last `max_users` users are remembered, the others are
+    treated as changed.
+    """
+
+    def __init__(
+        self, stripes: int, lock_dir: Optional[str] = None, poll_interval: float = 0.005, max_poll_interval: float = 0.05,
+        max_users: int = 10000
+    ):
+        if lock_dir is not None:
+            if fcntl is None:
+                raise ValueError("locking users across workers needs fcntl, which this platform doesn't have")
+            Path(lock_dir).mkdir(parents=True, exist_ok=True)
+        self.stripes = stripes
+        self.lock_dir = lock_dir
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.max_users = max_users
+        # Locks in use, dropped once nobody holds or waits for them
+        self._locks: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+        # Counter of each stripe as this process left it
+        self._seen: dict[int, int] = {}
+        # Bumped each time another process turns out to have held the stripe
+        self._epochs: dict[int, int] = {}
+        # Epoch of its stripe when each user was last served, least recently served first
+        self._user_epochs: OrderedDict[str, int] = OrderedDict()
+
+    def stripe(self, user_id: str) -> int:
+        # Python's hash() differs between processes
+        return int.from_bytes(hashlib.blake2b(user_id.encode('utf-8'), digest_size=8).digest(), "little") % self.stripes
+
+    @asynccontextmanager
+    async def hold(self, user_id: str, deadline: Optional[float] = None) -> AsyncIterator[bool]:
+        """Hold the user's turn for the block. Waiting for it ends with TimeoutError at `deadline`, in event loop time.
+        Yields whether another process may have changed the user's history since this process last served the
+        user, always False without `lock_dir`."""
+        stripe = self.stripe(user_id)
+        lock = self._locks.get(stripe)
+        if lock is None:
+            lock = self._locks[stripe] = asyncio.Lock()
+        if lock.locked():
+            inc("user_lock_waits_total", scope="process")
+        async with asyncio.timeout_at(deadline):
+            await lock.acquire()
+        try:
+            if self.lock_dir is None:
+                yield False
+                return
+            async with asyncio.timeout_at(deadline):
+                fd, version = await self._lock_file(stripe)
+            if self._seen.get(stripe) != version:
+                self._epochs[stripe] = self._epochs.get(stripe, 0) + 1
+            epoch = self._epochs[stripe]
+            try:
+                yield self._user_epochs.get(user_id) != epoch
+            finally:
+                self._user_epochs[user_id] = epoch
+                self._user_epochs.move_to_end(user_id)
+                if len(self._user_epochs) > self.max_users:
+                    self._user_epochs.popitem(last=False)
+                # Bumped even when the turn failed, it may have written part of the history
+                version = (version + 1) % 2 ** 64
+                os.pwrite(fd, VERSION.pack(version), 0)
+                self._seen[stripe] = version
+                # Closing the file releases its lock
+                os.close(fd)
+        finally:
+            lock.release()
+
+    async def _lock_file(self, stripe: int) -> tuple[int, int]:
+        """Open and lock the stripe's file, returns the file descriptor and the counter."""
+        fd = os.open(os.path.join(self.lock_dir, f"{stripe:04x}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            delay = self.poll_interval
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    data = os.pread(fd, VERSION.size, 0)
+                    return fd, VERSION.unpack(data)[0] if len(data) == VERSION.size else 0
+                except BlockingIOError:
+                    # Polled rather than waited for on a thread, which would take the lock after a cancelled turn
+                    if delay == self.poll_interval:
+                        inc("user_lock_waits_total", scope="workers")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.max_poll_interval)
+        except BaseException:
+            os.close(fd)
+            raise
@@ -0,0 +1 @@
+"""Benchmarks and load tests, run from the repository root with `app` on the PYTHONPATH."""
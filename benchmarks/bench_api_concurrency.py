@@ -0,0 +1,50 @@
+"""Load test showing how many chats a single API worker serves concurrently.
+
+Every request goes through `chat_endpoint` in-process while the provider is the local fake server.
+Run from the repository root:
+    PYTHONPATH=app python benchmarks/bench_api_concurrency.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_anthropic import serve_in_thread
+
+PROVIDER_LATENCY_MS = 200
+
+os.environ.setdefault("CLAUDE_API_KEY", "benchmark")
+os.environ["ANTHROPIC_BASE_URL"] = serve_in_thread(port=8101, latency_ms=PROVIDER_LATENCY_MS)
+os.environ["CONV_HISTORY_PATH_TEMPLATE"] = os.path.join(tempfile.mkdtemp(), "{user_id}.jsonl")
+
+import httpx
+
+from app.api import app
+
+async def run(concurrency: int) -> float:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://api") as client:
+        async def chat(i: int):
+            response = await client.post("/api/chat/v0.1", json={
+                "author": {"user_id": f"user{i}"},
+                "message": {"text": "花園さんはどこですの？"},
+            })
+            assert response.json()["status"] == "ok", response.text
+
+        start = time.perf_counter()
+        await asyncio.gather(*(chat(i) for i in range(concurrency)))
+        return time.perf_counter() - start
+
+async def main():
+    await run(1)
+    print(f"provider latency: {PROVIDER_LATENCY_MS} ms")
+    print(f"{'concurrency':>11} {'wall ms':>9} {'req/s':>8}")
+    for concurrency in (1, 8, 32, 128):
+        elapsed = await run(concurrency)
+        print(f"{concurrency:>11} {elapsed * 1000:>9.0f} {concurrency / elapsed:>8.1f}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
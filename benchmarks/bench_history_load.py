@@ -0,0 +1,64 @@
+"""Compares the tail reader of the JSONL history store with parsing the whole history file.
+
+Run from the repository root:
+    PYTHONPATH=app python benchmarks/bench_history_load.py
+"""
+import json
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("CLAUDE_API_KEY", "benchmark")
+HISTORY_DIR = tempfile.mkdtemp()
+os.environ["CONV_HISTORY_PATH_TEMPLATE"] = os.path.join(HISTORY_DIR, "{user_id}.jsonl")
+os.environ["CONV_HISTORY_BACKEND"] = "jsonl"
+
+from app.api import MAX_CHAT_LOG_LENGTH, history_store
+from app.utils.models import ChatMessage, ChatRole
+
+SIZES = [("1KB", 1024), ("100KB", 100 * 1024), ("1MB", 1024 ** 2), ("10MB", 10 * 1024 ** 2), ("50MB", 50 * 1024 ** 2)]
+
+def full_parse(user_id: str, max_length: int = MAX_CHAT_LOG_LENGTH) -> list[ChatMessage]:
+    messages = []
+    with open(history_store.get_file_path(user_id), 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            data = json.loads(line)
+            role = ChatRole.USER if data['role'] == 'user' else ChatRole.AI
+            messages.append(ChatMessage(role=role, content=data['text']))
+    return messages[-max_length:]
+
+def write_history(user_id: str, size: int):
+    with open(history_store.get_file_path(user_id), 'w', encoding='utf-8') as f:
+        written = 0
+        i = 0
+        while written < size:
+            line = json.dumps({
+                "user_id": user_id,
+                "platform": "discord",
+                "timestamp": "2024-01-01T12:00:00Z",
+                "role": "user" if i % 2 == 0 else "assistant",
+                "text": f"メッセージ{i} うふふふ…不安ですわ。",
+            }, ensure_ascii=False) + "\n"
+            f.write(line)
+            written += len(line.encode('utf-8'))
+            i += 1
+
+def main():
+    print(f"{'file':>6} {'full parse ms':>14} {'tail read ms':>13}")
+    for label, size in SIZES:
+        user_id = f"bench_{label}"
+        write_history(user_id, size)
+        assert full_parse(user_id) == history_store.load_last(user_id, MAX_CHAT_LOG_LENGTH)
+        number = 3 if size >= 10 * 1024 ** 2 else 50
+        full = timeit.timeit(lambda: full_parse(user_id), number=number) / number
+        tail = timeit.timeit(lambda: history_store.load_last(user_id, MAX_CHAT_LOG_LENGTH), number=number) / number
+        print(f"{label:>6} {full * 1000:>14.3f} {tail * 1000:>13.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""End-to-end load driver for the chat endpoint, reporting throughput and latency percentiles as JSON.
+
+By default the API runs in-process against the local fake provider, so runs are reproducible:
+    PYTHONPATH=app python benchmarks/bench_load.py --requests 1000 --concurrency 64 --output load.json
+Point it at a running server instead with `--url http://127.0.0.1:8000`.
+The stage durations from the Server-Timing header are summarized as well when metrics are enabled.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+
+from benchmarks.fake_anthropic import serve_in_thread
+from benchmarks.results import report, summarize
+
+PROVIDER_PORT = 8106
+MESSAGES = ["花園さんはどこですの？", "今日は何を作りますの？", "邪神ちゃんさんに負けませんわ！", "こんにちは"]
+
+def parse_server_timing(header: str) -> dict[str, float]:
+    timings = {}
+    for metric in header.split(","):
+        name, _, params = metric.strip().partition(";")
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "dur":
+                timings[name] = float(value)
+    return timings
+
+def create_client(args) -> httpx.AsyncClient:
+    if args.url:
+        return httpx.AsyncClient(base_url=args.url, timeout=600, limits=httpx.Limits(max_connections=args.concurrency))
+
+    # The app reads its configuration on import
+    os.environ.setdefault("CLAUDE_API_KEY", "benchmark")
+    os.environ["ANTHROPIC_BASE_URL"] = serve_in_thread(port=PROVIDER_PORT, latency_ms=args.latency_ms, token_latency_ms=args.token_latency_ms)
+    os.environ["CONV_HISTORY_PATH_TEMPLATE"] = os.path.join(tempfile.mkdtemp(), "{user_id}.jsonl")
+    from app.api import app
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://api", timeout=600)
+
+async def run(args) -> list[dict]:
+    latencies: list[float] = []
+    stages: dict[str, list[float]] = {}
+    statuses: dict[str, int] = {}
+
+    async with create_client(args) as client:
+        async def send(i: int) -> tuple[httpx.Response, float]:
+            start = time.perf_counter()
+            response = await client.post("/api/chat/v0.1", json={
+                "request_id": f"load-{i}",
+                "origin": {"platform": "benchmark"},
+                "author": {"user_id": f"load_user{i % args.users}"},
+                "message": {"text": MESSAGES[i % len(MESSAGES)]},
+            })
+            return response, (time.perf_counter() - start) * 1000
+
+        # Warm up connections and caches one request at a time, left out of the results
+        for i in range(args.warmup):
+            await send(i)
+
+        next_index = iter(range(args.warmup, args.warmup + args.requests))
+
+        async def worker():
+            for i in next_index:
+                response, elapsed = await send(i)
+                status = response.json()["status"] if response.status_code == 200 else f"http_{response.status_code}"
+                statuses[status] = statuses.get(status, 0) + 1
+                latencies.append(elapsed)
+                for name, ms in parse_server_timing(response.headers.get("server-timing", "")).items():
+                    stages.setdefault(name, []).append(ms)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        wall = time.perf_counter() - start
+
+    results = [{
+        "name": "chat_endpoint",
+        "params": {"concurrency": args.concurrency, "users": args.users},
+        "throughput_rps": len(latencies) / wall,
+        "wall_s": wall,
+        "statuses": statuses,
+        **summarize(latencies),
+    }]
+    results += [{"name": "stage", "params": {"stage": name}, **summarize(samples)} for name, samples in stages.items()]
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="base url of a running API server, the API runs in-process when omitted")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--users", type=int, default=50, help="distinct user ids the requests are spread over")
+    parser.add_argument("--warmup", type=int, default=10, help="requests sent first and left out of the results")
+    parser.add_argument("--latency-ms", type=int, default=200, help="time to the first token of the fake provider")
+    parser.add_argument("--token-latency-ms", type=int, default=0, help="time per output token of the fake provider")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    config = {key: value for key, value in vars(args).items() if key != "output"}
+    report("load", results, config=config, output=args.output)
+
+if __name__ == "__main__":
+    main()
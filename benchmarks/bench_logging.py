@@ -0,0 +1,131 @@
+"""Cost of the logging of one chat request on the request path, before and after structured logging.
+
+`before` is the previous logging of the API: f-strings of the whole history, keyword matches, people
+and rules, written by a handler on the calling thread. `after` logs the events of app/api.py through
+the queue handler. Both write to an in-memory stream that counts bytes:
+    PYTHONPATH=app python benchmarks/bench_logging.py --output logging.json
+`cpu_us` is the CPU time of the request thread per request, the listener thread of `after` is not counted.
+"""
+import argparse
+import logging
+import os
+import queue
+import random
+import sys
+import time
+from logging.handlers import QueueListener
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("CLAUDE_API_KEY", "benchmark")
+
+from benchmarks.bench_terminology import HIRAGANA, synthetic_terms
+from benchmarks.results import report
+
+from utils.log import EventLogger, JsonFormatter, _DeferredQueueHandler, bind
+from utils.models import AditionalRule, ChatMessage, ChatRole, ClaudeUsage, KeywordMatches
+
+HISTORY_SIZES = (4, 20, 100)
+LEVELS = ("INFO", "WARNING")
+
+class ByteCounter:
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, text: str):
+        self.bytes += len(text.encode("utf-8"))
+
+    def flush(self):
+        pass
+
+def synthetic_request(history_size: int, rng: random.Random) -> dict:
+    terms = synthetic_terms(20, rng)
+    rules = [AditionalRule(index_regex=term.index_regex, rules=[f"You call {term.name} {term.name}さん."]) for term in terms]
+    matches = KeywordMatches(knowledge="1", terms=[term.index_regex for term in terms[:3]], rules=[rule.index_regex for rule in rules[:3]])
+    history = [
+        ChatMessage(role=ChatRole.USER if i % 2 == 0 else ChatRole.AI, content="".join(rng.choices(HIRAGANA, k=100)), matches=matches)
+        for i in range(history_size)
+    ]
+    return {
+        "message": ChatMessage(role=ChatRole.USER, content="".join(rng.choices(HIRAGANA, k=50))),
+        "history": history,
+        "matches": [matches] * 4,
+        "people": terms[:3],
+        "rules": rules[:3],
+        "reply": "".join(rng.choices(HIRAGANA, k=80)),
+        "usage": ClaudeUsage(input_tokens=1200, output_tokens=40, elapsed_time_ms=900),
+    }
+
+def log_before(logger: logging.Logger, request: dict, request_id: str, user_id: str):
+    logger.info(f"received request: {request['message'].content}(request_id: {request_id}, user_id: {user_id})")
+    logger.info(f"got chat history: {request['history']}(request_id: {request_id})")
+    logger.info(f"got keyword matches: {request['matches']}(request_id: {request_id})")
+    logger.info(f"collected people: {request['people']}(request_id: {request_id})")
+    logger.info(f"collected additional rules: {request['rules']}(request_id: {request_id})")
+    logger.info(f"claude usage: {request['usage']}(request_id: {request_id})")
+    logger.info(f"sent message: {request['reply']}(request_id: {request_id})")
+
+def log_after(logger: EventLogger, request: dict, request_id: str, user_id: str):
+    bind(request_id=request_id, user_id=user_id)
+    logger.info("chat_received", endpoint="chat", platform="benchmark", chars=len(request["message"].content))
+    logger.debug("chat_text", text=request["message"].content)
+    history = request["history"]
+    logger.info("history_loaded", messages=len(history), chars=lambda: sum(len(message.content) for message in history))
+    logger.info(
+        "knowledge_collected",
+        people=lambda: [person.name for person in request["people"]],
+        additional_rules=lambda: [rule.index_regex for rule in request["rules"]]
+    )
+    logger.info("reply_generated", chars=len(request["reply"]), usage=request["usage"].model_dump)
+    logger.info("turn_saved", reply_chars=len(request["reply"]))
+    logger.debug("reply_text", text=request["reply"])
+
+def run(variant: str, level: str, request: dict, requests: int) -> dict:
+    counter = ByteCounter()
+    handler = logging.StreamHandler(counter)
+    listener = None
+    name = f"bench_logging.{variant}"
+    target = logging.getLogger(name)
+    target.propagate = False
+    target.handlers.clear()
+    target.setLevel(level)
+    if variant == "before":
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+        target.addHandler(handler)
+        log, logger = log_before, target
+    else:
+        handler.setFormatter(JsonFormatter())
+        log_queue: queue.Queue = queue.Queue()
+        listener = QueueListener(log_queue, handler)
+        listener.start()
+        target.addHandler(_DeferredQueueHandler(log_queue))
+        log, logger = log_after, EventLogger(name)
+
+    start = time.thread_time()
+    for i in range(requests):
+        log(logger, request, f"request-{i}", "user")
+    cpu = time.thread_time() - start
+    if listener:
+        listener.stop()
+    return {"cpu_us": cpu / requests * 1e6, "bytes": counter.bytes / requests}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    results = []
+    for size in HISTORY_SIZES:
+        request = synthetic_request(size, rng)
+        for level in LEVELS:
+            for variant in ("before", "after"):
+                stats = run(variant, level, request, args.requests)
+                results.append({"name": "request_logging", "params": {"variant": variant, "level": level, "history": size}, **stats})
+
+    report("logging", results, config={"requests": args.requests, "seed": args.seed}, output=args.output)
+
+if __name__ == "__main__":
+    main()
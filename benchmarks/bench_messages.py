@@ -0,0 +1,134 @@
+"""Allocations and throughput of the message path: history lines to messages, messages to the provider payload,
+and records to history lines.
+
+`before` reproduces the previous path: json.loads into pydantic ChatMessage and KeywordMatches models, nested
+content blocks built for every message on every request, and json.dumps per record. `after` runs the code
+of utils. Results are printed as JSON, or written to a file to compare runs:
+    PYTHONPATH=app python benchmarks/bench_messages.py --output messages.json
+`alloc_bytes` is the memory allocated by one call, `retained_bytes` what the result keeps alive.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tracemalloc
+from typing import Callable, Optional
+
+from pydantic import BaseModel
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("CLAUDE_API_KEY", "benchmark")
+
+from benchmarks.bench_terminology import HIRAGANA
+from benchmarks.results import measure, report
+
+from utils import codec
+from utils.claude import _build_messages
+from utils.history_store import _to_chat_message
+from utils.models import ChatRole
+
+HISTORY_SIZES = (10, 100)
+TEXT_CHARS = 100
+
+class LegacyKeywordMatches(BaseModel):
+    knowledge: str
+    terms: list[str]
+    rules: list[str]
+
+class LegacyChatMessage(BaseModel):
+    role: ChatRole
+    content: str
+    matches: Optional[LegacyKeywordMatches] = None
+
+def load_before(lines: list[bytes]) -> list[LegacyChatMessage]:
+    messages = []
+    for line in lines:
+        data = json.loads(line.decode('utf-8'))
+        matches = data.get('matches')
+        messages.append(LegacyChatMessage(
+            role=ChatRole.USER if data['role'] == 'user' else ChatRole.AI,
+            content=data['text'],
+            matches=LegacyKeywordMatches(**matches) if matches else None
+        ))
+    return messages
+
+def load_after(lines: list[bytes]) -> list:
+    messages = []
+    for line in lines:
+        data = codec.loads(line)
+        messages.append(_to_chat_message(data['role'], data['text'], data.get('matches')))
+    return messages
+
+def payload_before(history: list[LegacyChatMessage], query: str) -> list[dict]:
+    messages = []
+    for chat in history:
+        messages.append({
+            "role": "user" if chat.role == ChatRole.USER else "assistant",
+            "content": [{"type": "text", "text": chat.content}]
+        })
+    messages.append({"role": "user", "content": [{"type": "text", "text": query}]})
+    return messages
+
+def encode_before(records: list[dict]) -> bytes:
+    return "".join(json.dumps(record, ensure_ascii=False) + '\n' for record in records).encode('utf-8')
+
+def synthetic_records(count: int, rng: random.Random) -> list[dict]:
+    return [
+        {
+            "user_id": "user",
+            "platform": "benchmark",
+            "timestamp": "2026-01-01T00:00:00.000000Z",
+            "role": "user" if i % 2 == 0 else "assistant",
+            "text": "".join(rng.choices(HIRAGANA, k=TEXT_CHARS)),
+            "matches": {"knowledge": "f67062c89cd9", "terms": ["ゆりね"] if i % 3 == 0 else [], "rules": ["53138ecb07fb"] if i % 3 == 0 else []},
+        }
+        for i in range(count)
+    ]
+
+def allocations(fn: Callable[[], object], calls: int = 50) -> dict:
+    """Bytes allocated per call of `fn`, and bytes still held by its result afterwards. Results are kept until
+    the end so freed memory isn't reused by the next call."""
+    fn()
+    tracemalloc.start()
+    results = [fn() for _ in range(calls)]
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del results
+    # The list holding the results is not part of the calls
+    overhead = sys.getsizeof([None] * calls)
+    return {"alloc_bytes": (peak - overhead) / calls, "retained_bytes": (retained - overhead) / calls}
+
+def case(name: str, variant: str, size: int, fn: Callable[[], object], iterations: int) -> dict:
+    stats = measure(fn, iterations)
+    return {"name": name, "params": {"variant": variant, "messages": size}, **stats, "messages_per_s": size / (stats["mean_ms"] / 1000), **allocations(fn)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    query = "".join(rng.choices(HIRAGANA, k=TEXT_CHARS))
+    results = []
+    for size in HISTORY_SIZES:
+        records = synthetic_records(size, rng)
+        lines = encode_before(records).splitlines()
+        results.append(case("history_decode", "before", size, lambda: load_before(lines), args.iterations))
+        results.append(case("history_decode", "after", size, lambda: load_after(lines), args.iterations))
+
+        # The history cache serves the same messages to every turn of the user
+        legacy_history, history = load_before(lines), load_after(lines)
+        results.append(case("provider_payload", "before", size, lambda: payload_before(legacy_history, query), args.iterations))
+        results.append(case("provider_payload", "after", size, lambda: _build_messages(query, history, None), args.iterations))
+
+        results.append(case("history_encode", "before", size, lambda: encode_before(records), args.iterations))
+        results.append(case("history_encode", "after", size, lambda: codec.dumps_lines(records), args.iterations))
+
+    report("messages", results, config={"iterations": args.iterations, "text_chars": TEXT_CHARS, "seed": args.seed}, output=args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""Microbenchmarks of the per-request work of the chat endpoints on synthetic data of several sizes.
+
+Covers the knowledge searches, truncation, prompt rendering and history load/save of both history
+backends. Results are printed as JSON, or written to a file to compare runs:
+    PYTHONPATH=app python benchmarks/bench_micro.py --output micro.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("CLAUDE_API_KEY", "benchmark")
+
+from benchmarks.bench_terminology import HIRAGANA, synthetic_query, synthetic_terms
+from benchmarks.results import measure, report
+
+from constants import MAX_RESPONSE_LENGTH
+from utils.additional_rules import search_additional_rules
+from utils.knowledge import KnowledgeSnapshot, knowledge_store
+from utils.terminology import search_terminology
+from utils.history_store import JsonlHistoryStore, SqliteHistoryStore
+from utils.models import AditionalRule, TermAttribute, TermCategory
+from utils.normalization import truncate_text
+from utils.prompt import clear_prompt_cache, render_prompts
+
+GLOSSARY_SIZES = (10, 100, 1_000, 10_000)
+QUERY_LENGTHS = (100, 1_000)
+TEXT_LENGTHS = (100, 1_000, 10_000)
+MATCHED_SIZES = (0, 5, 20)
+HISTORY_SIZES = (("100KB", 100 * 1024), ("1MB", 1024 ** 2), ("10MB", 10 * 1024 ** 2))
+HISTORY_LOAD_COUNT = 10
+
+def iterations_for(size: int, budget: int = 20_000) -> int:
+    return max(20, min(1_000, budget // max(size, 1)))
+
+def bench_search_terminology(rng: random.Random) -> list[dict]:
+    results = []
+    for size in GLOSSARY_SIZES:
+        terms = synthetic_terms(size, rng)
+        knowledge_store.snapshot = KnowledgeSnapshot(version=size, terminology=terms, additional_rules=[])
+        for length in QUERY_LENGTHS:
+            query = synthetic_query(terms, length, rng)
+            stats = measure(lambda: search_terminology(query, TermCategory.PERSON), iterations_for(size))
+            results.append({"name": "search_terminology", "params": {"terms": size, "query_chars": length}, **stats})
+    return results
+
+def bench_search_additional_rules(rng: random.Random) -> list[dict]:
+    results = []
+    for size in GLOSSARY_SIZES:
+        terms = synthetic_terms(size, rng)
+        rules = [AditionalRule(index_regex=term.index_regex, rules=[f"You call {term.name} {term.name}さん."]) for term in terms]
+        knowledge_store.snapshot = KnowledgeSnapshot(version=size, terminology=[], additional_rules=rules)
+        for length in QUERY_LENGTHS:
+            query = synthetic_query(terms, length, rng)
+            stats = measure(lambda: search_additional_rules(query), iterations_for(size))
+            results.append({"name": "search_additional_rules", "params": {"rules": size, "query_chars": length}, **stats})
+    return results
+
+def bench_truncate_text(rng: random.Random) -> list[dict]:
+    results = []
+    for length in TEXT_LENGTHS:
+        text = "".join(rng.choice(HIRAGANA) if rng.random() > 0.05 else "。" for _ in range(length))
+        # Same as the chat endpoint
+        stats = measure(lambda: truncate_text(text, MAX_RESPONSE_LENGTH) or truncate_text(text, MAX_RESPONSE_LENGTH * 2, 1) or text, 1_000)
+        results.append({"name": "truncate_text", "params": {"text_chars": length, "max_length": MAX_RESPONSE_LENGTH}, **stats})
+    return results
+
+def bench_render_prompts(rng: random.Random) -> list[dict]:
+    results = []
+    terms = synthetic_terms(max(MATCHED_SIZES), rng)
+    for term in terms:
+        term.description = "".join(rng.choices(HIRAGANA, k=100))
+        term.attributes = [TermAttribute(name="好物", value="".join(rng.choices(HIRAGANA, k=10)))]
+    for size in MATCHED_SIZES:
+        params = {
+            "people": terms[:size],
+            "additional_rules": [AditionalRule(index_regex=term.index_regex, rules=["You call them さん."]) for term in terms[:size]],
+        }
+        cold = measure(lambda: render_prompts(params), 500, setup=clear_prompt_cache)
+        warm = measure(lambda: render_prompts(params), 1_000)
+        results.append({"name": "render_prompts", "params": {"matched": size, "cache": "cold"}, **cold})
+        results.append({"name": "render_prompts", "params": {"matched": size, "cache": "warm"}, **warm})
+    return results
+
+def history_records(user_id: str, size: int) -> list[dict]:
+    records = []
+    written = 0
+    while written < size:
+        i = len(records)
+        record = {
+            "user_id": user_id,
+            "platform": "discord",
+            "timestamp": f"2024-01-01T12:00:{i % 60:02d}.{i:06d}Z",
+            "role": "user" if i % 2 == 0 else "assistant",
+            "text": f"メッセージ{i} うふふふ…不安ですわ。",
+        }
+        records.append(record)
+        written += len(json.dumps(record, ensure_ascii=False).encode('utf-8')) + 1
+    return records
+
+def bench_history(directory: str) -> list[dict]:
+    results = []
+    stores = {
+        "jsonl": JsonlHistoryStore(
+            path_template=os.path.join(directory, "{user_id}.jsonl"), archive_folder=os.path.join(directory, "archive"),
+            max_bytes=1024 ** 3, carry_over=0, max_cached_sizes=1000
+        ),
+        "sqlite": SqliteHistoryStore(db_path=os.path.join(directory, "history.sqlite3"), max_bytes=1024 ** 3, carry_over=0, max_cached_sizes=1000),
+    }
+    for backend, store in stores.items():
+        for label, size in HISTORY_SIZES:
+            user_id = f"bench_{label}"
+            records = history_records(user_id, size)
+            if backend == "jsonl":
+                store.append(user_id, records)
+            else:
+                store.import_records(records)
+            load = measure(lambda: store.load_last(user_id, HISTORY_LOAD_COUNT), 200)
+            save = measure(lambda: store.append(user_id, records[-2:]), 200)
+            results.append({"name": "history_load", "params": {"backend": backend, "history": label, "messages": HISTORY_LOAD_COUNT}, **load})
+            results.append({"name": "history_save", "params": {"backend": backend, "history": label, "messages": 2}, **save})
+        store.close()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        results = (
+            bench_search_terminology(rng)
+            + bench_search_additional_rules(rng)
+            + bench_truncate_text(rng)
+            + bench_render_prompts(rng)
+            + bench_history(directory)
+        )
+    report("micro", results, config={"seed": args.seed}, output=args.output)
+
+if __name__ == "__main__":
+    main()
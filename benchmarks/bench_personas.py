@@ -0,0 +1,132 @@
+"""Cold start and memory of one process serving many personas.
+
+Every sample loads the persona registry and the knowledge of all its personas in a fresh interpreter:
+    PYTHONPATH=app python benchmarks/bench_personas.py --output personas.json
+Knowledge layouts:
+- `shared`: every persona names the same knowledge files, so they use one knowledge store
+- `copies`: every persona has its own copy of the same files, their stores share one snapshot of the indices
+- `distinct`: every persona has knowledge of its own, nothing can be shared, as with one process per persona
+`memory_mb` is the memory held by the registry once loaded, traced by tracemalloc in a separate run so the
+tracing doesn't slow the timed ones. `knowledge_snapshots` is the number of distinct sets of indices in memory.
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.bench_startup import write_knowledge
+from benchmarks.results import report, summarize
+
+PERSONA_COUNTS = (1, 8, 32)
+LAYOUTS = ("shared", "copies", "distinct")
+
+def child_load(directory: str, traced: bool) -> dict:
+    from utils.knowledge import KnowledgeStore
+    from utils.persona import Persona, PersonaRegistry
+    from utils.prompt import parse_template
+    from constants import DYNAMIC_SYSTEM_PROMPT_TEMPLATE, ASSISTANT_PROMPT_TEMPLATE, FALLBACK_MESSAGES, STATIC_SYSTEM_PROMPT
+
+    knowledge = os.path.join(directory, "knowledge", "0")
+    if traced:
+        tracemalloc.start()
+    start = time.perf_counter()
+    registry = PersonaRegistry(Persona(
+        "default", STATIC_SYSTEM_PROMPT, parse_template(DYNAMIC_SYSTEM_PROMPT_TEMPLATE), parse_template(ASSISTANT_PROMPT_TEMPLATE),
+        KnowledgeStore(
+            os.path.join(knowledge, "terminology.json"), os.path.join(knowledge, "additional_rules.json"), 0,
+            os.path.join(knowledge, "knowledge.compiled")
+        ),
+        FALLBACK_MESSAGES
+    ))
+    registry.load_dir(os.path.join(directory, "personas"))
+    registry.load_knowledge()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    memory = tracemalloc.get_traced_memory()[0] if traced else 0
+    stores = registry.knowledge_stores()
+    return {
+        "ms": elapsed * 1000,
+        "memory_mb": memory / 2 ** 20,
+        "personas": len(registry.personas),
+        "knowledge_stores": len(stores),
+        "knowledge_snapshots": len({id(store.get().terminology_indices) for store in stores}),
+    }
+
+def spawn(*args: str) -> dict:
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.join(ROOT, "app"), ROOT]), CLAUDE_API_KEY="benchmark", LOG_LEVEL="WARNING")
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", *args], capture_output=True, text=True, env=env, cwd=ROOT, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def write_personas(directory: str, personas: int, layout: str, terms: int, rng: random.Random):
+    """Knowledge directories and persona files of `layout`. The default persona of the child is persona 0."""
+    from constants import STATIC_SYSTEM_PROMPT
+    knowledge = os.path.join(directory, "knowledge")
+    os.makedirs(os.path.join(knowledge, "0"))
+    write_knowledge(os.path.join(knowledge, "0"), terms, rng)
+    os.makedirs(os.path.join(directory, "personas"))
+    for i in range(1, personas):
+        path = os.path.join(knowledge, "0" if layout == "shared" else str(i))
+        if layout == "copies":
+            shutil.copytree(os.path.join(knowledge, "0"), path)
+        elif layout == "distinct":
+            os.makedirs(path)
+            write_knowledge(path, terms, rng)
+        definition = {
+            # Every persona has a prompt of its own
+            "system_prompt": STATIC_SYSTEM_PROMPT.replace("ぴの", f"ぴの{i}"),
+            "assistant_prompt_template": f"[an angel, ぴの{i}]<response>",
+            "terminology_path": os.path.join(path, "terminology.json"),
+            "additional_rules_path": os.path.join(path, "additional_rules.json"),
+            "compiled_knowledge_path": os.path.join(path, "knowledge.compiled"),
+        }
+        with open(os.path.join(directory, "personas", f"p{i:03d}.json"), "w", encoding="utf-8") as f:
+            json.dump(definition, f, ensure_ascii=False)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--personas", default=",".join(map(str, PERSONA_COUNTS)), help="comma-separated numbers of personas")
+    parser.add_argument("--terms", type=int, default=1_000, help="terms and additional rules of each knowledge")
+    parser.add_argument("--repeat", type=int, default=3, help="fresh interpreters per case")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--child", nargs="+", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(child_load(args.child[0], args.child[1] == "traced")))
+        return
+
+    os.environ.setdefault("CLAUDE_API_KEY", "benchmark")
+    rng = random.Random(args.seed)
+    results = []
+    for layout in LAYOUTS:
+        for personas in (int(n) for n in args.personas.split(",")):
+            with tempfile.TemporaryDirectory() as directory:
+                write_personas(directory, personas, layout, args.terms, rng)
+                runs = [spawn(directory, "timed") for _ in range(args.repeat)]
+                memory = spawn(directory, "traced")["memory_mb"]
+            results.append({
+                "name": "persona_load",
+                "params": {"personas": personas, "layout": layout},
+                **summarize([run["ms"] for run in runs]),
+                "memory_mb": memory,
+                "memory_mb_per_persona": memory / personas,
+                "knowledge_stores": runs[0]["knowledge_stores"],
+                "knowledge_snapshots": runs[0]["knowledge_snapshots"],
+            })
+            print(f"{layout} personas={personas}: {results[-1]['mean_ms']:.1f} ms {memory:.1f} MB", file=sys.stderr)
+
+    report("personas", results, config={"terms": args.terms, "repeat": args.repeat, "seed": args.seed}, output=args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""Reports input tokens billed with and without provider-side caching of the static persona.
+
+Requests go through `generate_response_async` to the local fake provider, which accounts
+cache writes and reads for system blocks marked with `cache_control`.
+Run from the repository root:
+    PYTHONPATH=app python benchmarks/bench_prompt_caching.py
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_anthropic import serve_in_thread
+
+os.environ.setdefault("CLAUDE_API_KEY", "benchmark")
+os.environ["ANTHROPIC_BASE_URL"] = serve_in_thread(port=8102, latency_ms=0)
+
+from utils import generate_response_async, search_additional_rules, search_terminology, TermCategory
+
+QUERIES = ["こんにちは", "邪神ちゃんがまたプリンを食べましたわ", "花園さんはどこ？", "ぺこら様とぽぽろんが来ましたわ", "今日の天気は？"]
+# Relative prices of cache writes and reads, as multiples of the base input token price
+CACHE_WRITE_PRICE = 1.25
+CACHE_READ_PRICE = 0.1
+
+async def main():
+    totals = {"input_tokens": 0, "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}
+    for _ in range(20):
+        for query in QUERIES:
+            people = search_terminology(query, TermCategory.PERSON)
+            additional_rules = search_additional_rules(query + "".join(person.description for person in people))
+            _, usage = await generate_response_async(query, params={"people": people, "additional_rules": additional_rules})
+            for key in totals:
+                totals[key] += getattr(usage, key)
+
+    uncached = sum(totals.values())
+    billed = totals["input_tokens"] + totals["cache_creation_input_tokens"] * CACHE_WRITE_PRICE + totals["cache_read_input_tokens"] * CACHE_READ_PRICE
+    print(totals)
+    print(f"input token cost without caching: {uncached}")
+    print(f"input token cost with caching:    {billed:.0f} ({billed / uncached:.0%})")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,130 @@
+"""Cold start benchmark: import time, knowledge load time and latency of the first request.
+
+Every sample runs in a fresh interpreter, so nothing is cached between samples:
+    PYTHONPATH=app python benchmarks/bench_startup.py --output startup.json
+`first_request` compares the API server with and without the lifespan warm-up against the local fake
+provider, `knowledge_load` compares loading the JSON knowledge files with the compiled file.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.results import report, summarize
+
+PROVIDER_PORT = 8107
+IMPORTS = ("utils", "app.api")
+GLOSSARY_SIZES = (34, 1_000, 10_000)
+
+def child_import(module: str) -> dict:
+    start = time.perf_counter()
+    __import__(module)
+    return {"ms": (time.perf_counter() - start) * 1000}
+
+def child_knowledge(directory: str, compiled: bool) -> dict:
+    from utils.knowledge import KnowledgeStore
+    store = KnowledgeStore(
+        os.path.join(directory, "terminology.json"), os.path.join(directory, "additional_rules.json"), 0,
+        os.path.join(directory, "knowledge.compiled") if compiled else None
+    )
+    start = time.perf_counter()
+    store.get()
+    return {"ms": (time.perf_counter() - start) * 1000}
+
+def child_first_request(warm_up: bool) -> dict:
+    import asyncio
+    from benchmarks.fake_anthropic import serve_in_thread
+    os.environ["ANTHROPIC_BASE_URL"] = serve_in_thread(port=PROVIDER_PORT, latency_ms=0)
+    os.environ["CONV_HISTORY_PATH_TEMPLATE"] = os.path.join(tempfile.mkdtemp(), "{user_id}.jsonl")
+
+    import httpx
+    import app.api
+    if not warm_up:
+        async def skip_warm_up():
+            pass
+        app.api.warm_up = skip_warm_up
+
+    async def run() -> dict:
+        start = time.perf_counter()
+        async with app.api.app.router.lifespan_context(app.api.app):
+            startup = time.perf_counter() - start
+            transport = httpx.ASGITransport(app=app.api.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://api") as client:
+                latencies = []
+                for i in range(2):
+                    start = time.perf_counter()
+                    response = await client.post("/api/chat/v0.1", json={"author": {"user_id": f"startup{i}"}, "message": {"text": "花園さんはどこですの？"}})
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    assert response.json()["status"] == "ok", response.text
+        return {"startup_ms": startup * 1000, "first_ms": latencies[0], "second_ms": latencies[1]}
+
+    return asyncio.run(run())
+
+def spawn(*args: str) -> dict:
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.join(ROOT, "app"), ROOT]), CLAUDE_API_KEY="benchmark", LOG_LEVEL="WARNING")
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", *args], capture_output=True, text=True, env=env, cwd=ROOT, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def write_knowledge(directory: str, size: int, rng: random.Random):
+    from benchmarks.bench_terminology import HIRAGANA, synthetic_terms
+    from utils.knowledge import compile_knowledge
+    from utils.models import AditionalRule
+    terms = synthetic_terms(size, rng)
+    for term in terms:
+        term.description = "".join(rng.choices(HIRAGANA, k=100))
+    rules = [AditionalRule(index_regex=term.index_regex, rules=[f"You call {term.name} {term.name}さん."]) for term in terms]
+    with open(os.path.join(directory, "terminology.json"), "w", encoding="utf-8") as f:
+        json.dump([term.model_dump(mode="json") for term in terms], f, ensure_ascii=False)
+    with open(os.path.join(directory, "additional_rules.json"), "w", encoding="utf-8") as f:
+        json.dump([rule.model_dump(mode="json") for rule in rules], f, ensure_ascii=False)
+    compile_knowledge(os.path.join(directory, "terminology.json"), os.path.join(directory, "additional_rules.json"), os.path.join(directory, "knowledge.compiled"))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters per case")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--child", nargs="+", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        case, *params = args.child
+        if case == "import":
+            result = child_import(params[0])
+        elif case == "knowledge":
+            result = child_knowledge(params[0], params[1] == "compiled")
+        else:
+            result = child_first_request(params[0] == "warm")
+        print(json.dumps(result))
+        return
+
+    results = []
+    for module in IMPORTS:
+        samples = [spawn("import", module)["ms"] for _ in range(args.repeat)]
+        results.append({"name": "import", "params": {"module": module}, **summarize(samples)})
+
+    os.environ.setdefault("CLAUDE_API_KEY", "benchmark")
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        for size in GLOSSARY_SIZES:
+            write_knowledge(directory, size, rng)
+            for source in ("json", "compiled"):
+                samples = [spawn("knowledge", directory, source)["ms"] for _ in range(args.repeat)]
+                results.append({"name": "knowledge_load", "params": {"terms": size, "rules": size, "source": source}, **summarize(samples)})
+
+    for mode in ("cold", "warm"):
+        runs = [spawn("first_request", mode) for _ in range(args.repeat)]
+        for key in ("startup_ms", "first_ms", "second_ms"):
+            results.append({"name": "first_request", "params": {"warm_up": mode == "warm", "measure": key[:-3]}, **summarize([run[key] for run in runs])})
+
+    report("startup", results, config={"repeat": args.repeat, "seed": args.seed}, output=args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Compares time-to-first-byte and generated output tokens of the blocking and the streaming chat endpoints.
+
+The API server and the fake provider run locally, the fake replies with several sentences so the
+streaming endpoint can stop once the reply reaches MAX_RESPONSE_LENGTH.
+Run from the repository root:
+    PYTHONPATH=app python benchmarks/bench_streaming.py
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_anthropic import LONG_REPLY, serve_in_thread
+
+os.environ.setdefault("CLAUDE_API_KEY", "benchmark")
+provider_url = serve_in_thread(port=8103, latency_ms=300, token_latency_ms=15, reply_text=LONG_REPLY)
+os.environ["ANTHROPIC_BASE_URL"] = provider_url
+os.environ["CONV_HISTORY_PATH_TEMPLATE"] = os.path.join(tempfile.mkdtemp(), "{user_id}.jsonl")
+
+import httpx
+
+from app.api import app
+
+REQUESTS = 10
+
+def output_tokens_sent(client: httpx.Client) -> int:
+    return client.get(f"{provider_url}/stats").json()["output_tokens_sent"]
+
+def main():
+    api_url = serve_in_thread(port=8104, app=app)
+    body = {"author": {"user_id": "bench"}, "message": {"text": "お菓子を作ってくださる？"}}
+    with httpx.Client(timeout=60) as client:
+        for path in ("/api/chat/v0.1", "/api/chat/v0.1/stream"):
+            first_byte_ms, total_ms = [], []
+            tokens_before = output_tokens_sent(client)
+            for _ in range(REQUESTS):
+                start = time.perf_counter()
+                with client.stream("POST", api_url + path, json=body) as response:
+                    first = None
+                    for line in response.iter_lines():
+                        if first is None and line:
+                            first = time.perf_counter()
+                total_ms.append((time.perf_counter() - start) * 1000)
+                first_byte_ms.append((first - start) * 1000)
+                # Let the provider notice the disconnect before counting tokens
+                time.sleep(0.1)
+            tokens = (output_tokens_sent(client) - tokens_before) / REQUESTS
+            print(f"{path:<24} ttfb {statistics.median(first_byte_ms):7.0f} ms   total {statistics.median(total_ms):7.0f} ms   output tokens {tokens:6.1f}")
+
+if __name__ == "__main__":
+    main()
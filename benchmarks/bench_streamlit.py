@@ -0,0 +1,66 @@
+"""Measures the Streamlit app against the local fake provider.
+
+Time-to-first-token compares the blocking `generate_response` with the streamed path used by the app,
+with many sessions generating at once. Per-rerun CPU runs the app script headless with `AppTest`.
+Run from the repository root:
+    PYTHONPATH=app python benchmarks/bench_streamlit.py
+"""
+import hashlib
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_anthropic import LONG_REPLY, serve_in_thread
+
+os.environ.setdefault("CLAUDE_API_KEY", "benchmark")
+os.environ["ANTHROPIC_BASE_URL"] = serve_in_thread(port=8105, latency_ms=300, token_latency_ms=15, reply_text=LONG_REPLY)
+os.environ["HASHED_ACCESS_TOKENS"] = hashlib.sha256(b"benchmark").hexdigest()
+
+from streamlit.testing.v1 import AppTest
+
+from constants import MAX_RESPONSE_LENGTH, RESPONSE_POSTFIX
+from utils import generate_response, generate_response_stream, StreamingTruncator
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app", "main.py")
+TURNS = 10
+
+def blocking_first_token() -> float:
+    start = time.perf_counter()
+    generate_response("お菓子を作ってくださる？")
+    return time.perf_counter() - start
+
+def streamed_first_token() -> float:
+    start = time.perf_counter()
+    truncator = StreamingTruncator(MAX_RESPONSE_LENGTH, stop_text=RESPONSE_POSTFIX)
+    texts = generate_response_stream("お菓子を作ってくださる？").text_stream_sync()
+    for text in texts:
+        if truncator.feed(text):
+            break
+    elapsed = time.perf_counter() - start
+    texts.close()
+    return elapsed
+
+def main():
+    print(f"{'sessions':>8} {'blocking ttft ms':>17} {'streamed ttft ms':>17}")
+    for sessions in (1, 10, 50):
+        with ThreadPoolExecutor(max_workers=sessions) as executor:
+            blocking = list(executor.map(lambda _: blocking_first_token(), range(sessions)))
+            streamed = list(executor.map(lambda _: streamed_first_token(), range(sessions)))
+        print(f"{sessions:>8} {statistics.median(blocking) * 1000:>17.0f} {statistics.median(streamed) * 1000:>17.0f}")
+
+    app = AppTest.from_file(APP_PATH, default_timeout=60)
+    app.query_params["token"] = "benchmark"
+    app.run()
+    print(f"\n{'turn':>4} {'rerun cpu ms':>13}")
+    for turn in range(1, TURNS + 1):
+        start = time.process_time()
+        app.chat_input[0].set_value(f"{turn}回目ですわ").run()
+        if turn in (1, TURNS // 2, TURNS):
+            print(f"{turn:>4} {(time.process_time() - start) * 1000:>13.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Compares the compiled term index with the original per-term `re.search` loop.
+
+Run from the repository root:
+    PYTHONPATH=app python benchmarks/bench_terminology.py
+"""
+import os
+import random
+import re
+import timeit
+
+os.environ.setdefault("CLAUDE_API_KEY", "benchmark")
+
+from utils.matcher import PatternIndex
+from utils.models import Term, TermCategory
+
+KATAKANA = [chr(c) for c in range(ord("ァ"), ord("ン") + 1)]
+HIRAGANA = [chr(c) for c in range(ord("ぁ"), ord("ん") + 1)]
+
+def synthetic_terms(size: int, rng: random.Random) -> list[Term]:
+    terms = []
+    for i in range(size):
+        aliases = ["".join(rng.choices(alphabet, k=rng.randint(2, 6))) for alphabet in (KATAKANA, HIRAGANA)]
+        aliases.append(f"Term{i}")
+        terms.append(Term(
+            index_regex="|".join(aliases),
+            name=aliases[0],
+            categories=[TermCategory.PERSON if i % 2 == 0 else TermCategory.OTHER],
+            description="",
+            alias=aliases[0],
+            attributes=[],
+        ))
+    return terms
+
+def synthetic_query(terms: list[Term], length: int, rng: random.Random) -> str:
+    words = [rng.choice(term.index_regex.split("|")) for term in rng.sample(terms, min(5, len(terms)))]
+    filler = "".join(rng.choices(HIRAGANA, k=length))
+    for word in words:
+        pos = rng.randint(0, len(filler))
+        filler = filler[:pos] + word + filler[pos:]
+    return filler
+
+def naive_search(terms: list[Term], query: str, category: TermCategory) -> list[Term]:
+    return [v for v in terms if (re.search(v.index_regex, query) and (not category or category in v.categories))]
+
+def main():
+    rng = random.Random(0)
+    print(f"{'terms':>7} {'query':>6} {'naive ms':>10} {'index ms':>10} {'speedup':>8}")
+    for size in (10, 100, 1_000, 10_000):
+        terms = synthetic_terms(size, rng)
+        index = PatternIndex([(term.index_regex, term) for term in terms if TermCategory.PERSON in term.categories])
+        for length in (100, 1_000):
+            query = synthetic_query(terms, length, rng)
+            assert index.search(query) == naive_search(terms, query, TermCategory.PERSON)
+            number = max(1, 2_000 // size)
+            naive = timeit.timeit(lambda: naive_search(terms, query, TermCategory.PERSON), number=number) / number
+            indexed = timeit.timeit(lambda: index.search(query), number=number) / number
+            print(f"{size:>7} {length:>6} {naive * 1000:>10.3f} {indexed * 1000:>10.3f} {naive / indexed:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
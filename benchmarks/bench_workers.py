@@ -0,0 +1,235 @@
+"""Multi-process stress test of the per-user ordering of turns, and throughput by number of API workers.
+
+Starts `uvicorn app.api:app --workers N` against the fake provider in echo mode, which replies with the previous
+user message of the history it was sent. Several turns of each user are sent at the same time, then the history
+files, archives included, are checked: every line is valid JSON, user and assistant lines alternate, every
+answered message was saved once, and every reply saw the turn saved before it. History files are archived every
+few turns so rotation runs under load, and users are spread over few lock stripes so several users share one:
+    PYTHONPATH=app python benchmarks/bench_workers.py --output workers.json
+Run with `--ordering none` to see what goes wrong with several workers without the locks.
+`shared_stripe` replays random turns of a few users sharing a single stripe through two lock instances, each with
+its own history cache, and counts the turns that would have been answered from a stale cache.
+"""
+import argparse
+import asyncio
+import gzip
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.results import report, summarize
+
+from utils.user_locks import UserTurnLocks
+
+PROVIDER_PORT = 8127
+API_PORT = 8128
+
+def start_provider(latency_ms: int) -> subprocess.Popen:
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "benchmarks", "fake_anthropic.py"), "--port", str(PROVIDER_PORT), "--latency-ms", str(latency_ms), "--echo-history"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    wait_until_up(f"http://127.0.0.1:{PROVIDER_PORT}/stats")
+    return process
+
+def start_api(workers: int, ordering: str, directory: str, max_size_mb: float, stripes: int) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([os.path.join(ROOT, "app"), ROOT]),
+        CLAUDE_API_KEY="benchmark",
+        ANTHROPIC_BASE_URL=f"http://127.0.0.1:{PROVIDER_PORT}",
+        LOG_LEVEL="WARNING",
+        CONV_HISTORY_PATH_TEMPLATE=os.path.join(directory, "{user_id}.jsonl"),
+        CONV_HISTORY_ARCHIVE_FOLDER=os.path.join(directory, "archive"),
+        CONV_HISTORY_MAX_SIZE_MB=str(max_size_mb),
+        USER_ORDERING=ordering,
+        USER_LOCK_DIR=os.path.join(directory, "locks"),
+        USER_LOCK_STRIPES=str(stripes),
+        KNOWLEDGE_RELOAD_INTERVAL_SEC="0",
+    )
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.api:app", "--port", str(API_PORT), "--workers", str(workers), "--log-level", "warning"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    wait_until_up(f"http://127.0.0.1:{API_PORT}/health")
+    return process
+
+def wait_until_up(url: str, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"{url} didn't come up")
+
+def stop(process: subprocess.Popen):
+    # SIGINT lets uvicorn run the shutdown of every worker
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+async def send_turns(users: int, turns: int, in_flight: int) -> tuple[float, dict[str, set[str]], dict[str, int], list[float]]:
+    """Send `turns` messages per user, `in_flight` of each user at a time. Returns the wall time, the answered texts
+    per user, the count of each status and the latencies."""
+    answered: dict[str, set[str]] = {f"stress{u}": set() for u in range(users)}
+    statuses: dict[str, int] = {}
+    latencies: list[float] = []
+    limits = httpx.Limits(max_connections=users * in_flight, max_keepalive_connections=users * in_flight)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{API_PORT}", limits=limits, timeout=60) as client:
+        async def user(user_id: str):
+            semaphore = asyncio.Semaphore(in_flight)
+
+            async def turn(k: int):
+                async with semaphore:
+                    text = f"{user_id}-{k}"
+                    start = time.perf_counter()
+                    response = await client.post("/api/chat/v0.1", json={"author": {"user_id": user_id}, "message": {"text": text}})
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    body = response.json()
+                    status = "fallback" if body.get("fallback_used") else body["status"]
+                    statuses[status] = statuses.get(status, 0) + 1
+                    if status == "ok":
+                        answered[user_id].add(text)
+
+            await asyncio.gather(*(turn(k) for k in range(turns)))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(user(user_id) for user_id in answered))
+        return time.perf_counter() - start, answered, statuses, latencies
+
+def read_history(directory: str, user_id: str) -> tuple[list[bytes], int]:
+    """Lines of the user's archives, oldest first, then of the active file, without the lines carried over from one
+    file to the next. Also returns the number of lines that aren't valid JSON."""
+    import orjson
+    archive = Path(directory, "archive")
+    names = sorted({path.name.removesuffix(".gz") for path in archive.glob(f"{user_id}_*.jsonl*") if not path.name.endswith(".tmp")})
+    contents = []
+    for name in names:
+        raw = archive / name
+        contents.append(raw.read_bytes() if raw.exists() else gzip.decompress((archive / (name + ".gz")).read_bytes()))
+    active = Path(directory, f"{user_id}.jsonl")
+    if active.exists():
+        contents.append(active.read_bytes())
+
+    lines: list[bytes] = []
+    seen: set[bytes] = set()
+    damaged = 0
+    for content in contents:
+        for line in content.split(b"\n"):
+            if not line.strip() or line in seen:
+                continue
+            try:
+                orjson.loads(line)
+            except orjson.JSONDecodeError:
+                damaged += 1
+                continue
+            seen.add(line)
+            lines.append(line)
+    return lines, damaged
+
+def check_history(directory: str, answered: dict[str, set[str]]) -> dict:
+    """Count the violations of per-user ordering found in the history files."""
+    import orjson
+    problems = {"damaged_lines": 0, "missing": 0, "duplicated": 0, "not_alternating": 0, "stale_history": 0}
+    for user_id, texts in answered.items():
+        lines, damaged = read_history(directory, user_id)
+        problems["damaged_lines"] += damaged
+        records = [orjson.loads(line) for line in lines]
+        saved = [record["text"] for record in records if record["role"] == "user"]
+        problems["missing"] += len(texts - set(saved))
+        problems["duplicated"] += len(saved) - len(set(saved))
+        previous = ""
+        for i in range(0, len(records), 2):
+            pair = records[i:i + 2]
+            if [record["role"] for record in pair] != ["user", "assistant"]:
+                problems["not_alternating"] += 1
+                break
+            if pair[1]["text"] != f"after:{previous}":
+                problems["stale_history"] += 1
+            previous = pair[0]["text"]
+    return problems
+
+async def check_shared_stripe(turns: int, seed: int) -> int:
+    """Turns of users hashed onto one stripe, served by two lock instances in random order, that would have been
+    answered from a cached history missing turns of the other instance."""
+    rng = random.Random(seed)
+    users = ["x", "y", "z"]
+    store: dict[str, list[int]] = {user: [] for user in users}
+    stale = 0
+    with tempfile.TemporaryDirectory() as directory:
+        workers = [(UserTurnLocks(stripes=1, lock_dir=directory), {}) for _ in range(2)]
+        for turn in range(turns):
+            locks, cache = rng.choice(workers)
+            user = rng.choice(users)
+            async with locks.hold(user) as changed:
+                if changed or user not in cache:
+                    cache[user] = list(store[user])
+                if cache[user] != store[user]:
+                    stale += 1
+                    cache[user] = list(store[user])
+                store[user].append(turn)
+                cache[user].append(turn)
+    return stale
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default="1,2,4", help="comma-separated numbers of API workers")
+    parser.add_argument("--ordering", default="workers", choices=("none", "process", "workers"), help="USER_ORDERING of the API workers")
+    parser.add_argument("--users", type=int, default=32)
+    parser.add_argument("--turns", type=int, default=20, help="turns per user")
+    parser.add_argument("--in-flight", type=int, default=4, help="turns of each user sent at the same time")
+    parser.add_argument("--latency-ms", type=int, default=20, help="latency of the fake provider")
+    parser.add_argument("--max-size-mb", type=float, default=0.002, help="CONV_HISTORY_MAX_SIZE_MB, small so files are archived during the run")
+    parser.add_argument("--stripes", type=int, default=4, help="USER_LOCK_STRIPES, few so users share stripes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    stale = asyncio.run(check_shared_stripe(1000, args.seed))
+    results = [{"name": "shared_stripe", "params": {"turns": 1000}, "stale_history": stale}]
+    print(f"shared stripe: stale={stale}", file=sys.stderr)
+
+    provider = start_provider(args.latency_ms)
+    try:
+        for workers in (int(n) for n in args.workers.split(",")):
+            with tempfile.TemporaryDirectory() as directory:
+                api = start_api(workers, args.ordering, directory, args.max_size_mb, args.stripes)
+                try:
+                    elapsed, answered, statuses, latencies = asyncio.run(send_turns(args.users, args.turns, args.in_flight))
+                finally:
+                    stop(api)
+                problems = check_history(directory, answered)
+                archived = len({path.name.removesuffix(".gz") for path in Path(directory, "archive").glob("*.jsonl*")})
+            results.append({
+                "name": "ordered_turns",
+                "params": {"workers": workers, "ordering": args.ordering, "stripes": args.stripes},
+                "turns_per_s": args.users * args.turns / elapsed,
+                "statuses": statuses,
+                "archived_files": archived,
+                **problems,
+                **summarize(latencies),
+            })
+            print(f"workers={workers}: {results[-1]['turns_per_s']:.1f} turns/s {statuses} archived={archived} {problems}", file=sys.stderr)
+    finally:
+        stop(provider)
+
+    report("workers", results, config={**vars(args), "cpus": os.cpu_count()}, output=args.output)
+
+if __name__ == "__main__":
+    main()
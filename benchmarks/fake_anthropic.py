@@ -0,0 +1,130 @@
+"""Local stand-in for the Anthropic messages API used by the benchmarks.
+
+Start it standalone with:
+    python benchmarks/fake_anthropic.py --port 8100 --latency-ms 500 --token-latency-ms 20
+and point the app at it with `ANTHROPIC_BASE_URL=http://127.0.0.1:8100`.
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+REPLY_TEXT = "うふふふ…不安ですわ。花園さん、わたくしを見捨てないでくださいますわよね？</response>"
+# Longer than MAX_RESPONSE_LENGTH, so the reply gets truncated
+LONG_REPLY = (
+    "うふふふ…花園さんがわたくしにお菓子を作ってほしいとおっしゃるなんて、なんて素敵な日なのでしょう。"
+    "でも、もしかしたら毒見役にされているのかもしれませんわ…不安ですわ。"
+    "いえ、花園さんに限ってそんなことはありませんわよね？"
+    "今日は金色の衣を纏いし紅顔の美少年を焼いてさしあげますわ！"
+    "主に見つかる前に、急いで膝に注射を打っておきますわ…。</response>"
+)
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 2
+
+def count_input_tokens(body: dict, cached_prefixes: set[str]) -> dict:
+    """Split input tokens like the provider does when system blocks are marked with cache_control."""
+    system = body.get("system", "")
+    blocks = [{"text": system}] if isinstance(system, str) else system
+    prefix = ""
+    cached_prefix = ""
+    for block in blocks:
+        prefix += block["text"]
+        if "cache_control" in block:
+            cached_prefix = prefix
+    usage = {"cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}
+    if cached_prefix:
+        key = "cache_read_input_tokens" if cached_prefix in cached_prefixes else "cache_creation_input_tokens"
+        usage[key] = estimate_tokens(cached_prefix)
+        cached_prefixes.add(cached_prefix)
+    usage["input_tokens"] = estimate_tokens(prefix[len(cached_prefix):] + str(body.get("messages", [])))
+    return usage
+
+def previous_user_text(body: dict) -> str:
+    """Text of the last user message of the history sent before the new one, empty without history."""
+    contents = [message["content"] for message in body.get("messages", []) if message["role"] == "user"]
+    if len(contents) < 2:
+        return ""
+    content = contents[-2]
+    return content if isinstance(content, str) else "".join(block["text"] for block in content)
+
+def sse(event: dict) -> str:
+    return f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+def create_app(latency_ms: int = 500, token_latency_ms: int = 0, reply_text: str = REPLY_TEXT, echo_history: bool = False) -> FastAPI:
+    """`latency_ms` is the time to the first token and `token_latency_ms` the time per output token of two characters.
+    With `echo_history` the reply is `after:` followed by the previous user message of the history the request was
+    sent with, to check which history each request saw."""
+    app = FastAPI()
+    app.state.output_tokens_sent = 0
+    cached_prefixes: set[str] = set()
+
+    def reply_tokens(body: dict) -> list[str]:
+        text = f"after:{previous_user_text(body)}" if echo_history else reply_text
+        return [text[i:i + 2] for i in range(0, len(text), 2)]
+
+    def message(body: dict, content: list, usage: dict) -> dict:
+        return {
+            "id": f"msg_{uuid.uuid4().hex}",
+            "type": "message",
+            "role": "assistant",
+            "model": body.get("model", "fake"),
+            "content": content,
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": usage,
+        }
+
+    async def stream(body: dict, usage: dict, tokens: list[str]):
+        yield sse({"type": "message_start", "message": message(body, [], {**usage, "output_tokens": 1})})
+        yield sse({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+        await asyncio.sleep(latency_ms / 1000)
+        for token in tokens:
+            # Counted only once sent, so a client that disconnects early stops the count
+            app.state.output_tokens_sent += 1
+            yield sse({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": token}})
+            await asyncio.sleep(token_latency_ms / 1000)
+        yield sse({"type": "content_block_stop", "index": 0})
+        yield sse({"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None}, "usage": {"output_tokens": len(tokens)}})
+        yield sse({"type": "message_stop"})
+
+    @app.post("/v1/messages")
+    async def messages(request: Request):
+        body = await request.json()
+        usage = count_input_tokens(body, cached_prefixes)
+        tokens = reply_tokens(body)
+        if body.get("stream"):
+            return StreamingResponse(stream(body, usage, tokens), media_type="text/event-stream")
+        await asyncio.sleep((latency_ms + token_latency_ms * len(tokens)) / 1000)
+        app.state.output_tokens_sent += len(tokens)
+        return message(body, [{"type": "text", "text": "".join(tokens)}], {**usage, "output_tokens": len(tokens)})
+
+    @app.get("/stats")
+    async def stats():
+        return {"output_tokens_sent": app.state.output_tokens_sent}
+
+    return app
+
+def serve_in_thread(port: int = 8100, app: FastAPI = None, **kwargs) -> str:
+    """Runs the fake provider, or another app, on a daemon thread and returns its base url once it accepts connections."""
+    config = uvicorn.Config(app or create_app(**kwargs), host="127.0.0.1", port=port, log_level="warning")
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return f"http://127.0.0.1:{port}"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency-ms", type=int, default=500)
+    parser.add_argument("--token-latency-ms", type=int, default=0)
+    parser.add_argument("--echo-history", action="store_true", help="reply with the previous user message the request was sent with")
+    args = parser.parse_args()
+    uvicorn.run(create_app(latency_ms=args.latency_ms, token_latency_ms=args.token_latency_ms, echo_history=args.echo_history), host="127.0.0.1", port=args.port)
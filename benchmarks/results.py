@@ -0,0 +1,79 @@
+"""Timing and JSON reporting shared by the benchmarks, so runs can be compared over time."""
+import json
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Callable, Optional
+
+def percentile(sorted_samples: list[float], p: float) -> float:
+    """Nearest-rank percentile of already sorted samples."""
+    if not sorted_samples:
+        return 0.0
+    rank = max(1, -(-len(sorted_samples) * p // 100))
+    return sorted_samples[int(rank) - 1]
+
+def summarize(samples_ms: list[float]) -> dict:
+    samples = sorted(samples_ms)
+    return {
+        "count": len(samples),
+        "mean_ms": sum(samples) / len(samples) if samples else 0.0,
+        "p50_ms": percentile(samples, 50),
+        "p95_ms": percentile(samples, 95),
+        "p99_ms": percentile(samples, 99),
+        "max_ms": samples[-1] if samples else 0.0,
+    }
+
+def measure(fn: Callable[[], object], iterations: int, warmup: int = 3, setup: Optional[Callable[[], object]] = None,
+            max_seconds: float = 5.0, min_iterations: int = 5) -> dict:
+    """Time each call of `fn` separately. `setup` runs before every call and is not timed.
+
+    Slow cases warm up with a single call and stop after `max_seconds` of timed calls once `min_iterations`
+    calls were timed.
+    """
+    for _ in range(warmup):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        if time.perf_counter() - start > max_seconds / min_iterations:
+            break
+    samples = []
+    total = 0.0
+    for _ in range(iterations):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        samples.append(elapsed * 1000)
+        total += elapsed
+        if total > max_seconds and len(samples) >= min_iterations:
+            break
+    return summarize(samples)
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def report(benchmark: str, results: list[dict], config: Optional[dict] = None, output: Optional[str] = None) -> dict:
+    """Print the results as JSON, or write them to `output`, with what is needed to compare runs."""
+    document = {
+        "benchmark": benchmark,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "config": config or {},
+        "results": results,
+    }
+    text = json.dumps(document, ensure_ascii=False, indent=2)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return document